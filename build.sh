@@ -41,6 +41,7 @@ fi
 # Run migrations
 echo "🗄️ Running database migrations..."
 python manage.py migrate
+python manage.py createcachetable
 
 # Load initial data
 echo "📥 Loading initial data..."
@@ -63,6 +64,9 @@ print('JSON is valid')
         echo "Loading data..."
         python manage.py loaddata initial_data.json --verbosity 3
         
+        echo "Building search index..."
+        python manage.py build_search_index
+
         echo "Checking media configuration..."
         python manage.py check_media
         
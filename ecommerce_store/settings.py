@@ -58,6 +58,7 @@ else:
                     'django.template.context_processors.request',
                     'django.contrib.auth.context_processors.auth',
                     'django.contrib.messages.context_processors.messages',
+                    'store.context_processors.cart',
                 ],
             },
         },
@@ -65,6 +65,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'store.context_processors.cart',
             ],
         },
     },
@@ -90,6 +91,36 @@ else:
         }
     }
 
+# ASGI deployment profile (see DEPLOYMENT.md). Persistent connections are
+# tied to the thread that opened them and are not reused across async
+# requests, so close them per request; on PostgreSQL use psycopg's pool
+# instead (requires psycopg[pool]).
+if os.environ.get('DJANGO_ASGI', 'False').lower() == 'true':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+        DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+            'min_size': 2,
+            'max_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        }
+
+# Cache
+# Shared by every gunicorn worker. Set REDIS_URL to use Redis (requires the
+# ``redis`` package), otherwise fall back to a table in the main database.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'store_cache',
+        }
+    }
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
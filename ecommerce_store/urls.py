@@ -19,9 +19,13 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from store.media_views import serve_thumbnail
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('store.urls')),
+    # Ahead of the media routes below, which would otherwise match it
+    path('media/thumb/<int:width>x<int:height>/<path:file_path>', serve_thumbnail, name='serve_thumbnail'),
 ]
 
 # Handle media files
@@ -15,22 +15,23 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 function setupAjaxCart() {
-    // Add to cart with AJAX
-    const addToCartForms = document.querySelectorAll('form[action*="add_to_cart"]');
+    // Add to cart with AJAX, through the async JSON endpoint
+    const addToCartForms = document.querySelectorAll('form[data-api-url]');
     
     addToCartForms.forEach(form => {
         form.addEventListener('submit', function(e) {
             e.preventDefault();
             
             const formData = new FormData(form);
-            const url = form.action;
+            const url = form.dataset.apiUrl;
             
             fetch(url, {
                 method: 'POST',
                 body: formData,
                 headers: {
                     'X-Requested-With': 'XMLHttpRequest',
-                    'X-CSRFToken': getCookie('csrftoken')
+                    'X-CSRFToken': getCookie('csrftoken'),
+                    'Idempotency-Key': newIdempotencyKey()
                 }
             })
             .then(response => response.json())
@@ -45,7 +46,7 @@ function setupAjaxCart() {
                     // Add animation to cart icon
                     animateCartIcon();
                 } else {
-                    showNotification('Error adding item to cart', 'error');
+                    showNotification(data.error || 'Error adding item to cart', 'error');
                 }
             })
             .catch(error => {
@@ -169,19 +170,84 @@ function setupDynamicContent() {
     }
     
     // Auto-save cart quantities
-    const quantityInputs = document.querySelectorAll('input[name="quantity"]');
+    setupCartBatchUpdate();
+}
+
+function setupCartBatchUpdate() {
+    // Collect quantity edits on the cart page and send them in one request
+    const cartLines = document.querySelector('#cart-lines');
+    if (!cartLines) {
+        return;
+    }
     
-    quantityInputs.forEach(input => {
-        let timeout;
+    const pending = {};
+    let timeout;
+    
+    cartLines.querySelectorAll('tr[data-product-id] input[name="quantity"]').forEach(input => {
         input.addEventListener('input', function() {
+            const quantity = parseInt(this.value, 10);
+            if (isNaN(quantity) || quantity < 0) {
+                return;
+            }
+            pending[this.closest('tr').dataset.productId] = quantity;
             clearTimeout(timeout);
-            timeout = setTimeout(() => {
-                this.closest('form').submit();
-            }, 1000);
+            timeout = setTimeout(() => sendCartUpdates(cartLines, pending), 600);
         });
     });
 }
 
+function sendCartUpdates(cartLines, pending) {
+    const items = Object.assign({}, pending);
+    Object.keys(pending).forEach(key => delete pending[key]);
+    if (Object.keys(items).length === 0) {
+        return;
+    }
+    
+    // CSRF_USE_SESSIONS hides the cookie, so take the token from the page
+    const csrfInput = cartLines.querySelector('input[name="csrfmiddlewaretoken"]');
+    
+    fetch(cartLines.dataset.batchUrl, {
+        method: 'POST',
+        body: JSON.stringify({items: items}),
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest',
+            'X-CSRFToken': csrfInput ? csrfInput.value : getCookie('csrftoken'),
+            'Idempotency-Key': newIdempotencyKey()
+        }
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            showNotification(data.error || 'Error updating cart', 'error');
+            return;
+        }
+        
+        cartLines.querySelectorAll('tr[data-product-id]').forEach(row => {
+            const line = data.items[row.dataset.productId];
+            if (!line) {
+                row.remove();
+                return;
+            }
+            row.querySelector('.line-total').textContent = '$' + line.total_price;
+        });
+        
+        const cartTotal = document.querySelector('#cart-total');
+        if (cartTotal) {
+            cartTotal.textContent = '$' + data.total_price;
+        }
+        updateCartBadge(data.cart_total);
+        
+        if (data.cart_total === 0) {
+            window.location.reload();
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showNotification('Error updating cart', 'error');
+    });
+}
+
 function setupSearch() {
     // Live search functionality (if search input exists)
     const searchInput = document.querySelector('#search-input');
@@ -251,6 +317,14 @@ function showNotification(message, type = 'info') {
     }, 5000);
 }
 
+// One key per user action; a retried request must send the same key again
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
 function getCookie(name) {
     let cookieValue = null;
     if (document.cookie && document.cookie !== '') {
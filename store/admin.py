@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Category, Product, Cart, CartItem, Order, OrderItem
+from .models import Category, Product, Cart, CartItem, Order, OrderItem, Job
+from .orders import refresh_order_totals
 
 
 @admin.register(Category)
@@ -47,9 +48,23 @@ class OrderItemInline(admin.TabularInline):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'first_name', 'last_name', 'email', 'status', 'created_at']
+    list_display = [
+        'id', 'user', 'first_name', 'last_name', 'email', 'status', 'item_count', 'total_cost', 'created_at'
+    ]
     list_filter = ['status', 'created_at']
     list_editable = ['status']
     inlines = [OrderItemInline]
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['total_cost', 'item_count', 'created_at', 'updated_at']
     search_fields = ['first_name', 'last_name', 'email']
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # The stored totals must follow edits to the inline items
+        refresh_order_totals(Order.objects.filter(pk=form.instance.pk))
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'task', 'status', 'attempts', 'run_at', 'finished_at']
+    list_filter = ['status', 'task']
+    readonly_fields = ['locked_at', 'locked_by', 'last_error', 'created_at', 'finished_at']
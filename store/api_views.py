@@ -0,0 +1,175 @@
+"""
+Catalog and cart JSON API.
+
+``/api/products/`` streams products as a JSON array or as NDJSON
+(``?format=ndjson`` or ``Accept: application/x-ndjson``) straight from
+a database iterator, so memory use stays flat regardless of catalog
+size.
+
+The product lookup and cart endpoints are ``async def`` views using the
+async ORM. Under ASGI (see DEPLOYMENT.md) a worker keeps serving other
+connections while they wait on the database; under WSGI Django runs
+them in a per-request event loop and they behave like sync views.
+"""
+import json
+from datetime import datetime
+
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import require_GET, require_POST
+
+from .cart import aadd_item, aget_cart_summary
+from .idempotency import idempotent
+from .inventory import with_available
+from .models import Product
+
+CHUNK_SIZE = 2000
+
+# Rows serialized per chunk written to the socket
+ROWS_PER_WRITE = 100
+
+FIELDS = {
+    'id': lambda p: p.id,
+    'name': lambda p: p.name,
+    'slug': lambda p: p.slug,
+    'description': lambda p: p.description,
+    'price': lambda p: str(p.price),
+    'stock': lambda p: p.stock,
+    'available': lambda p: p.available,
+    'category': lambda p: p.category.slug,
+    'category_name': lambda p: p.category.name,
+    'image': lambda p: p.image.url if p.image else None,
+    'url': lambda p: p.get_absolute_url(),
+    'created_at': lambda p: p.created_at.isoformat(),
+    'updated_at': lambda p: p.updated_at.isoformat(),
+}
+
+DEFAULT_FIELDS = [
+    'id', 'name', 'slug', 'price', 'stock', 'available', 'category', 'image', 'url', 'updated_at',
+]
+
+
+def _parse_since(value):
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(value)
+        since = datetime(date.year, date.month, date.day)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.get_default_timezone())
+    return since
+
+
+def _serialize(rows, fields, ndjson):
+    getters = [(name, FIELDS[name]) for name in fields]
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    separator = '\n' if ndjson else ','
+    buffer = []
+    first = True
+    if not ndjson:
+        yield '['
+    for product in rows:
+        buffer.append(encoder.encode({name: get(product) for name, get in getters}))
+        if len(buffer) >= ROWS_PER_WRITE:
+            chunk = separator.join(buffer)
+            yield chunk + '\n' if ndjson else (chunk if first else ',' + chunk)
+            first = False
+            buffer = []
+    if buffer:
+        chunk = separator.join(buffer)
+        yield chunk + '\n' if ndjson else (chunk if first else ',' + chunk)
+    if not ndjson:
+        yield ']'
+
+
+def product_feed(request):
+    """Stream the catalog as JSON or NDJSON
+
+    Query parameters: ``fields`` (comma separated), ``category`` (slug,
+    repeatable), ``updated_since`` (ISO date or datetime),
+    ``include_unavailable=1`` and ``format=json|ndjson``.
+    """
+    fields = DEFAULT_FIELDS
+    if request.GET.get('fields'):
+        fields = [name.strip() for name in request.GET['fields'].split(',') if name.strip()]
+        unknown = [name for name in fields if name not in FIELDS]
+        if unknown:
+            return JsonResponse(
+                {'error': f"Unknown fields: {', '.join(unknown)}", 'fields': sorted(FIELDS)},
+                status=400,
+            )
+
+    products = Product.objects.select_related('category').order_by('updated_at', 'id')
+    if not request.GET.get('include_unavailable'):
+        products = products.filter(available=True)
+    categories = request.GET.getlist('category')
+    if categories:
+        products = products.filter(category__slug__in=categories)
+    if request.GET.get('updated_since'):
+        try:
+            since = _parse_since(request.GET['updated_since'])
+        except ValueError:
+            return JsonResponse({'error': 'updated_since must be an ISO date or datetime'}, status=400)
+        products = products.filter(updated_at__gte=since)
+
+    ndjson = (
+        request.GET.get('format') == 'ndjson'
+        or 'application/x-ndjson' in request.headers.get('Accept', '')
+    )
+    content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    response = StreamingHttpResponse(
+        _serialize(products.iterator(chunk_size=CHUNK_SIZE), fields, ndjson),
+        content_type=content_type,
+    )
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_GET
+async def product_detail(request, slug):
+    """One available product as JSON"""
+    try:
+        product = await Product.objects.select_related('category').aget(slug=slug, available=True)
+    except Product.DoesNotExist:
+        return JsonResponse({'error': 'Product not found'}, status=404)
+    return JsonResponse({name: get(product) for name, get in FIELDS.items()})
+
+
+def _summary_json(summary):
+    return {
+        'lines': summary['lines'],
+        'total_items': summary['total_items'],
+        'total_price': str(summary['total_price']),
+    }
+
+
+@require_GET
+async def cart_summary(request):
+    """Totals for the current cart"""
+    return JsonResponse(_summary_json(await aget_cart_summary(request)))
+
+
+@require_POST
+@idempotent
+async def cart_add(request, product_id):
+    """Add one of a product to the current cart
+
+    The async counterpart of the AJAX branch of ``views.add_to_cart``,
+    returning the same payload.
+    """
+    try:
+        product = await with_available(Product.objects.all()).aget(id=product_id)
+    except Product.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Product not found'}, status=404)
+    if product.sellable < 1:
+        return JsonResponse({'success': False, 'error': f'{product.name} is out of stock.'}, status=409)
+    await aadd_item(request, product)
+    summary = await aget_cart_summary(request)
+    return JsonResponse({
+        'success': True,
+        'cart_total': summary['total_items'],
+        'message': f'{product.name} added to cart!',
+        **_summary_json(summary),
+    })
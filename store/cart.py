@@ -0,0 +1,386 @@
+"""
+Cart access for signed-in users and guests.
+
+Signed-in users keep their cart in ``Cart``/``CartItem``. Guests get a
+``GuestCart`` stored in the session as a compact ``{product id:
+quantity}`` mapping, so adding items never writes to the cart tables;
+with ``SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'``
+it needs no database writes at all. On login the guest cart is merged
+into the user's cart with one bulk upsert (see ``store.signals``).
+
+The navbar badge and the conditional GET validators only need a few
+totals for the current cart. For signed-in users they are aggregated
+with a single query (``summarize_cart_items``), kept in the shared cache
+per user and memoized on the request, so a cache hit costs no queries
+at all. Saving or deleting a ``CartItem`` drops the user's entry; the
+catalog version is stored alongside each entry so price changes are
+picked up too. ``aadd_item`` and ``aget_cart_summary`` serve the async
+cart API.
+"""
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .catalog_cache import get_catalog_version
+from .models import Cart, CartItem, Product, summarize_cart_items
+
+DEFAULT_TIMEOUT = 60 * 60
+
+SESSION_KEY = 'cart'
+
+EMPTY_SUMMARY = {'lines': 0, 'total_items': 0, 'total_price': Decimal('0.00'), 'last_modified': None}
+
+
+class GuestCartItem:
+    def __init__(self, product, quantity):
+        self.product = product
+        self.product_id = product.id
+        self.quantity = quantity
+
+    def get_total_price(self):
+        return self.quantity * self.product.price
+
+
+class GuestCart:
+    """Anonymous cart kept in the session"""
+
+    def __init__(self, session):
+        self.session = session
+        self._items = None
+
+    @property
+    def data(self):
+        # JSON session serialization turns keys into strings
+        return self.session.get(SESSION_KEY, {})
+
+    def _save(self, data):
+        if data:
+            self.session[SESSION_KEY] = data
+        else:
+            self.session.pop(SESSION_KEY, None)
+        self._items = None
+
+    def quantities(self):
+        return {int(product_id): quantity for product_id, quantity in self.data.items()}
+
+    def add(self, product_id, quantity=1):
+        data = dict(self.data)
+        data[str(product_id)] = data.get(str(product_id), 0) + quantity
+        self._save(data)
+        return data[str(product_id)]
+
+    def set(self, product_id, quantity):
+        data = dict(self.data)
+        if quantity > 0:
+            data[str(product_id)] = quantity
+        else:
+            data.pop(str(product_id), None)
+        self._save(data)
+
+    def remove(self, product_id):
+        data = dict(self.data)
+        removed = data.pop(str(product_id), None) is not None
+        self._save(data)
+        return removed
+
+    def clear(self):
+        self._save({})
+
+    def get_items(self):
+        """Cart lines with their products, loaded with one query"""
+        if self._items is None:
+            quantities = self.quantities()
+            products = (
+                Product.objects.select_related('category').in_bulk(list(quantities))
+                if quantities else {}
+            )
+            self._items = [
+                GuestCartItem(products[product_id], quantity)
+                for product_id, quantity in quantities.items()
+                if product_id in products
+            ]
+        return self._items
+
+    def get_total_price(self):
+        return sum(item.get_total_price() for item in self.get_items())
+
+    def get_total_items(self):
+        return sum(self.data.values())
+
+    def get_summary(self):
+        if not self.data:
+            return EMPTY_SUMMARY
+        return {
+            'lines': len(self.data),
+            'total_items': self.get_total_items(),
+            'total_price': self.get_total_price(),
+            'last_modified': None,
+        }
+
+
+def get_cart(request):
+    """The user's ``Cart`` (created on demand), or a ``GuestCart``"""
+    if request.user.is_authenticated:
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        return cart
+    return GuestCart(request.session)
+
+
+def get_cart_items(cart):
+    """Cart lines with their products and categories joined"""
+    if isinstance(cart, GuestCart):
+        return cart.get_items()
+    return list(cart.items.select_related('product__category'))
+
+
+def _cart_changed(request):
+    """Forget every cached view of the current cart"""
+    request._cart_summary = None
+    if request.user.is_authenticated:
+        user_id = request.user.pk
+        invalidate_cart_summary(user_id)
+        transaction.on_commit(lambda: invalidate_cart_summary(user_id))
+
+
+def _increment_sql():
+    """``INSERT ... ON CONFLICT`` that adds to an existing line's quantity
+
+    The cart is looked up by user inside the statement, so an add is a
+    single round trip. Returns None on backends without ``ON CONFLICT``.
+    """
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return None
+    qn = connection.ops.quote_name
+    item_table = qn(CartItem._meta.db_table)
+    cart_table = qn(Cart._meta.db_table)
+
+    def column(model, name):
+        return qn(model._meta.get_field(name).column)
+
+    cart, product, quantity, created_at, updated_at = (
+        column(CartItem, name)
+        for name in ('cart', 'product', 'quantity', 'created_at', 'updated_at')
+    )
+    return (
+        f'INSERT INTO {item_table} ({cart}, {product}, {quantity}, {created_at}, {updated_at}) '
+        f'SELECT {cart_table}.{qn(Cart._meta.pk.column)}, %s, %s, %s, %s FROM {cart_table} '
+        f'WHERE {cart_table}.{column(Cart, "user")} = %s '
+        f'ON CONFLICT ({cart}, {product}) DO UPDATE SET '
+        f'{quantity} = {item_table}.{quantity} + EXCLUDED.{quantity}, '
+        f'{updated_at} = EXCLUDED.{updated_at}'
+    )
+
+
+def _increment(user, product_id, quantity):
+    """Atomically add ``quantity`` to the user's line; False if they have no cart"""
+    now = timezone.now()
+    sql = _increment_sql()
+    if sql is None:
+        updated = CartItem.objects.filter(cart__user=user, product_id=product_id).update(
+            quantity=F('quantity') + quantity, updated_at=now
+        )
+        if updated:
+            return True
+        cart = Cart.objects.filter(user=user).first()
+        if cart is None:
+            return False
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+        except IntegrityError:
+            # Another request created the line first
+            CartItem.objects.filter(cart=cart, product_id=product_id).update(
+                quantity=F('quantity') + quantity, updated_at=now
+            )
+        return True
+    now = connection.ops.adapt_datetimefield_value(now)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [product_id, quantity, now, now, user.pk])
+        return cursor.rowcount > 0
+
+
+def add_item(request, product, quantity=1):
+    """Add ``quantity`` of ``product`` to the current cart
+
+    For signed-in users this is one ``INSERT ... ON CONFLICT DO UPDATE``
+    statement, so concurrent adds never lose an increment or trip the
+    ``(cart, product)`` unique constraint.
+    """
+    if not request.user.is_authenticated:
+        GuestCart(request.session).add(product.id, quantity)
+    elif not _increment(request.user, product.id, quantity):
+        Cart.objects.get_or_create(user=request.user)
+        _increment(request.user, product.id, quantity)
+    _cart_changed(request)
+
+
+async def aadd_item(request, product, quantity=1):
+    """Async ``add_item``
+
+    Adding to a line the user already has is a single ``aupdate()`` with
+    an F() increment on the event loop; first adds and guest carts fall
+    back to the sync path in a worker thread.
+    """
+    user = await request.auser()
+    if user.is_authenticated:
+        updated = await CartItem.objects.filter(cart__user=user, product=product).aupdate(
+            quantity=F('quantity') + quantity, updated_at=timezone.now()
+        )
+        if updated:
+            request._cart_summary = None
+            await cache.adelete(_cache_key(user.pk))
+            return
+    await sync_to_async(add_item)(request, product, quantity)
+
+
+def set_item_quantity(request, product, quantity):
+    """Set the quantity of ``product``, removing it when ``quantity`` is 0"""
+    if not request.user.is_authenticated:
+        GuestCart(request.session).set(product.id, quantity)
+    else:
+        items = CartItem.objects.filter(cart__user=request.user, product=product)
+        if quantity <= 0:
+            items.delete()
+        elif not items.update(quantity=quantity, updated_at=timezone.now()):
+            # An absolute quantity, so last write wins on a conflict
+            CartItem.objects.bulk_create(
+                [CartItem(cart=get_cart(request), product=product, quantity=quantity)],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity', 'updated_at'],
+            )
+    _cart_changed(request)
+
+
+def remove_item(request, product):
+    """Remove ``product`` from the current cart; returns False if it wasn't there"""
+    if not request.user.is_authenticated:
+        removed = GuestCart(request.session).remove(product.id)
+    else:
+        deleted, _ = CartItem.objects.filter(cart__user=request.user, product=product).delete()
+        removed = deleted > 0
+    _cart_changed(request)
+    return removed
+
+
+def set_quantities(request, quantities):
+    """Apply ``{product id: quantity}`` to the current cart in one transaction
+
+    Existing lines are changed with one ``bulk_update``, new lines added
+    with one upsert and zero quantities removed with one delete. Unknown
+    products are ignored. Returns the updated cart lines.
+    """
+    product_ids = set(
+        Product.objects.filter(id__in=list(quantities)).values_list('id', flat=True)
+    )
+    quantities = {
+        product_id: quantity for product_id, quantity in quantities.items()
+        if product_id in product_ids
+    }
+    if not request.user.is_authenticated:
+        cart = GuestCart(request.session)
+        for product_id, quantity in quantities.items():
+            cart.set(product_id, quantity)
+        _cart_changed(request)
+        return cart.get_items()
+
+    removed = [product_id for product_id, quantity in quantities.items() if quantity <= 0]
+    now = timezone.now()
+    with transaction.atomic():
+        cart = get_cart(request)
+        existing = {
+            item.product_id: item
+            for item in cart.items.filter(product_id__in=list(quantities))
+        }
+        changed, created = [], []
+        for product_id, quantity in quantities.items():
+            if quantity <= 0:
+                continue
+            item = existing.get(product_id)
+            if item is None:
+                created.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+            elif item.quantity != quantity:
+                item.quantity, item.updated_at = quantity, now
+                changed.append(item)
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+        if created:
+            CartItem.objects.bulk_create(
+                created,
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity', 'updated_at'],
+            )
+        if removed:
+            cart.items.filter(product_id__in=removed).delete()
+    # bulk_update() and bulk_create() send no signals
+    _cart_changed(request)
+    return get_cart_items(cart)
+
+
+def merge_guest_cart(request, user):
+    """Fold the session's guest cart into ``user``'s cart with one upsert"""
+    guest = GuestCart(request.session)
+    quantities = guest.quantities()
+    if not quantities:
+        return
+    cart, created = Cart.objects.get_or_create(user=user)
+    existing = {} if created else dict(
+        cart.items.filter(product_id__in=quantities).values_list('product_id', 'quantity')
+    )
+    # Products may have been deleted since they were added
+    product_ids = Product.objects.filter(id__in=quantities).values_list('id', flat=True)
+    CartItem.objects.bulk_create(
+        [
+            CartItem(cart=cart, product_id=product_id,
+                     quantity=existing.get(product_id, 0) + quantities[product_id])
+            for product_id in product_ids
+        ],
+        update_conflicts=True,
+        unique_fields=['cart', 'product'],
+        update_fields=['quantity', 'updated_at'],
+    )
+    guest.clear()
+    # bulk_create() sends no post_save signals
+    invalidate_cart_summary(user.pk)
+
+
+def _cache_key(user_id):
+    return f'store:cart_summary:{user_id}'
+
+
+def get_user_cart_summary(user_id):
+    """Summary of ``user_id``'s cart from the shared cache, or the database"""
+    version = get_catalog_version()
+    cached = cache.get(_cache_key(user_id))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    summary = summarize_cart_items(CartItem.objects.filter(cart__user_id=user_id))
+    timeout = getattr(settings, 'STORE_CART_SUMMARY_TIMEOUT', DEFAULT_TIMEOUT)
+    cache.set(_cache_key(user_id), (version, summary), timeout)
+    return summary
+
+
+def get_cart_summary(request):
+    """Summary of the current cart, computed at most once per request"""
+    summary = getattr(request, '_cart_summary', None)
+    if summary is None:
+        if request.user.is_authenticated:
+            summary = get_user_cart_summary(request.user.pk)
+        else:
+            summary = GuestCart(request.session).get_summary()
+        request._cart_summary = summary
+    return summary
+
+
+async def aget_cart_summary(request):
+    return await sync_to_async(get_cart_summary)(request)
+
+
+def invalidate_cart_summary(user_id):
+    cache.delete(_cache_key(user_id))
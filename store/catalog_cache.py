@@ -0,0 +1,178 @@
+"""
+Two-tier, versioned catalog cache.
+
+Lookups go to a bounded per-process LRU first, then to Django's shared
+cache, and only then to the database. Every key is namespaced with a
+catalog version number kept in the shared cache; saving or deleting a
+``Product`` or ``Category`` bumps the version (see ``store.signals``),
+so every worker stops using its old entries at once without any
+broadcast. Sales change stock without bumping it unless a product sells
+out or drops into the featured set's low-stock range; pages read live
+stock themselves. Cached objects are shared between requests and must be
+treated as read-only.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Category, Product
+
+CATALOG_VERSION_KEY = 'store:catalog_version'
+
+STOCK_VERSION_KEY = 'store:stock_version'
+
+DEFAULT_LRU_SIZE = 1024
+DEFAULT_TIMEOUT = 60 * 60
+DEFAULT_VERSION_TTL = 1.0
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used key"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class CatalogCache:
+    def __init__(self, max_size=None, timeout=None, version_ttl=None):
+        self.local = LRUCache(max_size or getattr(settings, 'STORE_CATALOG_LRU_SIZE', DEFAULT_LRU_SIZE))
+        self.timeout = timeout or getattr(settings, 'STORE_CATALOG_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+        if version_ttl is None:
+            version_ttl = getattr(settings, 'STORE_CATALOG_VERSION_TTL', DEFAULT_VERSION_TTL)
+        # How long a worker may reuse the version number before re-reading it
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_checked = 0.0
+        self.stats_lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= self.version_ttl:
+            version = cache.get(CATALOG_VERSION_KEY)
+            if version is None:
+                cache.add(CATALOG_VERSION_KEY, time.time_ns(), None)
+                version = cache.get(CATALOG_VERSION_KEY)
+            self._version, self._version_checked = version, now
+        return self._version
+
+    def bump(self):
+        """Start a new catalog version, invalidating every cached entry"""
+        version = time.time_ns()
+        cache.set(CATALOG_VERSION_KEY, version, None)
+        self._version, self._version_checked = version, time.monotonic()
+        self.local.clear()
+
+    def _count(self, counter):
+        with self.stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_or_set(self, key, loader):
+        """Return the cached value for ``key``, calling ``loader()`` on a miss"""
+        versioned_key = f'catalog:{self.version}:{key}'
+        value = self.local.get(versioned_key, _MISSING)
+        if value is not _MISSING:
+            self._count('local_hits')
+            return value
+        value = cache.get(versioned_key, _MISSING)
+        if value is not _MISSING:
+            self._count('shared_hits')
+        else:
+            self._count('misses')
+            value = loader()
+            cache.set(versioned_key, value, self.timeout)
+        self.local.set(versioned_key, value)
+        return value
+
+    def stats(self):
+        with self.stats_lock:
+            hits = self.local_hits + self.shared_hits
+            total = hits + self.misses
+            return {
+                'version': self._version,
+                'local_entries': len(self.local),
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / total, 4) if total else None,
+            }
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.local_hits = self.shared_hits = self.misses = 0
+
+
+catalog_cache = CatalogCache()
+
+
+def get_catalog_version():
+    return catalog_cache.version
+
+
+def bump_catalog_version():
+    catalog_cache.bump()
+
+
+def get_stock_version():
+    """Changes whenever stock levels do; part of page validators, never of cache keys"""
+    return cache.get(STOCK_VERSION_KEY, 0)
+
+
+def bump_stock_version():
+    cache.set(STOCK_VERSION_KEY, time.time_ns(), None)
+
+
+def get_categories():
+    """All categories, in ``Meta.ordering`` order"""
+    return catalog_cache.get_or_set('categories', lambda: list(Category.objects.all()))
+
+
+def get_category(slug):
+    """Category with ``slug`` from the cached list, or None"""
+    for category in get_categories():
+        if category.slug == slug:
+            return category
+    return None
+
+
+def get_product(slug):
+    """Available product with ``slug`` (category and recommendations joined), or None"""
+    def load():
+        return (
+            Product.objects.select_related('category', 'recommendation')
+            .filter(slug=slug, available=True)
+            .first()
+        )
+    return catalog_cache.get_or_set(f'product:{slug}', load)
@@ -0,0 +1,65 @@
+"""
+Conditional GET for catalog pages.
+
+The ETag combines the catalog version from ``store.catalog_cache``
+(bumped on every product or category write, including deletes), the
+stock version (bumped on every sale and stock reservation change), the
+request path and query string, and the state of the visitor's cart: the
+cached summary from ``store.cart`` for signed-in users, the guest
+cart held in the session otherwise. No Last-Modified is sent: a date
+cannot capture stock moves, cart changes or who is signed in, so
+``If-Modified-Since`` alone could confirm a stale page. When the
+client's ETag still matches, Django's ``condition`` decorator answers
+``304 Not Modified`` without running the view; anonymous revalidations
+cost no queries at all.
+"""
+import hashlib
+
+from django.contrib import messages
+from django.views.decorators.http import condition
+
+from .cart import SESSION_KEY, get_cart_summary
+from .catalog_cache import get_catalog_version, get_product, get_stock_version
+from .recommendations import get_cached_related_products
+
+
+def home_scope(request):
+    return []
+
+
+def product_list_scope(request, category_slug=None):
+    return []
+
+
+def product_detail_scope(request, slug):
+    product = get_product(slug)
+    if product is None:
+        return None
+    return [product, product.category] + list(get_cached_related_products(product))
+
+
+def _etag(request, scope, args, kwargs):
+    shown = scope(request, *args, **kwargs)
+    # Pending flash messages are rendered once, so never answer 304 over them
+    if shown is None or len(messages.get_messages(request)):
+        return None
+
+    parts = [get_catalog_version(), get_stock_version(), request.get_full_path()]
+    if request.user.is_authenticated:
+        cart = get_cart_summary(request)
+        parts.extend([request.user.pk, cart['lines'], cart['total_items'], cart['last_modified']])
+    elif SESSION_KEY in request.session:
+        parts.append(sorted(request.session[SESSION_KEY].items()))
+    return hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def catalog_condition(scope):
+    """Decorate a catalog view with an ETag validator
+
+    ``scope`` receives the view's arguments and returns the cached objects
+    the page shows, or None to skip conditional handling.
+    """
+    def etag_func(request, *args, **kwargs):
+        return _etag(request, scope, args, kwargs)
+
+    return condition(etag_func=etag_func)
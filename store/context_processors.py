@@ -0,0 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_cart_summary
+
+
+def cart(request):
+    """Expose ``cart_summary`` to templates, loaded only when used"""
+    return {'cart_summary': SimpleLazyObject(lambda: get_cart_summary(request))}
@@ -0,0 +1,241 @@
+"""
+Streaming bulk export of catalog and order tables.
+
+Rows are read with ``QuerySet.iterator()`` (a server-side cursor on
+PostgreSQL) and written straight to CSV or NDJSON, optionally gzip
+compressed, so memory stays bounded however large the table is.
+Incremental runs export only rows past the watermark saved by the
+previous run, and large tables can be split into primary key ranges
+exported by a pool of worker processes.
+"""
+import csv
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import Category, Order, OrderItem, Product, Watermark
+
+# Dataset name -> (model, watermark field)
+DATASETS = {
+    'categories': (Category, 'updated_at'),
+    'products': (Product, 'updated_at'),
+    'orders': (Order, 'updated_at'),
+    'order_items': (OrderItem, 'updated_at'),
+}
+
+FORMATS = ('csv', 'ndjson')
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def _field_names(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _parse_watermark(value):
+    if value in (None, ''):
+        return None
+    since = datetime.fromisoformat(value)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def _filtered(dataset, since, until):
+    model, field = DATASETS[dataset]
+    queryset = model._default_manager.all()
+    if since is not None:
+        queryset = queryset.filter(**{f'{field}__gt': since})
+    return queryset.filter(**{f'{field}__lte': until})
+
+
+def split_ranges(low, high, parts):
+    """Split the inclusive pk range ``[low, high]`` into half-open ranges"""
+    if low is None:
+        return []
+    parts = max(1, min(parts, high - low + 1))
+    step = -(-(high - low + 1) // parts)
+    return [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+
+
+def _open(path, compress):
+    if compress:
+        return gzip.open(path, 'wt', newline='', encoding='utf-8')
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+def export_range(dataset, path, fmt, compress, since, until, pk_range=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write one slice of ``dataset`` to ``path``; returns the row count"""
+    model, field = DATASETS[dataset]
+    fields = _field_names(model)
+    queryset = _filtered(dataset, since, until)
+    if pk_range is not None:
+        queryset = queryset.filter(pk__gte=pk_range[0], pk__lt=pk_range[1])
+    rows = queryset.order_by('pk').values_list(*fields).iterator(chunk_size=chunk_size)
+
+    tmp_path = path + '.tmp'
+    count = 0
+    try:
+        with _open(tmp_path, compress) as fh:
+            if fmt == 'csv':
+                writer = csv.writer(fh)
+                writer.writerow(fields)
+                for row in rows:
+                    writer.writerow([_encode(value) for value in row])
+                    count += 1
+            else:
+                encoder = json.JSONEncoder(separators=(',', ':'))
+                for row in rows:
+                    fh.write(encoder.encode(dict(zip(fields, map(_encode, row)))))
+                    fh.write('\n')
+                    count += 1
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return count
+
+
+def _worker_init():
+    django.setup()
+
+
+def _export_part(args):
+    try:
+        return export_range(*args)
+    finally:
+        connections.close_all()
+
+
+def run_export(dataset, output_dir, fmt='csv', compress=False, incremental=False,
+               since=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Export ``dataset`` and return ``(rows, files, new watermark)``
+
+    With ``incremental`` the export starts after the stored watermark (or
+    ``since`` when given) and the watermark is advanced once every part
+    has been written.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f'Unknown dataset: {dataset}')
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format: {fmt}')
+    watermark_name = f'export:{dataset}'
+
+    if since is None and incremental:
+        stored = Watermark.objects.filter(name=watermark_name).values_list('value', flat=True).first()
+        try:
+            since = _parse_watermark(stored)
+        except ValueError:
+            # An id watermark from before order items had updated_at:
+            # export the dataset in full once
+            since = None
+    elif isinstance(since, str):
+        since = _parse_watermark(since)
+
+    # Fix the upper bound up front so rows written during the export are
+    # left for the next run instead of being half-exported.
+    until = stamp = timezone.now()
+
+    os.makedirs(output_dir, exist_ok=True)
+    extension = fmt + ('.gz' if compress else '')
+    basename = f"{dataset}-{stamp.strftime('%Y%m%dT%H%M%S')}"
+
+    if workers > 1:
+        bounds = _filtered(dataset, since, until).aggregate(low=Min('pk'), high=Max('pk'))
+        ranges = split_ranges(bounds['low'], bounds['high'], workers)
+    else:
+        ranges = []
+
+    if len(ranges) > 1:
+        jobs = [
+            (dataset, os.path.join(output_dir, f'{basename}.part{i:03d}.{extension}'),
+             fmt, compress, since, until, pk_range, chunk_size)
+            for i, pk_range in enumerate(ranges)
+        ]
+        # Children must not share the parent's database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=len(jobs), initializer=_worker_init) as pool:
+            rows = sum(pool.map(_export_part, jobs))
+        files = [job[1] for job in jobs]
+    else:
+        path = os.path.join(output_dir, f'{basename}.{extension}')
+        rows = export_range(dataset, path, fmt, compress, since, until, chunk_size=chunk_size)
+        files = [path]
+
+    if incremental:
+        Watermark.objects.update_or_create(name=watermark_name, defaults={'value': until.isoformat()})
+    return rows, files, until
+
+
+class ExportCommand(BaseCommand):
+    """Shared options for the ``export_*`` management commands"""
+    datasets = ()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default='exports', help='Directory to write files to')
+        parser.add_argument('--format', choices=FORMATS, default='csv', help='Output format')
+        parser.add_argument('--gzip', action='store_true', help='Compress output with gzip')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Only export rows changed since the last incremental run',
+        )
+        parser.add_argument(
+            '--since',
+            help='Export rows changed after this ISO datetime instead of the stored watermark',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Worker processes; each exports one primary key range to its own file',
+        )
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows per fetch')
+        parser.add_argument(
+            '--only', action='append', choices=self.datasets,
+            help='Export only this dataset (repeatable)',
+        )
+
+    def handle(self, *args, **options):
+        # Checked before anything is written
+        try:
+            since = _parse_watermark(options['since'])
+        except ValueError:
+            raise CommandError(f"--since {options['since']!r} is not an ISO datetime")
+
+        for dataset in options['only'] or self.datasets:
+            try:
+                rows, files, until = run_export(
+                    dataset,
+                    options['output_dir'],
+                    fmt=options['format'],
+                    compress=options['gzip'],
+                    incremental=options['incremental'],
+                    since=since,
+                    workers=options['workers'],
+                    chunk_size=options['chunk_size'],
+                )
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(
+                f'Exported {rows} {dataset} rows to {len(files)} file(s) (up to {until})'
+            ))
+            for path in files:
+                self.stdout.write(f'  {path}')
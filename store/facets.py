@@ -0,0 +1,230 @@
+"""
+Faceted catalog filtering.
+
+Every available product gets a bit position in catalog order
+``(-created_at, id)``, and each facet value (category, price band,
+in-stock) keeps a bitmap of the products that have it. Any filter
+combination is then a handful of integer ANDs, facet counts are
+popcounts, and only the final page of products is fetched from the
+database.
+
+The bitmaps are rebuilt lazily whenever the catalog version in
+``store.catalog_cache`` moves on, so every worker notices a ``Product``
+or ``Category`` change without a broadcast.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from django.conf import settings
+
+from .catalog_cache import get_catalog_version
+from .inventory import with_available
+from .models import Product
+from .pagination import KeysetPage, decode_cursor
+
+# (lower bound, upper bound) in the store currency; None means unbounded
+DEFAULT_PRICE_BANDS = [
+    (0, 25),
+    (25, 50),
+    (50, 100),
+    (100, 250),
+    (250, None),
+]
+
+FACETS = ('category', 'price', 'stock')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def sort_key(created_at, pk):
+    """Key that sorts like ORDER BY created_at DESC, id ASC"""
+    return (-((created_at - EPOCH) // timedelta(microseconds=1)), pk)
+
+
+def get_price_bands():
+    bands = []
+    for low, high in getattr(settings, 'STORE_PRICE_BANDS', DEFAULT_PRICE_BANDS):
+        key = f'{low}-{high}' if high is not None else f'{low}+'
+        label = f'${low} - ${high}' if high is not None else f'${low}+'
+        bands.append((key, label, Decimal(low), Decimal(high) if high is not None else None))
+    return bands
+
+
+def bitmap_from_positions(positions, size):
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_bits(mask):
+    """Yield set bit positions of ``mask`` from lowest to highest"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def iter_bits_reversed(mask):
+    while mask:
+        position = mask.bit_length() - 1
+        yield position
+        mask ^= 1 << position
+
+
+class FacetIndex:
+    def __init__(self, rows, price_bands):
+        """``rows`` are (id, created_at, price, stock, category slug, category name)"""
+        self.ids = []
+        self.keys = []
+        self.bitmaps = {facet: {} for facet in FACETS}
+        self.labels = {
+            'category': {},
+            'price': {key: label for key, label, low, high in price_bands},
+            'stock': {'in': 'In stock'},
+        }
+        positions = {facet: {} for facet in FACETS}
+        for key, label, low, high in price_bands:
+            positions['price'][key] = []
+        positions['stock']['in'] = []
+
+        rows = sorted(rows, key=lambda row: sort_key(row[1], row[0]))
+        for position, (pk, created_at, price, stock, slug, name) in enumerate(rows):
+            self.ids.append(pk)
+            self.keys.append(sort_key(created_at, pk))
+            positions['category'].setdefault(slug, []).append(position)
+            self.labels['category'][slug] = name
+            for key, label, low, high in price_bands:
+                if price >= low and (high is None or price < high):
+                    positions['price'][key].append(position)
+                    break
+            if stock > 0:
+                positions['stock']['in'].append(position)
+
+        size = len(self.ids)
+        for facet, values in positions.items():
+            for value, value_positions in values.items():
+                self.bitmaps[facet][value] = bitmap_from_positions(value_positions, size)
+        self.all = (1 << size) - 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clean(self, selected):
+        """Drop empty facets and unknown price/stock values from a selection
+
+        Unknown categories are kept so that filtering on a category with no
+        available products matches nothing rather than everything.
+        """
+        cleaned = {}
+        for facet, values in selected.items():
+            if facet not in self.bitmaps or not values:
+                continue
+            if facet != 'category':
+                values = {value for value in values if value in self.bitmaps[facet]}
+            if values:
+                cleaned[facet] = set(values)
+        return cleaned
+
+    def _facet_mask(self, facet, values):
+        mask = 0
+        for value in values:
+            mask |= self.bitmaps[facet].get(value, 0)
+        return mask
+
+    def match(self, selected):
+        """Bitmap of products matching every selected facet (values are ORed)"""
+        mask = self.all
+        for facet, values in selected.items():
+            if values:
+                mask &= self._facet_mask(facet, values)
+        return mask
+
+    def counts(self, selected):
+        """Per-value counts, each computed against the other facets' filters"""
+        masks = {facet: self._facet_mask(facet, values) for facet, values in selected.items() if values}
+        counts = {}
+        for facet in FACETS:
+            mask = self.all
+            for other, other_mask in masks.items():
+                if other != facet:
+                    mask &= other_mask
+            counts[facet] = {
+                value: (bitmap & mask).bit_count()
+                for value, bitmap in self.bitmaps[facet].items()
+            }
+        return counts
+
+    def page_ids(self, mask, cursor=None, page_size=24):
+        """Return (ids, has_next, has_previous) for one keyset page of ``mask``"""
+        if not cursor:
+            positions = []
+            for position in iter_bits(mask):
+                positions.append(position)
+                if len(positions) > page_size:
+                    break
+            return [self.ids[p] for p in positions[:page_size]], len(positions) > page_size, False
+
+        created_at, pk, direction = decode_cursor(cursor)
+        key = sort_key(created_at, pk)
+        if direction == 'next':
+            start = bisect_right(self.keys, key)
+            positions = []
+            for position in iter_bits(mask >> start):
+                positions.append(start + position)
+                if len(positions) > page_size:
+                    break
+            return [self.ids[p] for p in positions[:page_size]], len(positions) > page_size, True
+
+        end = bisect_left(self.keys, key)
+        positions = []
+        for position in iter_bits_reversed(mask & ((1 << end) - 1)):
+            positions.append(position)
+            if len(positions) > page_size:
+                break
+        has_previous = len(positions) > page_size
+        return [self.ids[p] for p in reversed(positions[:page_size])], True, has_previous
+
+    def page(self, selected, cursor=None, page_size=24):
+        """Fetch one page of matching products with a single query"""
+        ids, has_next, has_previous = self.page_ids(self.match(selected), cursor, page_size)
+        products = with_available(Product.objects.filter(id__in=ids)).in_bulk() if ids else {}
+        return KeysetPage([products[pk] for pk in ids if pk in products], has_next, has_previous)
+
+
+def build_facet_index():
+    rows = Product.objects.filter(available=True).values_list(
+        'id', 'created_at', 'price', 'stock', 'category__slug', 'category__name'
+    )
+    return FacetIndex(list(rows.iterator(chunk_size=2000)), get_price_bands())
+
+
+_facets = None
+_facets_version = None
+_facets_lock = threading.Lock()
+
+
+def get_facet_index():
+    """Return this process's facet index, rebuilding it when the catalog changed"""
+    global _facets, _facets_version
+    version = get_catalog_version()
+    if _facets is not None and version == _facets_version:
+        return _facets
+    with _facets_lock:
+        if _facets is None or version != _facets_version:
+            _facets, _facets_version = build_facet_index(), version
+        return _facets
+
+
+def parse_selection(params, category_slug=None):
+    """Read ``?category=&price=&in_stock=`` into a ``{facet: values}`` selection"""
+    selected = {
+        'category': set(params.getlist('category')),
+        'price': set(params.getlist('price')),
+        'stock': {'in'} if params.get('in_stock') else set(),
+    }
+    if category_slug:
+        selected['category'] = {category_slug}
+    return selected
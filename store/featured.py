@@ -0,0 +1,88 @@
+"""
+Featured product set for the home page.
+
+The ordered list of featured product IDs is computed once, kept in the
+versioned catalog cache and rebuilt only after the catalog changes (see
+``store.signals``). The home page then loads the whole set with a
+single query.
+"""
+from django.conf import settings
+
+from .catalog_cache import catalog_cache
+from .inventory import with_available
+from .models import Product
+
+FEATURED_CACHE_KEY = 'featured_product_ids'
+
+# Daily essentials and high-demand items, by slug. Override with
+# ``STORE_FEATURED_PRODUCTS`` in settings.
+DEFAULT_FEATURED_PRODUCTS = [
+    'premium-coffee-beans',
+    'greek-yogurt',
+    'wireless-headphones',
+    'organic-apples',
+    'fitness-tracker',
+    'whole-grain-bread',
+    'smartphone-pro',
+    'bluetooth-speaker',
+]
+
+DEFAULT_FEATURED_LIMIT = 8
+
+# Products at or below this stock top up the featured set
+LOW_STOCK_THRESHOLD = 20
+
+
+def get_featured_slugs():
+    """Return the configured featured product slugs in display order"""
+    return list(getattr(settings, 'STORE_FEATURED_PRODUCTS', DEFAULT_FEATURED_PRODUCTS))
+
+
+def get_featured_limit():
+    return getattr(settings, 'STORE_FEATURED_LIMIT', DEFAULT_FEATURED_LIMIT)
+
+
+def compute_featured_product_ids():
+    """Build the ordered list of featured product IDs from the database"""
+    limit = get_featured_limit()
+    slugs = get_featured_slugs()
+
+    # Configured products first, in the configured order
+    ids_by_slug = dict(
+        Product.objects.filter(slug__in=slugs, available=True).values_list('slug', 'id')
+    )
+    featured_ids = [ids_by_slug[slug] for slug in slugs if slug in ids_by_slug][:limit]
+
+    # Top up with high-demand items (low stock indicates popularity)
+    if len(featured_ids) < limit:
+        featured_ids.extend(
+            Product.objects.filter(available=True, stock__lte=LOW_STOCK_THRESHOLD)
+            .exclude(id__in=featured_ids)
+            .order_by('stock', 'price')
+            .values_list('id', flat=True)[:limit - len(featured_ids)]
+        )
+
+    # Final fallback: affordable items
+    if len(featured_ids) < limit:
+        featured_ids.extend(
+            Product.objects.filter(available=True, price__lte=30)
+            .exclude(id__in=featured_ids)
+            .order_by('price')
+            .values_list('id', flat=True)[:limit - len(featured_ids)]
+        )
+
+    return featured_ids
+
+
+def get_featured_product_ids():
+    """Return the cached featured IDs, rebuilding them on a cache miss"""
+    return catalog_cache.get_or_set(FEATURED_CACHE_KEY, compute_featured_product_ids)
+
+
+def get_featured_products():
+    """Return the featured products, in order, loaded with one query"""
+    featured_ids = get_featured_product_ids()
+    if not featured_ids:
+        return []
+    products = with_available(Product.objects.filter(id__in=featured_ids, available=True)).in_bulk()
+    return [products[pk] for pk in featured_ids if pk in products]
@@ -1,6 +1,8 @@
+from datetime import datetime, time, timedelta
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from django.utils import timezone
 from .models import Order
 
 
@@ -35,3 +37,36 @@ class OrderForm(forms.ModelForm):
             'postal_code': forms.TextInput(attrs={'class': 'form-control'}),
             'city': forms.TextInput(attrs={'class': 'form-control'}),
         }
+
+
+class OrderHistoryFilterForm(forms.Form):
+    """Status and date-range filters for order history, bound to ``request.GET``"""
+    status = forms.ChoiceField(
+        choices=[('', 'Any status')] + Order.STATUS_CHOICES, required=False,
+        widget=forms.Select(attrs={'class': 'form-select'}),
+    )
+    date_from = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+    date_to = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+
+    def filter(self, orders):
+        """Narrow ``orders``; call only once the form is valid
+
+        Dates become a half-open ``created_at`` range rather than a
+        ``__date`` lookup, so the ``(user, created_at)`` index still applies.
+        """
+        data = self.cleaned_data
+        if data['status']:
+            orders = orders.filter(status=data['status'])
+        if data['date_from']:
+            orders = orders.filter(created_at__gte=self._start_of(data['date_from']))
+        if data['date_to']:
+            orders = orders.filter(created_at__lt=self._start_of(data['date_to'] + timedelta(days=1)))
+        return orders
+
+    @staticmethod
+    def _start_of(day):
+        return timezone.make_aware(datetime.combine(day, time.min))
@@ -0,0 +1,242 @@
+"""
+Idempotency keys for POST views.
+
+A client that may retry a POST sends a unique key with it, either in an
+``Idempotency-Key`` header or an ``idempotency_key`` form field. The
+first request with a key claims an ``IdempotencyKey`` row before the
+view runs and stores the response once it returns; a retry carrying the
+same key gets that stored response back, marked ``Idempotent-Replayed``,
+and the view does not run again. So a retried checkout cannot place a
+second order and a retried cart POST cannot add the item twice.
+
+Keys are scoped to the signed-in user, or to the session for guests, and
+kept for ``STORE_IDEMPOTENCY_TTL`` seconds (24 hours by default). A retry
+that arrives while the first request is still running gets ``409`` with
+``Retry-After``; one that reuses a key for a different request gets
+``422``. Server errors and exceptions release the key so the request can
+be tried again. A claim left behind by a crashed worker is taken over
+after ``STORE_IDEMPOTENCY_LOCK_TIMEOUT`` seconds, so a view whose effects
+must never repeat calls ``remember`` with its response inside the
+transaction that makes them: once that commits, retries replay. ``reap_idempotency_keys``
+deletes expired rows.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.http.request import RawPostDataException
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+FORM_FIELD = 'idempotency_key'
+
+MAX_KEY_LENGTH = 255
+
+DEFAULT_TTL = 24 * 60 * 60
+
+DEFAULT_LOCK_TIMEOUT = 60
+
+DEFAULT_REAP_BATCH_SIZE = 1000
+
+# Form fields that differ between honest retries of the same submission
+_UNSIGNED_FIELDS = {'csrfmiddlewaretoken', FORM_FIELD}
+
+
+def get_ttl():
+    return timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_TTL', DEFAULT_TTL))
+
+
+def get_lock_timeout():
+    return timedelta(seconds=getattr(settings, 'STORE_IDEMPOTENCY_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT))
+
+
+def get_key(request):
+    return (request.headers.get(HEADER) or request.POST.get(FORM_FIELD) or '').strip()
+
+
+def fingerprint(request):
+    """Hash of what the request asks for, to catch a key reused for another request"""
+    digest = hashlib.sha256(f'{request.method} {request.path}'.encode())
+    if request.content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+        fields = sorted(
+            (name, request.POST.getlist(name)) for name in request.POST if name not in _UNSIGNED_FIELDS
+        )
+        digest.update(json.dumps(fields).encode())
+    else:
+        try:
+            digest.update(request.body)
+        except RawPostDataException:
+            pass
+    return digest.hexdigest()
+
+
+def _owner(user, session):
+    if user.is_authenticated:
+        return f'user:{user.pk}'
+    # A guest without a session has nothing an earlier request could have changed
+    if session.session_key:
+        return f'session:{session.session_key}'
+    return None
+
+
+def _error(message, status):
+    return JsonResponse({'success': False, 'error': message}, status=status)
+
+
+def _busy():
+    response = _error('A request with this idempotency key is in progress', 409)
+    response['Retry-After'] = '1'
+    return response
+
+
+def replay(record):
+    response = HttpResponse(bytes(record.content), status=record.status_code)
+    for name, value in record.headers.items():
+        response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def claim(owner, key, request_fingerprint):
+    """Claim ``key`` for a new request; returns ``(record, None)`` or ``(None, response)``
+
+    The response is the stored one to replay, or an error if the key is
+    busy or was used for a different request.
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                owner=owner, key=key, fingerprint=request_fingerprint, expires_at=now + get_ttl()
+            ), None
+    except IntegrityError:
+        pass
+
+    record = IdempotencyKey.objects.filter(owner=owner, key=key).first()
+    abandoned = record is not None and record.status_code is None and record.created_at <= now - get_lock_timeout()
+    if record is None or record.expires_at <= now or abandoned:
+        # Gone, expired or left behind by a crashed request: start afresh,
+        # unless another retry beats us to it
+        IdempotencyKey.objects.filter(owner=owner, key=key, created_at__lte=now).delete()
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    owner=owner, key=key, fingerprint=request_fingerprint, expires_at=now + get_ttl()
+                ), None
+        except IntegrityError:
+            return None, _busy()
+
+    if record.fingerprint != request_fingerprint:
+        return None, _error('This idempotency key was used for a different request', 422)
+    if record.status_code is None:
+        return None, _busy()
+    return None, replay(record)
+
+
+def _store(record, response):
+    record.status_code = response.status_code
+    # Cookies are not replayed: they belong to the original client session
+    record.headers = dict(response.items())
+    record.content = response.content
+    record.save(update_fields=['status_code', 'headers', 'content'])
+
+
+def complete(record, response):
+    """Store ``response`` for replay, or release the key if it should not be replayed"""
+    if response.streaming or response.status_code >= 500:
+        record.delete()
+        return
+    _store(record, response)
+
+
+def remember(request, response):
+    """Store ``response`` for replay of ``request``'s key ahead of the view returning
+
+    Call it inside the transaction that makes the request's effects, so
+    they and the stored response commit together. No-op without a key.
+    """
+    record = getattr(request, '_idempotency_record', None)
+    if record is not None:
+        _store(record, response)
+
+
+def release(record):
+    record.delete()
+
+
+def idempotent(view):
+    """Make a POST view replay its first response for a repeated idempotency key
+
+    Requests without a key, and non-POST requests, pass straight through.
+    Works on sync and async views.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            key = get_key(request) if request.method == 'POST' else ''
+            if not key:
+                return await view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error('Idempotency key is too long', 400)
+            owner = _owner(await request.auser(), request.session)
+            if owner is None:
+                return await view(request, *args, **kwargs)
+            record, response = await sync_to_async(claim)(owner, key, fingerprint(request))
+            if response is not None:
+                return response
+            request._idempotency_record = record
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                await sync_to_async(release)(record)
+                raise
+            await sync_to_async(complete)(record, response)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = get_key(request) if request.method == 'POST' else ''
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error('Idempotency key is too long', 400)
+        owner = _owner(request.user, request.session)
+        if owner is None:
+            return view(request, *args, **kwargs)
+        record, response = claim(owner, key, fingerprint(request))
+        if response is not None:
+            return response
+        request._idempotency_record = record
+        try:
+            response = view(request, *args, **kwargs)
+        except BaseException:
+            release(record)
+            raise
+        complete(record, response)
+        return response
+
+    return wrapper
+
+
+def reap_expired(batch_size=DEFAULT_REAP_BATCH_SIZE, now=None):
+    """Delete expired keys ``batch_size`` rows at a time; returns the count"""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return total
+        deleted, _ = IdempotencyKey.objects.filter(id__in=ids).delete()
+        total += deleted
@@ -0,0 +1,170 @@
+"""
+Inventory reservations.
+
+Proceeding to checkout (a POST) holds the cart's quantities in
+``StockReservation`` for ``STORE_RESERVATION_TTL`` seconds (15 minutes by
+default), so stock a shopper is paying for cannot sell out from under
+them. Proceeding again keeps an unexpired hold as it is: lines the
+shopper changed are held until the same expiry, so a cart cannot keep
+its stock by renewing the hold. Available-to-sell
+is ``stock`` minus the active holds of other carts, summed over the
+``(product, expires_at)`` index; catalog pages show it as ``sellable``
+(see ``with_available``) and add-to-cart refuses products with none left.
+Expiry is lazy: expired holds are simply ignored on read, and
+``reap_reservations`` deletes them in batches. Placing, releasing and
+reaping holds bump the stock version when held quantities change, so conditional GETs of catalog
+pages revalidate; a hold that lapses between reaps may linger in a
+revalidated page until the next run.
+
+Reserving and checking out lock only the product rows involved, in id
+order so two carts cannot deadlock; carts holding different products
+never wait on each other. SQLite ignores row locks but serializes writers
+anyway.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, StockReservation
+
+DEFAULT_TTL = 15 * 60
+
+DEFAULT_REAP_BATCH_SIZE = 1000
+
+
+class OutOfStock(Exception):
+    """Some lines ask for more than is available; ``products`` lists them"""
+
+    def __init__(self, products):
+        self.products = products
+        super().__init__(', '.join(product.name for product in products))
+
+
+def _stock_changed():
+    # Imported here: store.signals imports store.search, which imports this module
+    from .signals import stock_changed
+
+    stock_changed()
+
+
+def get_reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STORE_RESERVATION_TTL', DEFAULT_TTL))
+
+
+def reserved_elsewhere(cart_id=None, now=None):
+    """Quantity of the outer product held by active reservations of other carts"""
+    held = StockReservation.objects.filter(product=OuterRef('pk'), expires_at__gt=now or timezone.now())
+    if cart_id is not None:
+        held = held.exclude(cart_id=cart_id)
+    held = held.values('product').annotate(total=Sum('quantity')).values('total')
+    return Coalesce(Subquery(held, output_field=IntegerField()), 0)
+
+
+def with_available(queryset, cart_id=None, now=None):
+    """Annotate products with ``sellable``: stock less other carts' active holds"""
+    return queryset.annotate(sellable=F('stock') - reserved_elsewhere(cart_id, now))
+
+
+def available_to_sell(product_ids, cart_id=None):
+    """``{product id: available}`` for ``product_ids``, from one query"""
+    return dict(
+        with_available(Product.objects.filter(id__in=list(product_ids)), cart_id)
+        .values_list('id', 'sellable')
+    )
+
+
+def lock_products(product_ids):
+    """Row-lock ``product_ids`` until the end of the transaction; returns ``{id: stock}``"""
+    return dict(
+        Product.objects.select_for_update().filter(id__in=list(product_ids))
+        .order_by('id').values_list('id', 'stock')
+    )
+
+
+def _active_holds(cart, now):
+    """``{product id: (quantity, expires_at)}`` of the unexpired holds of ``cart``"""
+    return {
+        product_id: (quantity, expires_at)
+        for product_id, quantity, expires_at in cart.reservations.filter(expires_at__gt=now)
+        .values_list('product_id', 'quantity', 'expires_at')
+    }
+
+
+def get_hold_expiry(cart):
+    """When the unexpired holds of ``cart`` lapse, or None; never writes"""
+    holds = _active_holds(cart, timezone.now())
+    return min(expires_at for quantity, expires_at in holds.values()) if holds else None
+
+
+def reserve_cart(cart):
+    """Hold every line of ``cart``; returns the expiry
+
+    A cart without unexpired holds is held for the reservation TTL. One
+    that already has them keeps their expiry: unchanged lines are left
+    alone and changed ones are held until the same time. Raises
+    ``OutOfStock`` without changing any hold if a line asks for more than
+    is available to this cart.
+    """
+    now = timezone.now()
+    quantities = dict(cart.items.values_list('product_id', 'quantity'))
+    holds = _active_holds(cart, now)
+    if holds and {product_id: hold[0] for product_id, hold in holds.items()} == quantities:
+        # Already held as it stands: nothing to write
+        return min(expires_at for quantity, expires_at in holds.values())
+
+    with transaction.atomic():
+        lock_products(quantities)
+        holds = _active_holds(cart, now)
+        if holds:
+            expires_at = min(expires_at for quantity, expires_at in holds.values())
+        else:
+            expires_at = now + get_reservation_ttl()
+        products = with_available(Product.objects.filter(id__in=list(quantities)), cart.pk, now)
+        short = [product for product in products if product.sellable < quantities[product.id]]
+        if short:
+            raise OutOfStock(short)
+        changed = {
+            product_id: quantity for product_id, quantity in quantities.items()
+            if holds.get(product_id, (None,))[0] != quantity
+        }
+        StockReservation.objects.bulk_create(
+            [
+                StockReservation(cart=cart, product_id=product_id, quantity=quantity, expires_at=expires_at)
+                for product_id, quantity in changed.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['cart', 'product'],
+            update_fields=['quantity', 'expires_at'],
+        )
+        removed, _ = cart.reservations.exclude(product_id__in=list(quantities)).delete()
+        if changed or removed:
+            _stock_changed()
+    return expires_at
+
+
+def release_cart(cart):
+    """Drop every hold of ``cart``"""
+    deleted, _ = StockReservation.objects.filter(cart=cart).delete()
+    if deleted:
+        _stock_changed()
+
+
+def reap_expired(batch_size=DEFAULT_REAP_BATCH_SIZE, now=None):
+    """Delete expired holds ``batch_size`` rows at a time; returns the count"""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            StockReservation.objects.filter(expires_at__lte=now)
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            if total:
+                _stock_changed()
+            return total
+        deleted, _ = StockReservation.objects.filter(id__in=ids).delete()
+        total += deleted
@@ -0,0 +1,229 @@
+"""
+Background jobs kept in the database.
+
+A job is a row in ``Job`` naming a task and its keyword arguments.
+``enqueue`` inserts it inside the caller's transaction, so a job queued
+while placing an order exists exactly when the order does, and no broker
+is needed. ``run_worker`` claims due jobs in small batches: with
+``SELECT ... FOR UPDATE SKIP LOCKED`` on PostgreSQL, so concurrent
+workers take disjoint batches without waiting on each other, and on
+SQLite, which has no row locks but serializes writers, with a conditional
+``UPDATE`` that only takes rows that are still due.
+
+A task that raises is retried with exponential backoff (with jitter) until
+the job's ``max_attempts`` is used up, then marked failed with its
+traceback. A job left running by a worker that died is claimed again once
+its lock is older than ``STORE_JOB_LOCK_TIMEOUT`` seconds. Finished jobs,
+done or failed, are kept for ``STORE_JOB_RETENTION`` seconds (a week by
+default) and then deleted in batches by ``reap_jobs``.
+
+Tasks are plain functions registered with ``@task`` (see
+``store.tasks``) and called with the job's payload as keyword arguments.
+"""
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+DEFAULT_BACKOFF = 10
+
+MAX_BACKOFF = 60 * 60
+
+DEFAULT_LOCK_TIMEOUT = 5 * 60
+
+DEFAULT_BATCH_SIZE = 10
+
+DEFAULT_RETENTION = 7 * 24 * 60 * 60
+
+# Tries at writing a job's outcome before leaving it to the lock timeout
+RECORD_ATTEMPTS = 3
+
+DEFAULT_REAP_BATCH_SIZE = 1000
+
+_tasks = {}
+
+
+class UnknownTask(Exception):
+    pass
+
+
+def task(func=None, *, name=None):
+    """Register ``func`` as a task, under ``name`` or its dotted path"""
+    def register(func):
+        func.task_name = name or f'{func.__module__}.{func.__name__}'
+        _tasks[func.task_name] = func
+        return func
+
+    return register(func) if func is not None else register
+
+
+def get_task(name):
+    try:
+        return _tasks[name]
+    except KeyError:
+        raise UnknownTask(name)
+
+
+def enqueue(task, payload=None, delay=0, max_attempts=None):
+    """Queue ``task`` (a registered function or its name) to run after ``delay`` seconds"""
+    name = getattr(task, 'task_name', task)
+    get_task(name)
+    return Job.objects.create(
+        task=name,
+        payload=payload or {},
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or getattr(settings, 'STORE_JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS),
+    )
+
+
+def get_lock_timeout():
+    return timedelta(seconds=getattr(settings, 'STORE_JOB_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT))
+
+
+def get_retention():
+    return timedelta(seconds=getattr(settings, 'STORE_JOB_RETENTION', DEFAULT_RETENTION))
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed ``attempts`` times"""
+    base = getattr(settings, 'STORE_JOB_BACKOFF', DEFAULT_BACKOFF)
+    delay = min(base * 2 ** (attempts - 1), MAX_BACKOFF)
+    # Jitter spreads out retries of jobs that failed together
+    return delay * random.uniform(0.5, 1.0)
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def _due(now):
+    stale = now - get_lock_timeout()
+    return Q(status=Job.QUEUED, run_at__lte=now) | Q(status=Job.RUNNING, locked_at__lt=stale)
+
+
+def claim(worker, batch_size=DEFAULT_BATCH_SIZE):
+    """Lock up to ``batch_size`` due jobs for ``worker``, oldest first"""
+    now = timezone.now()
+    due = Job.objects.filter(_due(now)).order_by('run_at', 'id')
+    claimed = {'status': Job.RUNNING, 'locked_at': now, 'locked_by': worker, 'attempts': F('attempts') + 1}
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            Job.objects.filter(id__in=ids).update(**claimed)
+    else:
+        ids = list(due.values_list('id', flat=True)[:batch_size])
+        # Rows another worker claimed in between are no longer due
+        Job.objects.filter(_due(now), id__in=ids).update(**claimed)
+    return list(Job.objects.filter(id__in=ids, locked_by=worker, locked_at=now).order_by('run_at', 'id'))
+
+
+def run_job(job):
+    """Run a claimed job and record the outcome: ``'done'``, ``'retry'`` or ``'failed'``"""
+    try:
+        get_task(job.task)(**job.payload)
+    except Exception as e:
+        error = traceback.format_exc()
+        now = timezone.now()
+        if job.attempts >= job.max_attempts or isinstance(e, UnknownTask):
+            outcome, fields = 'failed', {'status': Job.FAILED, 'finished_at': now}
+        else:
+            outcome, fields = 'retry', {
+                'status': Job.QUEUED, 'run_at': now + timedelta(seconds=backoff(job.attempts)),
+            }
+    else:
+        outcome, error, fields = 'done', '', {'status': Job.DONE, 'finished_at': timezone.now()}
+    # Only the holder of the lock may record the outcome. The task has run,
+    # so a busy database is worth a short wait rather than a second run.
+    for attempt in range(RECORD_ATTEMPTS):
+        try:
+            Job.objects.filter(pk=job.pk, locked_by=job.locked_by, locked_at=job.locked_at).update(
+                locked_at=None, locked_by='', last_error=error, **fields
+            )
+            break
+        except OperationalError:
+            if attempt == RECORD_ATTEMPTS - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+    return outcome
+
+
+class Metrics:
+    """Throughput and latency totals for a worker pool"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts = {'done': 0, 'retry': 0, 'failed': 0}
+        self.busy = 0.0
+        self.max_lag = 0.0
+
+    def add(self, outcome, elapsed, lag):
+        self.counts[outcome] += 1
+        self.busy += elapsed
+        self.max_lag = max(self.max_lag, lag)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        average = self.busy / self.total * 1000 if self.total else 0.0
+        return (
+            f"{self.counts['done']} done, {self.counts['retry']} retried, {self.counts['failed']} failed; "
+            f'{self.total / elapsed:.1f} jobs/s, {average:.1f} ms per job, max queue lag {self.max_lag:.1f}s'
+        )
+
+
+def work(stop, report, batch_size=DEFAULT_BATCH_SIZE, poll_interval=1.0, burst=False):
+    """Claim and run jobs until ``stop`` is set
+
+    ``report(outcome, seconds running, seconds queued past run_at)`` is
+    called after every job. With ``burst`` the loop ends as soon as no job
+    is due.
+    """
+    worker = worker_id()
+    while not stop.is_set():
+        try:
+            jobs = claim(worker, batch_size)
+        except OperationalError:
+            # SQLite timed out waiting for another writer; try again shortly
+            jobs = None
+        if not jobs:
+            if burst and jobs is not None:
+                return
+            stop.wait(poll_interval)
+            continue
+        for job in jobs:
+            started = time.perf_counter()
+            try:
+                outcome = run_job(job)
+            except OperationalError:
+                # The outcome was not recorded; the job is claimed again
+                # once its lock times out
+                continue
+            report(outcome, time.perf_counter() - started, (job.locked_at - job.run_at).total_seconds())
+
+
+def reap_finished(batch_size=DEFAULT_REAP_BATCH_SIZE, now=None):
+    """Delete jobs finished longer ago than the retention period, ``batch_size`` rows at a time"""
+    cutoff = (now or timezone.now()) - get_retention()
+    finished = Job.objects.filter(status__in=[Job.DONE, Job.FAILED], finished_at__lte=cutoff)
+    total = 0
+    while True:
+        ids = list(finished.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        deleted, _ = Job.objects.filter(id__in=ids).delete()
+        total += deleted
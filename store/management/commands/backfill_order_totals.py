@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from store.models import Order
+from store.orders import DEFAULT_BACKFILL_BATCH_SIZE, refresh_order_totals
+
+
+class Command(BaseCommand):
+    help = 'Recompute stored order totals and item counts from the order items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Recompute every order instead of only orders with no stored items',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BACKFILL_BATCH_SIZE,
+            help='Orders updated per statement',
+        )
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if not options['all']:
+            orders = orders.filter(item_count=0)
+        updated = refresh_order_totals(orders, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated totals for {updated} orders'))
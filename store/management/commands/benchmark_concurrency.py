@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.urls import reverse
+from store.models import Product
+import asyncio
+import io
+import statistics
+import sys
+import time
+
+
+def wsgi_get(app, path):
+    """Run one GET through the WSGI handler, as a gunicorn sync worker would"""
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+    }
+    status = []
+    response = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+    return int(status[0].split()[0])
+
+
+async def asgi_get(app, path):
+    """Run one GET through the ASGI handler, as uvicorn would"""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    request_sent = False
+    status = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client stays connected until the response is complete
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+class Command(BaseCommand):
+    """Both servers run in this one process, so CPU time is shared under the
+    GIL; the comparison is of how many requests each model keeps in flight
+    while queries wait on the database. In production multiply either side
+    by the number of worker processes (WEB_CONCURRENCY).
+    """
+    help = 'Compare request capacity of WSGI sync workers with the ASGI event loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='URL to request (defaults to the async product API)')
+        parser.add_argument('--requests', type=int, default=400, help='Requests per run')
+        parser.add_argument('--workers', type=int, default=4, help='WSGI sync workers (WEB_CONCURRENCY)')
+        parser.add_argument(
+            '--concurrency', type=int, nargs='+', default=[4, 32, 128],
+            help='Open connections served by one ASGI worker',
+        )
+        parser.add_argument(
+            '--latency', type=float, default=20.0,
+            help='Simulated database round trip per query, in ms (0 for the local database as is)',
+        )
+
+    def add_latency(self, latency):
+        def wrapper(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def install(sender, connection, **kwargs):
+            if wrapper not in connection.execute_wrappers:
+                connection.execute_wrappers.append(wrapper)
+
+        connection_created.connect(install, weak=False)
+        for connection in connections.all(initialized_only=True):
+            install(None, connection)
+
+    def report(self, label, timings, elapsed, errors):
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f'{label:<24} {len(timings) / elapsed:>9.1f} {statistics.median(timings):>9.1f} '
+            f'{p95:>9.1f} {errors:>7}'
+        )
+
+    def run_wsgi(self, path, total, workers):
+        app = get_wsgi_application()
+
+        def timed(_):
+            started = time.perf_counter()
+            status = wsgi_get(app, path)
+            return (time.perf_counter() - started) * 1000, status
+
+        started = time.perf_counter()
+        # Requests queue behind busy workers, one request per worker at a time
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(timed, range(total)))
+        elapsed = time.perf_counter() - started
+        errors = sum(1 for _, status in results if status != 200)
+        self.report(f'WSGI {workers} workers', [ms for ms, _ in results], elapsed, errors)
+
+    def run_asgi(self, path, total, concurrency):
+        app = get_asgi_application()
+
+        async def main():
+            slots = asyncio.Semaphore(concurrency)
+
+            async def timed():
+                async with slots:
+                    started = time.perf_counter()
+                    status = await asgi_get(app, path)
+                    return (time.perf_counter() - started) * 1000, status
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*(timed() for _ in range(total)))
+            return results, time.perf_counter() - started
+
+        results, elapsed = asyncio.run(main())
+        errors = sum(1 for _, status in results if status != 200)
+        self.report(f'ASGI {concurrency} connections', [ms for ms, _ in results], elapsed, errors)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            product = Product.objects.filter(available=True).first()
+            if product is None:
+                raise CommandError('No products found; run populate_db first or pass --path')
+            path = reverse('store:api_product_detail', args=[product.slug])
+
+        if options['latency']:
+            self.add_latency(options['latency'] / 1000)
+
+        self.stdout.write(
+            f"GET {path}: {options['requests']} requests, {options['latency']} ms simulated DB latency"
+        )
+        self.stdout.write(f"{'server':<24} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+        self.run_wsgi(path, options['requests'], options['workers'])
+        for concurrency in options['concurrency']:
+            self.run_asgi(path, options['requests'], concurrency)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from store import search
+from store.models import Product
+import statistics
+import time
+
+
+DEFAULT_QUERIES = ['coffee', 'wireless headphones', 'running shoes', 'organic', 'book', 'smart watch']
+
+
+class Command(BaseCommand):
+    help = 'Compare indexed product search against the icontains table scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help='Queries to run (defaults to a built-in set)')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--limit', type=int, default=48, help='Results per query')
+
+    def icontains(self, query, limit):
+        condition = Q()
+        for word in query.split():
+            condition &= (
+                Q(name__icontains=word)
+                | Q(description__icontains=word)
+                | Q(category__name__icontains=word)
+            )
+        return list(Product.objects.filter(condition, available=True)[:limit])
+
+    def timed(self, func, query, limit, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            results = func(query, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings), len(results)
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or DEFAULT_QUERIES
+        repeat = options['repeat']
+        limit = options['limit']
+
+        # Warm up so index loading is not counted against the first query
+        search.get_index()
+
+        self.stdout.write(f'{Product.objects.count()} products, {repeat} runs per query (median ms)')
+        self.stdout.write(f"{'query':<24} {'index':>10} {'hits':>6} {'icontains':>10} {'hits':>6}")
+        for query in queries:
+            index_ms, index_hits = self.timed(search.search_products, query, limit, repeat)
+            scan_ms, scan_hits = self.timed(self.icontains, query, limit, repeat)
+            self.stdout.write(
+                f'{query:<24} {index_ms:>10.2f} {index_hits:>6} {scan_ms:>10.2f} {scan_hits:>6}'
+            )
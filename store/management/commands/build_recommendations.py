@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from store.recommendations import build_recommendations
+import time
+
+
+class Command(BaseCommand):
+    help = 'Build the co-purchase recommendation index from order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rebuild from every order instead of only orders since the last run',
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=None,
+            help='Neighbours to keep per product (default: STORE_RECOMMENDATIONS_TOP_N)',
+        )
+
+    def handle(self, *args, **options):
+        mode = 'full rebuild' if options['full'] else 'incremental refresh'
+        self.stdout.write(f'Building recommendations ({mode})...')
+        started = time.perf_counter()
+        last_order_id, refreshed = build_recommendations(full=options['full'], top_n=options['top'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed {refreshed} products up to order #{last_order_id} in {elapsed:.2f}s'
+        ))
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections
+from store.models import Product
+from store.renditions import render_product
+from store.signals import catalog_changed
+import time
+
+
+def _render(product_id, force):
+    try:
+        return render_product(product_id, force=force)
+    finally:
+        # Pool threads each open their own connection
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    """Pillow releases the GIL while resizing and encoding, so a thread
+    pool uses several cores without the start-up cost of processes.
+    """
+    help = 'Render missing product image renditions (for existing images or after changing the sizes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Hash every image again and record all renditions, not just missing ones',
+        )
+        parser.add_argument('--workers', type=int, default=4, help='Rendering threads')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            products = products.filter(renditions={})
+        ids = list(products.values_list('id', flat=True))
+        self.stdout.write(f'Rendering images of {len(ids)} products...')
+        started = time.perf_counter()
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                rendered = sum(pool.map(lambda product_id: _render(product_id, options['force']), ids))
+        else:
+            rendered = sum(render_product(product_id, force=options['force']) for product_id in ids)
+        if rendered:
+            catalog_changed()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {rendered} products in {time.perf_counter() - started:.2f}s'
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from store import search
+import time
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index and write it to disk'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Building search index...')
+        started = time.perf_counter()
+        index = search.rebuild_index()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {len(index)} products ({len(index.postings)} terms) '
+            f'in {elapsed:.2f}s -> {search.get_index_path()}'
+        ))
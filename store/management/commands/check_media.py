@@ -1,55 +1,77 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from store.media_audit import DEFAULT_MAX_BYTES, DEFAULT_MAX_SIDE, audit
+from store.models import Product
+import json
 import os
 
+DEFAULT_CHUNK_SIZE = 2000
+
 
 class Command(BaseCommand):
+    """With --audit, every product image is checked against the media tree;
+    see store.media_audit.
+    """
     help = 'Check media files configuration and availability'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--audit', action='store_true',
+            help='Report missing, orphaned, oversize and undecodable product images',
+        )
+        parser.add_argument('--json', action='store_true', help='Print the audit as JSON')
+        parser.add_argument(
+            '--workers', type=int, default=None, help='Verifying processes (default: one per CPU)',
+        )
+        parser.add_argument(
+            '--max-bytes', type=int,
+            default=getattr(settings, 'STORE_MEDIA_MAX_ORIGINAL_BYTES', DEFAULT_MAX_BYTES),
+            help='Flag originals larger than this many bytes',
+        )
+        parser.add_argument(
+            '--max-side', type=int,
+            default=getattr(settings, 'STORE_MEDIA_MAX_ORIGINAL_SIDE', DEFAULT_MAX_SIDE),
+            help='Flag originals wider or taller than this many pixels',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Products read from the database at a time',
+        )
+
     def handle(self, *args, **options):
+        if options['audit'] or options['json']:
+            return self.audit(options)
+
         self.stdout.write("🔍 Media Configuration Check")
         self.stdout.write("-" * 40)
-        
+
         # Check Django settings
         self.stdout.write(f"MEDIA_URL: {settings.MEDIA_URL}")
         self.stdout.write(f"MEDIA_ROOT: {settings.MEDIA_ROOT}")
-        
+
         # Check if media directory exists
         if os.path.exists(settings.MEDIA_ROOT):
             self.stdout.write(f"✓ MEDIA_ROOT directory exists: {settings.MEDIA_ROOT}")
-            
+
             # Check products subdirectory
             products_dir = os.path.join(settings.MEDIA_ROOT, 'products')
             if os.path.exists(products_dir):
                 self.stdout.write(f"✓ Products directory exists: {products_dir}")
-                
-                # List some files
-                files = os.listdir(products_dir)
-                self.stdout.write(f"📁 Found {len(files)} files in products directory:")
-                for i, file in enumerate(files[:5]):  # Show first 5 files
-                    file_path = os.path.join(products_dir, file)
-                    file_size = os.path.getsize(file_path)
-                    self.stdout.write(f"   {i+1}. {file} ({file_size} bytes)")
-                
-                if len(files) > 5:
-                    self.stdout.write(f"   ... and {len(files) - 5} more files")
-                    
-                # Check specific file that's failing
-                test_file = os.path.join(products_dir, 'smartphone-pro_ultra_precise.jpg')
-                if os.path.exists(test_file):
-                    size = os.path.getsize(test_file)
-                    self.stdout.write(f"✓ Test file exists: smartphone-pro_ultra_precise.jpg ({size} bytes)")
-                else:
-                    self.stdout.write("✗ Test file missing: smartphone-pro_ultra_precise.jpg")
+
+                with os.scandir(products_dir) as entries:
+                    sizes = [entry.stat().st_size for entry in entries if entry.is_file()]
+                self.stdout.write(
+                    f"📁 Found {len(sizes)} files in products directory ({sum(sizes)} bytes)"
+                )
+                self.stdout.write("   Run with --audit to check them against the products")
             else:
                 self.stdout.write(f"✗ Products directory missing: {products_dir}")
         else:
             self.stdout.write(f"✗ MEDIA_ROOT directory missing: {settings.MEDIA_ROOT}")
-            
+
         # Check current working directory
         cwd = os.getcwd()
         self.stdout.write(f"📍 Current working directory: {cwd}")
-        
+
         # Check if media files exist relative to CWD
         local_media = os.path.join(cwd, 'media', 'products')
         if os.path.exists(local_media):
@@ -57,3 +79,46 @@ class Command(BaseCommand):
             self.stdout.write(f"📁 Local media/products has {len(files)} files")
         else:
             self.stdout.write("✗ Local media/products directory not found")
+
+    def audit(self, options):
+        images = (
+            Product.objects.exclude(image='').exclude(image__isnull=True)
+            .order_by('id').values_list('id', 'image').iterator(chunk_size=options['chunk_size'])
+        )
+        report = audit(
+            settings.MEDIA_ROOT, images, workers=options['workers'],
+            max_bytes=options['max_bytes'], max_side=options['max_side'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(report.as_dict(), indent=2))
+            return
+
+        counts = report.counts()
+        self.stdout.write(f"Media audit of {report.root}")
+        self.stdout.write(
+            f"{counts['products']} product images, {counts['files']} files ({counts['bytes']} bytes) "
+            f"checked in {counts['seconds']:.2f}s"
+        )
+        self.table('Missing files', ['PRODUCT', 'IMAGE'], [
+            (row['product_id'], row['image']) for row in report.missing
+        ])
+        self.table('Orphaned files', ['PATH', 'BYTES'], [(row['path'], row['size']) for row in report.orphans])
+        self.table('Oversize originals', ['PATH', 'BYTES', 'PIXELS', 'PRODUCTS'], [
+            (row['path'], row['size'], f"{row['width']}x{row['height']}", ', '.join(map(str, row['product_ids'])))
+            for row in report.oversize
+        ])
+        self.table('Undecodable files', ['PATH', 'ERROR', 'PRODUCTS'], [
+            (row['path'], row['error'], ', '.join(map(str, row['product_ids']))) for row in report.undecodable
+        ])
+        if report.ok:
+            self.stdout.write(self.style.SUCCESS('No problems found'))
+
+    def table(self, title, headers, rows):
+        if not rows:
+            return
+        self.stdout.write('')
+        self.stdout.write(self.style.WARNING(f'{title}: {len(rows)}'))
+        rows = [headers] + [[str(value) for value in row] for row in rows]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(headers))]
+        for row in rows:
+            self.stdout.write('  ' + '  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
@@ -0,0 +1,6 @@
+from store.exports import ExportCommand
+
+
+class Command(ExportCommand):
+    help = 'Stream categories and products to CSV or NDJSON files'
+    datasets = ('categories', 'products')
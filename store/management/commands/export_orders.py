@@ -0,0 +1,6 @@
+from store.exports import ExportCommand
+
+
+class Command(ExportCommand):
+    help = 'Stream orders and order items to CSV or NDJSON files'
+    datasets = ('orders', 'order_items')
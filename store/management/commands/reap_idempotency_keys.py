@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from store.idempotency import DEFAULT_REAP_BATCH_SIZE, reap_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete expired idempotency keys in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_REAP_BATCH_SIZE,
+            help='Keys deleted per statement',
+        )
+
+    def handle(self, *args, **options):
+        deleted = reap_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys'))
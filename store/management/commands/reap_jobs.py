@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from store.jobs import DEFAULT_REAP_BATCH_SIZE, reap_finished
+
+
+class Command(BaseCommand):
+    help = 'Delete finished background jobs older than STORE_JOB_RETENTION in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_REAP_BATCH_SIZE,
+            help='Jobs deleted per statement',
+        )
+
+    def handle(self, *args, **options):
+        deleted = reap_finished(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} finished jobs'))
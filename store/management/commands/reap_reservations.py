@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from store.inventory import DEFAULT_REAP_BATCH_SIZE, reap_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete expired stock reservations in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_REAP_BATCH_SIZE,
+            help='Reservations deleted per statement',
+        )
+
+    def handle(self, *args, **options):
+        deleted = reap_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired reservations'))
@@ -0,0 +1,100 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+from store import jobs
+import django
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+
+def _thread_worker(stop, reports, options):
+    try:
+        jobs.work(stop, lambda *report: reports.put(report), **options)
+    finally:
+        # Connections are per thread; close this worker's own
+        connections.close_all()
+
+
+def _process_worker(stop, reports, options):
+    django.setup()
+    # Ctrl-C reaches the whole process group; the parent sets ``stop`` instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _thread_worker(stop, reports, options)
+
+
+class Command(BaseCommand):
+    """Jobs are claimed straight from the database, so any number of these
+    can run side by side, on one host or several.
+    """
+    help = 'Run background jobs from the database queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Worker threads (or processes)')
+        parser.add_argument(
+            '--processes', action='store_true',
+            help='Run each worker in its own process instead of a thread, for CPU-bound tasks',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=jobs.DEFAULT_BATCH_SIZE, help='Jobs claimed per query'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0, help='Seconds to wait when no job is due'
+        )
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+        parser.add_argument(
+            '--stats-interval', type=float, default=30.0, help='Seconds between throughput reports (0 to disable)'
+        )
+
+    def handle(self, *args, **options):
+        work_options = {
+            'batch_size': options['batch_size'],
+            'poll_interval': options['poll_interval'],
+            'burst': options['burst'],
+        }
+        if options['processes']:
+            context = multiprocessing.get_context()
+            stop, reports = context.Event(), context.Queue()
+            # Children must not share the parent's database connections
+            connections.close_all()
+            workers = [
+                context.Process(target=_process_worker, args=(stop, reports, work_options), daemon=True)
+                for _ in range(options['concurrency'])
+            ]
+        else:
+            stop, reports = threading.Event(), queue.Queue()
+            workers = [
+                threading.Thread(target=_thread_worker, args=(stop, reports, work_options), daemon=True)
+                for _ in range(options['concurrency'])
+            ]
+
+        handlers = {sig: signal.signal(sig, lambda *_: stop.set()) for sig in (signal.SIGINT, signal.SIGTERM)}
+        kind = 'processes' if options['processes'] else 'threads'
+        self.stdout.write(f"Running jobs with {options['concurrency']} {kind}")
+        metrics = jobs.Metrics()
+        last_report = time.monotonic()
+        try:
+            for worker in workers:
+                worker.start()
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    metrics.add(*reports.get(timeout=0.5))
+                except queue.Empty:
+                    pass
+                interval = options['stats_interval']
+                if interval and time.monotonic() - last_report >= interval:
+                    self.stdout.write(metrics.summary())
+                    last_report = time.monotonic()
+            for worker in workers:
+                worker.join()
+            while True:
+                try:
+                    metrics.add(*reports.get(timeout=0.1))
+                except queue.Empty:
+                    break
+        finally:
+            stop.set()
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        self.stdout.write(self.style.SUCCESS(metrics.summary()))
@@ -22,6 +22,11 @@ class Command(BaseCommand):
         call_command('migrate', verbosity=0)
         self.stdout.write(self.style.SUCCESS('✓ Database migrations completed'))
 
+        # Create the database cache table (no-op for other cache backends)
+        self.stdout.write('Creating cache table...')
+        call_command('createcachetable', verbosity=0)
+        self.stdout.write(self.style.SUCCESS('✓ Cache table ready'))
+
         # Collect static files
         self.stdout.write('Collecting static files...')
         call_command('collectstatic', '--noinput', verbosity=0)
@@ -1,30 +1,40 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 import os
-import shutil
+
+from store.media_sync import DEFAULT_WORKERS, sync_tree
+
 
 class Command(BaseCommand):
+    """Only new and changed files are copied; see store.media_sync."""
     help = 'Syncs media files to the production media directory'
 
-    def handle(self, *args, **kwargs):
-        media_root = settings.MEDIA_ROOT
-        if not os.path.exists(media_root):
-            os.makedirs(media_root)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source', default=os.path.join(settings.BASE_DIR, 'media', 'products'),
+            help='Directory to copy from (default: media/products in the project)',
+        )
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Copying threads')
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Delete previously synced files that are no longer in the source',
+        )
 
-        # Copy product images
-        products_dir = os.path.join(media_root, 'products')
-        if not os.path.exists(products_dir):
-            os.makedirs(products_dir)
+    def handle(self, *args, **options):
+        products_dir = os.path.join(settings.MEDIA_ROOT, 'products')
+        source_dir = options['source']
+        if not os.path.isdir(source_dir):
+            raise CommandError(f'{source_dir} is not a directory')
 
         self.stdout.write('Syncing media files...')
-        # Copy all files from media/products to production media directory
-        source_dir = os.path.join(settings.BASE_DIR, 'media', 'products')
-        if os.path.exists(source_dir):
-            for filename in os.listdir(source_dir):
-                source = os.path.join(source_dir, filename)
-                destination = os.path.join(products_dir, filename)
-                if os.path.isfile(source):
-                    shutil.copy2(source, destination)
-                    self.stdout.write(f'Copied {filename}')
-
-        self.stdout.write(self.style.SUCCESS('Successfully synced media files'))
+        result = sync_tree(source_dir, products_dir, workers=options['workers'], delete=options['delete'])
+        if options['verbosity'] > 1:
+            for name in result.copied:
+                self.stdout.write(f'Copied {name}')
+            for name in result.deleted:
+                self.stdout.write(f'Deleted {name}')
+        for name, error in result.errors:
+            self.stderr.write(f'Failed {name}: {error}')
+        if result.errors:
+            raise CommandError(f'Media sync incomplete: {result.summary()}')
+        self.stdout.write(self.style.SUCCESS(f'Successfully synced media files: {result.summary()}'))
@@ -0,0 +1,246 @@
+"""
+Serving files from MEDIA_ROOT.
+
+``serve_file`` answers a media request from a single ``os.stat``. Every
+response carries a strong ``ETag`` (size and modification time in
+nanoseconds) and ``Last-Modified``, so revalidation is answered with
+``304 Not Modified`` without opening the file. Content-hashed names under
+``STORE_MEDIA_IMMUTABLE_PREFIXES`` (image renditions by default) never
+change content and are sent with a one-year ``immutable`` lifetime; other
+files, uploads included, are cached for ``STORE_MEDIA_MAX_AGE`` seconds. Single byte ranges get ``206 Partial
+Content``, honouring ``If-Range``; multiple ranges get the whole file.
+
+With ``STORE_MEDIA_SENDFILE`` set to ``'x-accel-redirect'`` (nginx) or
+``'x-sendfile'`` (Apache, lighttpd) the body and ranges are left to the
+front-end server: the response only names the file, under
+``STORE_MEDIA_ACCEL_PREFIX`` for nginx. Otherwise files up to
+``STORE_MEDIA_MEMORY_FILE_MAX_BYTES`` are kept in a per-process LRU of at
+most ``STORE_MEDIA_MEMORY_CACHE_BYTES``; an entry is only used while the
+file's size and modification time still match the ``stat``.
+"""
+import mimetypes
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+DEFAULT_MAX_AGE = 60 * 60
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+DEFAULT_MEMORY_CACHE_BYTES = 16 * 1024 * 1024
+
+DEFAULT_MEMORY_FILE_MAX_BYTES = 256 * 1024
+
+DEFAULT_ACCEL_PREFIX = '/protected-media/'
+
+CHUNK_SIZE = 64 * 1024
+
+# Trees whose files are named by their content hash (see store.renditions).
+# Uploads are left out: their names may look hashed (UUIDs) but are
+# rewritten in place by media syncs.
+DEFAULT_IMMUTABLE_PREFIXES = ('renditions/',)
+
+# A run of 12 or more hex digits as a whole path segment or name part
+_HASHED_NAME = re.compile(r'(?:^|[/._-])[0-9a-f]{12,}(?=[/._-]|$)')
+
+
+def resolve(file_path):
+    """Absolute path of ``file_path`` under MEDIA_ROOT, or None if it points outside it"""
+    root = os.path.normpath(str(settings.MEDIA_ROOT))
+    full_path = os.path.normpath(os.path.join(root, file_path))
+    if not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+
+def is_immutable(file_path):
+    """Whether ``file_path`` is a content-hashed name in one of the immutable trees"""
+    prefixes = getattr(settings, 'STORE_MEDIA_IMMUTABLE_PREFIXES', DEFAULT_IMMUTABLE_PREFIXES)
+    return file_path.startswith(tuple(prefixes)) and bool(_HASHED_NAME.search(file_path))
+
+
+@lru_cache(maxsize=256)
+def content_type_for(extension):
+    content_type, _ = mimetypes.guess_type(f'file{extension}')
+    return content_type or 'application/octet-stream'
+
+
+def etag_for(st):
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """``(start, end)`` (inclusive) of a single ``bytes`` range, or None to send everything
+
+    Raises ``ValueError`` if the range lies wholly past the end of the file.
+    Malformed and multiple ranges are ignored, as RFC 9110 allows.
+    """
+    units, _, ranges = header.partition('=')
+    if units.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+class MemoryFileCache:
+    """Thread-safe LRU of small file contents, bounded by total bytes"""
+
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.data = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, st):
+        """Contents of ``path`` if cached and unchanged since ``st``, else None"""
+        with self.lock:
+            entry = self.data.get(path)
+            if entry is None:
+                return None
+            if entry[:2] != (st.st_size, st.st_mtime_ns):
+                self.size -= len(self.data.pop(path)[2])
+                return None
+            self.data.move_to_end(path)
+            return entry[2]
+
+    def load(self, path, st):
+        """Read ``path`` into the cache if it is small enough; returns the contents or None"""
+        if st.st_size > self.max_file_bytes or st.st_size > self.max_bytes:
+            return None
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        if len(content) != st.st_size:
+            # Changed while reading; serve it from disk this time
+            return None
+        with self.lock:
+            previous = self.data.pop(path, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self.data[path] = (st.st_size, st.st_mtime_ns, content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                self.size -= len(self.data.popitem(last=False)[1][2])
+        return content
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+
+_memory_cache = None
+_memory_cache_lock = threading.Lock()
+
+
+def get_memory_cache():
+    global _memory_cache
+    max_bytes = getattr(settings, 'STORE_MEDIA_MEMORY_CACHE_BYTES', DEFAULT_MEMORY_CACHE_BYTES)
+    max_file_bytes = getattr(settings, 'STORE_MEDIA_MEMORY_FILE_MAX_BYTES', DEFAULT_MEMORY_FILE_MAX_BYTES)
+    with _memory_cache_lock:
+        if _memory_cache is None or (_memory_cache.max_bytes, _memory_cache.max_file_bytes) != (
+            max_bytes, max_file_bytes
+        ):
+            _memory_cache = MemoryFileCache(max_bytes, max_file_bytes)
+        return _memory_cache
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def stat_file(path):
+    """``os.stat`` of a regular file at ``path``, or None"""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+
+def serve_file(request, path, st, content_type=None, max_age=None, accel_name=None):
+    """Response for the regular file at ``path`` whose ``os.stat`` is ``st``
+
+    ``accel_name`` is the file's name under MEDIA_ROOT; only such files are
+    handed to the front-end server when ``STORE_MEDIA_SENDFILE`` is set.
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'STORE_MEDIA_MAX_AGE', DEFAULT_MAX_AGE)
+    content_type = content_type or content_type_for(os.path.splitext(path)[1].lower())
+    etag = etag_for(st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': f'public, max-age={max_age}' + (', immutable' if max_age >= IMMUTABLE_MAX_AGE else ''),
+    }
+    validated = HttpResponse(content_type=content_type, headers=headers)
+    conditional = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime), response=validated)
+    if conditional is not validated:
+        return conditional
+
+    sendfile = getattr(settings, 'STORE_MEDIA_SENDFILE', None)
+    if sendfile and accel_name is not None:
+        if sendfile == 'x-accel-redirect':
+            prefix = getattr(settings, 'STORE_MEDIA_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX)
+            validated['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(accel_name.replace(os.sep, '/'))
+        else:
+            validated['X-Sendfile'] = path
+        return validated
+
+    headers['Accept-Ranges'] = 'bytes'
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and request.headers.get('If-Range', etag) in (etag, headers['Last-Modified']):
+        try:
+            byte_range = parse_range(range_header, st.st_size)
+        except ValueError:
+            headers['Content-Range'] = f'bytes */{st.st_size}'
+            return HttpResponse(status=416, content_type=content_type, headers=headers)
+
+    memory = get_memory_cache()
+    content = memory.get(path, st)
+    if content is None:
+        content = memory.load(path, st)
+    if byte_range is None:
+        if content is not None:
+            return HttpResponse(content, content_type=content_type, headers=headers)
+        return FileResponse(open(path, 'rb'), content_type=content_type, headers=headers)
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+    if content is not None:
+        return HttpResponse(content[start:end + 1], status=206, content_type=content_type, headers=headers)
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingHttpResponse(
+        _read_range(path, start, end - start + 1), status=206, content_type=content_type, headers=headers
+    )
@@ -0,0 +1,162 @@
+"""
+Integrity audit of product images on disk.
+
+``audit`` walks the media tree once with ``os.scandir`` and checks it
+against the image names stored on products, which the caller streams from
+the database (see the ``check_media`` command). It reports:
+
+- missing: images a product refers to that are not on disk
+- orphans: files on disk that no product refers to (generated files
+  under ``renditions/`` and dotfiles are not counted)
+- oversize: referenced originals larger than ``max_bytes`` or wider or
+  taller than ``max_side`` pixels
+- undecodable: referenced files Pillow cannot open or ``verify()``
+
+Verification runs in a process pool: opening and checking an image is
+CPU-bound, and separate processes avoid contending for the GIL on large
+trees. The worker function does not depend on Django, so the pool also
+works with the ``spawn`` and ``forkserver`` start methods.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+
+DEFAULT_MAX_SIDE = 4000
+
+# Directories of generated files, never product originals
+SKIPPED_DIRS = ('renditions',)
+
+# Most files handed to a pool worker at a time
+CHUNK_SIZE = 256
+
+
+def scan(root, skipped_dirs=SKIPPED_DIRS):
+    """``{relative path: size}`` of every file under ``root`` except dotfiles and ``skipped_dirs``"""
+    files = {}
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_dir))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                relative = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if relative not in skipped_dirs:
+                        pending.append(relative)
+                elif entry.is_file():
+                    files[relative] = entry.stat().st_size
+    return files
+
+
+def verify_image(path):
+    """``((width, height), None)`` if the image at ``path`` is sound, else ``(None, error)``"""
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            size = image.size
+            image.verify()
+    except Exception as e:
+        # Corrupt files raise anything from OSError to SyntaxError
+        return None, f'{type(e).__name__}: {e}'
+    return size, None
+
+
+class AuditReport:
+    def __init__(self, root):
+        self.root = root
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.products = 0
+        self.files = 0
+        self.bytes = 0
+        self.missing = []
+        self.orphans = []
+        self.oversize = []
+        self.undecodable = []
+
+    @property
+    def ok(self):
+        return not (self.missing or self.orphans or self.oversize or self.undecodable)
+
+    def counts(self):
+        return {
+            'products': self.products,
+            'files': self.files,
+            'bytes': self.bytes,
+            'missing': len(self.missing),
+            'orphans': len(self.orphans),
+            'oversize': len(self.oversize),
+            'undecodable': len(self.undecodable),
+            'seconds': round(self.elapsed, 3),
+        }
+
+    def as_dict(self):
+        return {
+            'media_root': str(self.root),
+            'summary': self.counts(),
+            'missing': self.missing,
+            'orphans': self.orphans,
+            'oversize': self.oversize,
+            'undecodable': self.undecodable,
+        }
+
+
+def audit(root, images, workers=None, max_bytes=DEFAULT_MAX_BYTES, max_side=DEFAULT_MAX_SIDE):
+    """Audit the media tree at ``root`` against ``images``, ``(product id, name)`` pairs
+
+    ``images`` is consumed once, so it can be a streaming queryset.
+    ``workers`` processes verify the images (one per CPU by default); with
+    1 they are verified in this process.
+    """
+    report = AuditReport(root)
+    files = scan(root)
+    report.files = len(files)
+    report.bytes = sum(files.values())
+
+    referenced = {}
+    for product_id, name in images:
+        report.products += 1
+        if name in files:
+            referenced.setdefault(name, []).append(product_id)
+        else:
+            report.missing.append({'product_id': product_id, 'image': name})
+
+    report.orphans = [{'path': name, 'size': files[name]} for name in sorted(set(files) - set(referenced))]
+
+    names = sorted(referenced)
+    paths = [os.path.join(root, *name.split('/')) for name in names]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        results = map(verify_image, paths)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # Several chunks per worker keep them all busy to the end
+        chunksize = max(1, min(CHUNK_SIZE, len(paths) // (workers * 4)))
+        results = pool.map(verify_image, paths, chunksize=chunksize)
+    try:
+        for name, (dimensions, error) in zip(names, results):
+            product_ids = referenced[name]
+            if error is not None:
+                report.undecodable.append({'path': name, 'error': error, 'product_ids': product_ids})
+                continue
+            width, height = dimensions
+            if files[name] > max_bytes or max(width, height) > max_side:
+                report.oversize.append({
+                    'path': name, 'size': files[name], 'width': width, 'height': height,
+                    'product_ids': product_ids,
+                })
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    report.elapsed = time.perf_counter() - report.started
+    return report
@@ -0,0 +1,216 @@
+"""
+Incremental copying of a media tree.
+
+``sync_tree`` copies a source directory into a destination and records
+what it copied in a manifest, ``.media-manifest.json`` in the destination:
+the size, modification time (in nanoseconds) and SHA-256 of every file.
+On the next run a file whose source and destination both still match
+their manifest entry is skipped after two ``stat`` calls, without being
+read, so a deploy where nothing changed touches no file contents.
+
+Files that do not match are handled by a thread pool. A destination file
+of the same size is hashed and compared before anything is copied, so a
+checkout that only reset modification times copies nothing. Copies go to
+a temporary file in the destination directory, are hashed while they are
+written, and are renamed into place; the manifest is written the same
+way. With ``delete`` files recorded in the manifest whose source is gone
+are removed; files the manifest never recorded (uploads, renditions) are
+left alone.
+
+Nothing here depends on Django, so ``copy_media.py`` can run it before
+the project is configured.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = '.media-manifest.json'
+
+MANIFEST_VERSION = 1
+
+DEFAULT_WORKERS = 8
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SyncResult:
+    """Counts of what one sync did"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.copied = []
+        self.unchanged = 0
+        self.deleted = []
+        self.errors = []
+        self.bytes_copied = 0
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return (
+            f'{len(self.copied)} copied ({self.bytes_copied / 1024 / 1024:.1f} MB), '
+            f'{self.unchanged} unchanged, {len(self.deleted)} deleted, {len(self.errors)} failed '
+            f'in {elapsed:.2f}s'
+        )
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    """``{relative path: {size, mtime_ns, sha256}}`` from ``path``; empty if missing or unreadable"""
+    try:
+        with open(path) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+
+def write_manifest(path, files):
+    """Write the manifest to a temporary file and rename it over ``path``"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-manifest-')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'version': MANIFEST_VERSION, 'files': files}, fh, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def scan(root):
+    """``{relative path: os.stat_result}`` of every file under ``root``, with one ``scandir`` per directory"""
+    files = {}
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relative)
+                elif entry.is_file() and not entry.name.startswith('.tmp-') and relative != MANIFEST_NAME:
+                    files[relative] = entry.stat()
+    return files
+
+
+def _matches(entry, st):
+    return entry is not None and st is not None and (entry['size'], entry['mtime_ns']) == (
+        st.st_size, st.st_mtime_ns
+    )
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _copy(source, destination):
+    """Copy ``source`` over ``destination`` atomically, returning the SHA-256 of what was written"""
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        shutil.copystat(source, tmp_path)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return digest.hexdigest()
+
+
+def _sync_file(source, destination, st, entry):
+    """Bring one destination file up to date; returns ``(manifest entry, copied)``"""
+    dest_st = _stat(destination)
+    if dest_st is not None and dest_st.st_size == st.st_size:
+        # Same size: compare content before copying anything
+        dest_hash = entry['sha256'] if _matches(entry, dest_st) else sha256_file(destination)
+        source_hash = entry['sha256'] if _matches(entry, st) else sha256_file(source)
+        if source_hash == dest_hash:
+            shutil.copystat(source, destination)
+            return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': source_hash}, False
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': _copy(source, destination)}, True
+
+
+def sync_tree(source, destination, workers=DEFAULT_WORKERS, delete=False):
+    """Copy new and changed files from ``source`` to ``destination``; returns a ``SyncResult``"""
+    result = SyncResult()
+    if os.path.realpath(source) == os.path.realpath(destination):
+        # Already in place
+        return result
+    os.makedirs(destination, exist_ok=True)
+    manifest_path = os.path.join(destination, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    sources = scan(source)
+
+    files = {}
+    pending = []
+    for relative, st in sources.items():
+        entry = manifest.get(relative)
+        target = os.path.join(destination, *relative.split('/'))
+        if _matches(entry, st) and _matches(entry, _stat(target)):
+            files[relative] = entry
+            result.unchanged += 1
+        else:
+            pending.append((relative, st, entry))
+
+    def work(item):
+        relative, st, entry = item
+        try:
+            return relative, _sync_file(
+                os.path.join(source, *relative.split('/')), os.path.join(destination, *relative.split('/')),
+                st, entry,
+            ), None
+        except OSError as e:
+            return relative, None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for relative, outcome, error in pool.map(work, pending):
+            if error is not None:
+                result.errors.append((relative, error))
+                continue
+            files[relative], copied = outcome
+            if copied:
+                result.copied.append(relative)
+                result.bytes_copied += files[relative]['size']
+            else:
+                result.unchanged += 1
+
+    for relative in sorted(set(manifest) - set(sources)):
+        if not delete:
+            # Still there, and still ours to delete on a later run
+            files[relative] = manifest[relative]
+            continue
+        try:
+            os.unlink(os.path.join(destination, *relative.split('/')))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            result.errors.append((relative, e))
+            files[relative] = manifest[relative]
+            continue
+        result.deleted.append(relative)
+
+    write_manifest(manifest_path, files)
+    return result
@@ -1,37 +1,37 @@
-from django.http import FileResponse, Http404
-from django.shortcuts import get_object_or_404
-from django.conf import settings
-import os
-import mimetypes
+from django.http import Http404
+
+from .media import IMMUTABLE_MAX_AGE, is_immutable, resolve, serve_file, stat_file
+from .thumbnails import InvalidThumbnail, get_thumbnail
+
+THUMBNAIL_MAX_AGE = 24 * 60 * 60
 
 
 def serve_media(request, file_path):
     """
-    Serve media files in production
+    Serve media files in production, with validators, ranges and caching (see store.media)
     """
-    # Security: only allow files in the media directory
-    full_path = os.path.join(settings.MEDIA_ROOT, file_path)
-    
-    # Normalize path to prevent directory traversal attacks
-    full_path = os.path.normpath(full_path)
-    
-    # Ensure the file is within MEDIA_ROOT
-    if not full_path.startswith(settings.MEDIA_ROOT):
+    # Refuses paths that normalize to outside MEDIA_ROOT
+    full_path = resolve(file_path)
+    st = stat_file(full_path) if full_path else None
+    if st is None:
         raise Http404("File not found")
-    
-    # Check if file exists
-    if not os.path.exists(full_path):
+    # Content-hashed names never change, so browsers may keep them for good
+    max_age = IMMUTABLE_MAX_AGE if is_immutable(file_path) else None
+    try:
+        return serve_file(request, full_path, st, max_age=max_age, accel_name=file_path)
+    except OSError:
         raise Http404("File not found")
-    
-    # Guess content type
-    content_type, _ = mimetypes.guess_type(full_path)
-    
-    # Return file response
+
+
+def serve_thumbnail(request, width, height, file_path):
+    """
+    Serve a media image scaled to fit inside width x height, from the thumbnail cache
+    """
     try:
-        response = FileResponse(
-            open(full_path, 'rb'),
-            content_type=content_type or 'application/octet-stream'
-        )
-        return response
-    except IOError:
+        path, content_type = get_thumbnail(file_path, f'{width}x{height}')
+        st = stat_file(path)
+        if st is None:
+            raise Http404("File not found")
+        return serve_file(request, path, st, content_type=content_type, max_age=THUMBNAIL_MAX_AGE)
+    except (InvalidThumbnail, OSError):
         raise Http404("File not found")
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['updated_at'], name='store_produ_updated_8f8f51_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:32
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    # A frozen copy of store.orders.refresh_order_totals
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    cost = items.annotate(
+        total=Sum(F('price') * F('quantity'), output_field=DecimalField(max_digits=12, decimal_places=2))
+    ).values('total')
+    count = items.annotate(total=Sum('quantity')).values('total')
+    Order.objects.update(
+        total_cost=Coalesce(Subquery(cost), Value(0), output_field=DecimalField(max_digits=12, decimal_places=2)),
+        item_count=Coalesce(Subquery(count), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
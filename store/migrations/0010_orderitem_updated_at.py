@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_product_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['updated_at'], name='store_order_updated_9c9aed_idx'),
+        ),
+    ]
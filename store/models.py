@@ -1,7 +1,9 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import Count, DecimalField, F, Max, Sum
 from django.contrib.auth.models import User
 from django.urls import reverse
-from PIL import Image
 
 
 class Category(models.Model):
@@ -29,6 +31,9 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # SHA-256 of the image file and its resized copies (see store.renditions)
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
     stock = models.PositiveIntegerField(default=0)
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -40,6 +45,7 @@ class Product(models.Model):
             models.Index(fields=['slug']),
             models.Index(fields=['available']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['updated_at']),
         ]
 
     def __str__(self):
@@ -48,14 +54,27 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('store:product_detail', args=[self.slug])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image = instance.__dict__.get('image')
+        return instance
+
+    def _image_replaced(self):
+        if 'image' not in self.__dict__:
+            # Deferred and never assigned
+            return False
+        if self.image and not self.image._committed:
+            return True
+        return (self.image.name or None) != (getattr(self, '_loaded_image', None) or None)
+
     def save(self, *args, **kwargs):
+        # Read by the post_save handler, which renders renditions only when
+        # the image file itself changed
+        self.image_replaced = self._image_replaced()
         super().save(*args, **kwargs)
-        if self.image:
-            img = Image.open(self.image.path)
-            if img.height > 300 or img.width > 300:
-                output_size = (300, 300)
-                img.thumbnail(output_size)
-                img.save(self.image.path)
+        if 'image' in self.__dict__:
+            self._loaded_image = self.image.name
 
 
 class Cart(models.Model):
@@ -66,11 +85,38 @@ class Cart(models.Model):
     def __str__(self):
         return f"Cart for {self.user.username}"
 
+    def get_summary(self):
+        """Line count, item count, total price and last change, from one query
+
+        The result is memoized on the instance; saving or deleting one of its
+        items through the ORM clears it again (see ``store.signals``).
+        """
+        if getattr(self, '_summary', None) is None:
+            self._summary = summarize_cart_items(self.items.all())
+        return self._summary
+
     def get_total_price(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        return self.get_summary()['total_price']
 
     def get_total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.get_summary()['total_items']
+
+
+def summarize_cart_items(items):
+    """Aggregate a ``CartItem`` queryset in the database"""
+    summary = items.aggregate(
+        lines=Count('id'),
+        total_items=Sum('quantity'),
+        total_price=Sum(
+            F('quantity') * F('product__price'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        last_modified=Max('updated_at'),
+    )
+    summary['total_items'] = summary['total_items'] or 0
+    # SQLite returns the product sum unquantized
+    summary['total_price'] = (summary['total_price'] or Decimal('0')).quantize(Decimal('0.01'))
+    return summary
 
 
 class CartItem(models.Model):
@@ -107,17 +153,25 @@ class Order(models.Model):
     postal_code = models.CharField(max_length=20)
     city = models.CharField(max_length=100)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    # Written by place_order and refresh_order_totals, so listings need not
+    # read the items
+    total_cost = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Order history pages a user's orders on (-created_at, id)
+            models.Index(fields=['user', '-created_at', 'id']),
+        ]
 
     def __str__(self):
         return f"Order {self.id} by {self.user.username}"
 
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        return self.total_cost
 
 
 class OrderItem(models.Model):
@@ -125,9 +179,135 @@ class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.PositiveIntegerField(default=1)
+    # Lines are edited in the order admin, so exports cannot treat them as
+    # append-only
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at']),
+        ]
 
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
     def get_cost(self):
         return self.price * self.quantity
+
+
+class CoPurchase(models.Model):
+    """How many orders contained both ``product`` and ``other``"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'other')
+        indexes = [
+            models.Index(fields=['product', '-count']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} + {self.other_id}: {self.count}"
+
+
+class ProductRecommendation(models.Model):
+    """Top co-purchased products for a product, best first"""
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name='recommendation'
+    )
+    related_ids = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Recommendations for {self.product_id}"
+
+
+class Watermark(models.Model):
+    """Progress marker for incremental batch jobs"""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.CharField(max_length=100, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+
+class StockReservation(models.Model):
+    """Stock held for a cart until ``expires_at`` (see ``store.inventory``)"""
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('cart', 'product')
+        indexes = [
+            # Active holds per product: WHERE product_id = ? AND expires_at > now
+            models.Index(fields=['product', 'expires_at']),
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for cart {self.cart_id}"
+
+
+class IdempotencyKey(models.Model):
+    """The response to the first request sent with a client's idempotency key
+
+    ``status_code`` stays empty while that request is still running (see
+    ``store.idempotency``).
+    """
+    owner = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    headers = models.JSONField(default=dict)
+    content = models.BinaryField(default=b'')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('owner', 'key')
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.key} for {self.owner}"
+
+
+class Job(models.Model):
+    """A unit of background work run by ``run_worker`` (see ``store.jobs``)"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField()
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers claim the oldest due jobs: WHERE status = 'queued' AND run_at <= now
+            models.Index(fields=['status', 'run_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.id} ({self.status})"
@@ -0,0 +1,151 @@
+"""
+Order placement.
+
+``place_order`` turns a user's cart into an order inside one
+transaction with a fixed number of queries however many lines the cart
+has: the cart is read once, stock for every line is taken with a single
+guarded ``UPDATE ... SET stock = stock - qty WHERE stock >= qty``, and
+the order items are written with one ``bulk_create``. If any line is
+short the update matches fewer rows than there are lines and the whole
+order is rolled back. Stock held for other carts (see
+``store.inventory``) does not count as in stock.
+
+The order's ``total_cost`` and ``item_count`` are stored on it at
+placement so order history never has to read the items to list orders;
+``refresh_order_totals`` recomputes them from the items in the database.
+Follow-up work such as the confirmation email is queued as a background
+job (see ``store.jobs``) rather than done in the request.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .inventory import OutOfStock, lock_products, release_cart, reserved_elsewhere
+from .jobs import enqueue
+from .models import CartItem, Order, OrderItem, Product
+from .featured import LOW_STOCK_THRESHOLD
+from .signals import cart_emptied, catalog_changed, stock_changed
+from .tasks import send_order_confirmation
+
+DEFAULT_BACKFILL_BATCH_SIZE = 1000
+
+
+class EmptyCart(Exception):
+    pass
+
+
+def _per_product(quantities):
+    """``CASE id WHEN ... THEN qty`` for a ``{product id: qty}`` mapping"""
+    return Case(
+        *[When(id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def crosses_catalog_threshold(before, taken):
+    """Whether taking ``taken`` from ``before`` changes version-cached catalog data
+
+    The facet index caches which products are in stock and the featured
+    set which are low on stock; any other sale leaves both valid.
+    """
+    after = before - taken
+    return after <= 0 or after <= LOW_STOCK_THRESHOLD < before
+
+
+def decrement_stock(quantities, cart_id=None, stock=None):
+    """Take ``{product id: qty}`` from stock in one statement, or raise ``OutOfStock``
+
+    Stock held by other carts' active reservations is left alone. Must run
+    inside a transaction, after ``lock_products``, so a short line undoes
+    the other lines and holds cannot change underneath the check. ``stock``
+    is the ``{product id: stock}`` that ``lock_products`` returned; the
+    catalog version is only bumped when a product crosses a threshold that
+    cached data depends on (always, without it).
+    """
+    now = timezone.now()
+    needed = _per_product(quantities)
+    products = Product.objects.filter(id__in=list(quantities)).alias(
+        reserved=reserved_elsewhere(cart_id, now)
+    )
+    updated = products.filter(stock__gte=needed + F('reserved')).update(
+        stock=F('stock') - needed, updated_at=now
+    )
+    if updated != len(quantities):
+        short = products.exclude(stock__gte=needed + F('reserved'))
+        raise OutOfStock(list(short))
+    # update() bypasses save() and its signals
+    if stock is None or any(
+        crosses_catalog_threshold(stock[product_id], taken) for product_id, taken in quantities.items()
+    ):
+        catalog_changed()
+    else:
+        stock_changed()
+
+
+def place_order(user, order):
+    """Save ``order`` for ``user`` with the contents of their cart
+
+    ``order`` is an unsaved ``Order`` carrying the shipping details. Prices
+    are taken from the products at checkout. Raises ``EmptyCart`` or
+    ``OutOfStock``; on either nothing is written.
+    """
+    with transaction.atomic():
+        items = list(CartItem.objects.filter(cart__user=user).select_related('cart', 'product'))
+        if not items:
+            raise EmptyCart()
+        cart = items[0].cart
+        quantities = {}
+        for item in items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        stock = lock_products(quantities)
+        decrement_stock(quantities, cart.pk, stock)
+
+        order.user = user
+        order.total_cost = sum((item.product.price * item.quantity for item in items), Decimal('0.00'))
+        order.item_count = sum(quantities.values())
+        order.save()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=item.product, price=item.product.price, quantity=item.quantity)
+            for item in items
+        ])
+        # One DELETE without per-line post_delete handlers, each of which
+        # would clear the cart summary again (a query per line on the
+        # database cache); it is cleared once here instead
+        CartItem.objects.filter(cart=cart)._raw_delete(CartItem.objects.db)
+        cart_emptied(cart)
+        release_cart(cart)
+        # Queued in the same transaction, so it exists exactly when the order does
+        enqueue(send_order_confirmation, {'order_id': order.id})
+    return order
+
+
+def refresh_order_totals(queryset=None, batch_size=DEFAULT_BACKFILL_BATCH_SIZE):
+    """Recompute ``total_cost`` and ``item_count`` from the order items
+
+    Runs one correlated ``UPDATE`` per ``batch_size`` orders, in primary
+    key order, so a large backfill never holds long locks. Returns the
+    number of orders updated.
+    """
+    queryset = Order.objects.all() if queryset is None else queryset
+    money = DecimalField(max_digits=12, decimal_places=2)
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    cost = items.annotate(total=Sum(F('price') * F('quantity'), output_field=money)).values('total')
+    count = items.annotate(total=Sum('quantity')).values('total')
+
+    total = 0
+    last_id = 0
+    while True:
+        ids = list(
+            queryset.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return total
+        # update() leaves updated_at alone: the order itself has not changed
+        total += Order.objects.filter(pk__in=ids).update(
+            total_cost=Coalesce(Subquery(cost), Value(0), output_field=money),
+            item_count=Coalesce(Subquery(count), Value(0)),
+        )
+        last_id = ids[-1]
@@ -0,0 +1,113 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by an opaque cursor holding the sort key of the row
+at the page boundary, so fetching page 500 costs the same as page 1 and
+no ``COUNT(*)`` is ever issued. Rows are ordered by ``(-created_at, id)``.
+"""
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(obj, direction):
+    payload = {'c': obj.created_at.isoformat(), 'i': obj.pk, 'd': direction}
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        created_at = datetime.fromisoformat(payload['c'])
+        pk = int(payload['i'])
+        direction = payload['d']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+    # Cursors only ever carry aware timestamps; naive ones can't be compared
+    if direction not in ('next', 'prev') or created_at.tzinfo is None:
+        raise InvalidCursor(cursor)
+    return created_at, pk, direction
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor(self.object_list[-1], 'next')
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0], 'prev')
+        return None
+
+
+class KeysetPaginator:
+    """Paginate a queryset on ``(-created_at, id)`` using opaque cursors"""
+
+    def __init__(self, queryset, page_size=None):
+        self.queryset = queryset
+        self.page_size = page_size or get_page_size()
+
+    def page(self, cursor=None):
+        size = self.page_size
+        if not cursor:
+            rows = list(self.queryset.order_by('-created_at', 'id')[:size + 1])
+            return KeysetPage(rows[:size], len(rows) > size, False)
+
+        created_at, pk, direction = decode_cursor(cursor)
+        if direction == 'next':
+            rows = list(
+                self.queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__gt=pk)
+                ).order_by('-created_at', 'id')[:size + 1]
+            )
+            return KeysetPage(rows[:size], len(rows) > size, True)
+
+        # Walk backwards in reverse order, then flip the page back around
+        rows = list(
+            self.queryset.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__lt=pk)
+            ).order_by('created_at', '-id')[:size + 1]
+        )
+        has_previous = len(rows) > size
+        return KeysetPage(rows[:size][::-1], True, has_previous)
+
+
+def get_page_size(request=None):
+    """Page size from ``?per_page=`` (capped) or ``STORE_PAGE_SIZE``"""
+    default = getattr(settings, 'STORE_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    if request is None:
+        return default
+    try:
+        per_page = int(request.GET.get('per_page', default))
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(per_page, getattr(settings, 'STORE_MAX_PAGE_SIZE', MAX_PAGE_SIZE)))
@@ -0,0 +1,153 @@
+"""
+Co-purchase recommendations.
+
+Pair counts of products bought together are accumulated offline in
+``CoPurchase`` by the ``build_recommendations`` command, and the top
+neighbours of each product are stored on ``ProductRecommendation`` so
+the product page can load them with a single ``IN`` query.
+"""
+from collections import Counter
+from itertools import combinations
+
+from django.conf import settings
+from django.db import transaction
+
+from .catalog_cache import bump_catalog_version, catalog_cache
+from .models import CoPurchase, OrderItem, Product, ProductRecommendation, Watermark
+
+WATERMARK_NAME = 'recommendations:last_order_id'
+
+DEFAULT_TOP_N = 8
+DEFAULT_RELATED_LIMIT = 4
+
+
+def get_top_n():
+    return getattr(settings, 'STORE_RECOMMENDATIONS_TOP_N', DEFAULT_TOP_N)
+
+
+def count_pairs(min_order_id=0, chunk_size=5000):
+    """Count co-purchased product pairs in orders after ``min_order_id``
+
+    Returns ``(pair counts, highest order id seen)``. Both directions of
+    each pair are counted so that lookups by either product are cheap.
+    """
+    pairs = Counter()
+    items = (
+        OrderItem.objects.filter(order_id__gt=min_order_id)
+        .exclude(order__status='cancelled')
+        .order_by('order_id')
+        .values_list('order_id', 'product_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    current_order = None
+    basket = set()
+    last_order_id = min_order_id
+    for order_id, product_id in items:
+        if order_id != current_order:
+            for a, b in combinations(sorted(basket), 2):
+                pairs[a, b] += 1
+                pairs[b, a] += 1
+            current_order, basket = order_id, set()
+            last_order_id = order_id
+        basket.add(product_id)
+    for a, b in combinations(sorted(basket), 2):
+        pairs[a, b] += 1
+        pairs[b, a] += 1
+    return pairs, last_order_id
+
+
+def store_pairs(pairs, replace=False, batch_size=1000):
+    """Add ``pairs`` to the stored counts; returns the affected product IDs"""
+    affected = {a for a, b in pairs}
+    if replace:
+        CoPurchase.objects.all().delete()
+        totals = pairs
+    else:
+        totals = Counter(pairs)
+        existing = CoPurchase.objects.filter(product_id__in=affected).values_list(
+            'product_id', 'other_id', 'count'
+        )
+        for a, b, count in existing.iterator(chunk_size=batch_size):
+            if (a, b) in pairs:
+                totals[a, b] += count
+    CoPurchase.objects.bulk_create(
+        [CoPurchase(product_id=a, other_id=b, count=count) for (a, b), count in totals.items()],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['product', 'other'],
+        update_fields=['count'],
+    )
+    return affected
+
+
+def refresh_top_n(product_ids, top_n=None, batch_size=1000):
+    """Recompute and store the top neighbours of ``product_ids``"""
+    top_n = top_n or get_top_n()
+    neighbours = {pk: [] for pk in product_ids}
+    rows = (
+        CoPurchase.objects.filter(product_id__in=neighbours)
+        .order_by('product_id', '-count', 'other_id')
+        .values_list('product_id', 'other_id')
+    )
+    for product_id, other_id in rows.iterator(chunk_size=batch_size):
+        if len(neighbours[product_id]) < top_n:
+            neighbours[product_id].append(other_id)
+    ProductRecommendation.objects.bulk_create(
+        [ProductRecommendation(product_id=pk, related_ids=ids) for pk, ids in neighbours.items()],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['product'],
+        update_fields=['related_ids', 'updated_at'],
+    )
+    return len(neighbours)
+
+
+def build_recommendations(full=False, top_n=None):
+    """Fold new orders into the co-purchase counts and refresh top-N lists
+
+    With ``full=True`` the counts are rebuilt from every order. Returns
+    ``(orders watermark, number of products refreshed)``.
+    """
+    with transaction.atomic():
+        watermark, created = Watermark.objects.select_for_update().get_or_create(
+            name=WATERMARK_NAME, defaults={'value': '0'}
+        )
+        since = 0 if full else int(watermark.value or 0)
+        pairs, last_order_id = count_pairs(since)
+        affected = store_pairs(pairs, replace=full)
+        if full:
+            ProductRecommendation.objects.all().delete()
+        refreshed = refresh_top_n(affected, top_n) if affected else 0
+        watermark.value = str(last_order_id)
+        watermark.save()
+    if refreshed:
+        # Product pages cache their related products
+        bump_catalog_version()
+    return last_order_id, refreshed
+
+
+def get_related_products(product, limit=DEFAULT_RELATED_LIMIT):
+    """Co-purchased products, topped up from the same category"""
+    try:
+        related_ids = [pk for pk in product.recommendation.related_ids if pk != product.pk]
+    except ProductRecommendation.DoesNotExist:
+        related_ids = []
+
+    related = []
+    if related_ids:
+        products = Product.objects.filter(id__in=related_ids, available=True).in_bulk()
+        related = [products[pk] for pk in related_ids if pk in products][:limit]
+
+    if len(related) < limit:
+        related.extend(
+            Product.objects.filter(category_id=product.category_id, available=True)
+            .exclude(id__in=[product.pk] + [p.pk for p in related])
+            .order_by('-created_at')[:limit - len(related)]
+        )
+    return related
+
+
+def get_cached_related_products(product, limit=DEFAULT_RELATED_LIMIT):
+    return catalog_cache.get_or_set(
+        f'related:{product.pk}:{limit}', lambda: get_related_products(product, limit)
+    )
@@ -0,0 +1,148 @@
+"""
+Product image renditions.
+
+Saving a product no longer touches its image: the uploaded original is
+kept as is, and resized copies are rendered from it off the request, by
+the job queue (``store.tasks.render_product_images``) or in bulk by
+``build_renditions``. Work is only queued when the image file changed,
+judged by the SHA-256 of its content, so saving a product for a stock or
+price change does no image work at all.
+
+``STORE_IMAGE_RENDITIONS`` maps a rendition name to the CSS width it is
+displayed at; each is rendered at every density in
+``STORE_IMAGE_DENSITIES`` and in every format in ``STORE_IMAGE_FORMATS``.
+Files are named after the content hash and pixel width, so they never go
+stale and products sharing a picture share the files. The storage names
+are recorded in ``Product.renditions`` as ``{name: {format: [[name, pixel
+width, density], ...]}}``, from which templates build ``srcset`` (see the
+``product_image`` template tag).
+"""
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .models import Product
+
+DEFAULT_RENDITIONS = {
+    'thumb': 60,
+    'card': 400,
+    'detail': 800,
+}
+
+DEFAULT_DENSITIES = (1, 2)
+
+DEFAULT_FORMATS = ('webp', 'jpeg')
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+QUALITY = {'webp': 80, 'jpeg': 85}
+
+RENDITIONS_DIR = 'renditions'
+
+
+def get_renditions():
+    return getattr(settings, 'STORE_IMAGE_RENDITIONS', DEFAULT_RENDITIONS)
+
+
+def get_densities():
+    return getattr(settings, 'STORE_IMAGE_DENSITIES', DEFAULT_DENSITIES)
+
+
+def get_formats():
+    return getattr(settings, 'STORE_IMAGE_FORMATS', DEFAULT_FORMATS)
+
+
+def hash_image(image):
+    """SHA-256 of an image field's file, read in chunks"""
+    digest = hashlib.sha256()
+    with image.open('rb'):
+        for chunk in image.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_updated(product):
+    """Record the hash of ``product``'s new image; True if renditions are needed
+
+    Called after a save that replaced the image file. Re-uploading the same
+    picture keeps the existing renditions.
+    """
+    digest = hash_image(product.image) if product.image else ''
+    if digest == product.image_hash:
+        return False
+    Product.objects.filter(pk=product.pk).update(image_hash=digest, renditions={})
+    product.image_hash, product.renditions = digest, {}
+    return bool(digest)
+
+
+def _encode(image, fmt):
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        # JPEG has no alpha channel: flatten onto white
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', image.size, 'white')
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt.upper(), quality=QUALITY[fmt], optimize=True)
+    return buffer.getvalue()
+
+
+def render(product):
+    """Render every rendition of ``product``'s image that is not stored yet
+
+    Returns the ``Product.renditions`` mapping. Never upscales: a rendition
+    wider than the original is served at the original's width.
+    """
+    storage = product.image.storage
+    with product.image.open('rb'):
+        original = ImageOps.exif_transpose(Image.open(product.image))
+        original.load()
+
+    renditions = {}
+    for name, width in get_renditions().items():
+        for fmt in get_formats():
+            entries = []
+            for density in get_densities():
+                pixels = min(width * density, original.width)
+                if entries and entries[-1][1] == pixels:
+                    continue
+                path = f'{RENDITIONS_DIR}/{product.image_hash[:2]}/{product.image_hash}/{pixels}.{fmt}'
+                if not storage.exists(path):
+                    height = max(1, round(original.height * pixels / original.width))
+                    resized = original.resize((pixels, height), Image.LANCZOS)
+                    path = storage.save(path, ContentFile(_encode(resized, fmt)))
+                entries.append([path, pixels, density])
+            renditions.setdefault(name, {})[fmt] = entries
+    return renditions
+
+
+def render_product(product_id, force=False):
+    """Render and record the renditions of one product; True if they were recorded
+
+    Products saved before renditions existed have no hash yet; it is taken
+    here. With ``force`` the hash is taken again and every rendition is
+    recorded afresh.
+    """
+    product = Product.objects.filter(pk=product_id).first()
+    if product is None or not product.image:
+        return False
+    if force or not product.image_hash:
+        product.image_hash = hash_image(product.image)
+        Product.objects.filter(pk=product.pk).update(image_hash=product.image_hash)
+    elif product.renditions:
+        return False
+    renditions = render(product)
+    # A newer upload may have replaced the image while this one rendered
+    current = Product.objects.filter(pk=product.pk, image_hash=product.image_hash)
+    return bool(current.update(renditions=renditions))
+
+
+def srcset(product, name, fmt):
+    """``srcset`` attribute value for one rendition of ``product``, or ''"""
+    storage = product.image.storage
+    entries = (product.renditions or {}).get(name, {}).get(fmt, [])
+    return ', '.join(f'{storage.url(path)} {density}x' for path, pixels, density in entries)
@@ -0,0 +1,320 @@
+"""
+In-process product search.
+
+Products are tokenized and stemmed into an inverted index over name,
+description and category name, and queries are ranked with BM25. The
+index is kept up to date incrementally from model signals in the process
+that made the change, and persisted to ``STORE_SEARCH_INDEX_PATH`` so
+worker processes load it from disk at boot instead of rebuilding it.
+Workers notice when another process has rewritten the file and reload it.
+
+Signals never write the file themselves: a change queues one
+``save_search_index`` job, run ``STORE_SEARCH_SAVE_DELAY`` seconds later,
+which rebuilds the index from the database and replaces the file. So a
+burst of saves costs one write, and no write is lost to two processes
+updating the file at once. ``build_search_index`` writes it directly.
+"""
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from .inventory import with_available
+from .jobs import enqueue
+from .models import Job, Product
+
+INDEX_FORMAT_VERSION = 1
+
+DEFAULT_SAVE_DELAY = 30
+
+SAVE_TASK = 'store.tasks.save_search_index'
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Term frequency multipliers per field
+FIELD_WEIGHTS = {
+    'name': 3,
+    'category': 2,
+    'description': 1,
+}
+
+STOP_WORDS = frozenset(
+    'a an and are as at be by for from has in is it its of on or that the '
+    'this to was were will with'.split()
+)
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def stem(word):
+    """Light suffix-stripping stemmer (plural and common verb endings)"""
+    if len(word) <= 3 or word.isdigit():
+        return word
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            # hopping -> hop
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+    if word.endswith('ly') and len(word) > 5:
+        word = word[:-2]
+    return word
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def document_terms(name, description, category_name):
+    terms = Counter()
+    for field, text in (('name', name), ('description', description), ('category', category_name)):
+        weight = FIELD_WEIGHTS[field]
+        for token in tokenize(text or ''):
+            terms[token] += weight
+    return dict(terms)
+
+
+class SearchIndex:
+    """Inverted index with BM25 scoring"""
+
+    def __init__(self):
+        self.docs = {}       # product id -> {term: weighted tf}
+        self.doc_len = {}    # product id -> document length
+        self.postings = {}   # term -> {product id: weighted tf}
+        self.total_len = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, terms):
+        """Index ``terms`` for ``doc_id``; returns False if nothing changed"""
+        with self.lock:
+            if self.docs.get(doc_id) == terms:
+                return False
+            self.remove(doc_id)
+            self.docs[doc_id] = terms
+            length = sum(terms.values())
+            self.doc_len[doc_id] = length
+            self.total_len += length
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+            return True
+
+    def remove(self, doc_id):
+        with self.lock:
+            terms = self.docs.pop(doc_id, None)
+            if terms is None:
+                return False
+            self.total_len -= self.doc_len.pop(doc_id)
+            for term in terms:
+                posting = self.postings[term]
+                del posting[doc_id]
+                if not posting:
+                    del self.postings[term]
+            return True
+
+    def search(self, query, limit=None):
+        """Return ``(product id, score)`` pairs for ``query``, best first"""
+        terms = set(tokenize(query))
+        with self.lock:
+            n = len(self.docs)
+            if not terms or not n:
+                return []
+            avgdl = self.total_len / n
+            scores = Counter()
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = K1 * (1 - B + B * self.doc_len[doc_id] / avgdl)
+                    scores[doc_id] += idf * tf * (K1 + 1) / (tf + norm)
+        if limit is None:
+            return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'version': INDEX_FORMAT_VERSION,
+                'docs': {str(doc_id): terms for doc_id, terms in self.docs.items()},
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != INDEX_FORMAT_VERSION:
+            raise ValueError('Unsupported search index format')
+        index = cls()
+        for doc_id, terms in data['docs'].items():
+            index.add(int(doc_id), terms)
+        return index
+
+
+def product_terms(product):
+    return document_terms(product.name, product.description, product.category.name)
+
+
+def build_index():
+    """Build a fresh index from every available product"""
+    index = SearchIndex()
+    products = (
+        Product.objects.filter(available=True)
+        .values_list('id', 'name', 'description', 'category__name')
+        .iterator(chunk_size=2000)
+    )
+    for doc_id, name, description, category_name in products:
+        index.add(doc_id, document_terms(name, description, category_name))
+    return index
+
+
+def get_index_path():
+    return getattr(
+        settings, 'STORE_SEARCH_INDEX_PATH',
+        os.path.join(settings.BASE_DIR, 'search_index.json')
+    )
+
+
+def save_index(index, path=None):
+    """Atomically write ``index`` to disk"""
+    path = path or get_index_path()
+    if not path:
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.search_index.')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(index.to_dict(), fh, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_index(path=None):
+    """Load the index from disk, or return None if it is missing or unreadable"""
+    path = path or get_index_path()
+    if not path:
+        return None
+    try:
+        with open(path) as fh:
+            return SearchIndex.from_dict(json.load(fh))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+
+def _disk_mtime():
+    path = get_index_path()
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_index():
+    """Return this process's index, loading or rebuilding it as needed"""
+    global _index, _index_mtime
+    mtime = _disk_mtime()
+    if _index is not None and mtime == _index_mtime:
+        return _index
+    with _index_lock:
+        mtime = _disk_mtime()
+        if _index is not None and mtime == _index_mtime:
+            return _index
+        index = load_index() if mtime is not None else None
+        if index is None:
+            index = build_index()
+            save_index(index)
+            mtime = _disk_mtime()
+        _index, _index_mtime = index, mtime
+        return _index
+
+
+def _persist(index):
+    global _index_mtime
+    save_index(index)
+    _index_mtime = _disk_mtime()
+
+
+def reset_index():
+    """Forget the in-process index (the next search reloads it)"""
+    global _index, _index_mtime
+    with _index_lock:
+        _index = _index_mtime = None
+
+
+def rebuild_index():
+    global _index
+    index = build_index()
+    with _index_lock:
+        _index = index
+        _persist(index)
+    return index
+
+
+def schedule_save():
+    """Queue a rebuild of the index file unless one is already waiting"""
+    if Job.objects.filter(task=SAVE_TASK, status=Job.QUEUED).exists():
+        return
+    # By name: store.tasks imports the signals, which import this module
+    enqueue(SAVE_TASK, delay=getattr(settings, 'STORE_SEARCH_SAVE_DELAY', DEFAULT_SAVE_DELAY))
+
+
+def index_product(product):
+    """Add, refresh or drop a single product after it was saved"""
+    index = get_index()
+    if product.available:
+        changed = index.add(product.pk, product_terms(product))
+    else:
+        changed = index.remove(product.pk)
+    if changed:
+        schedule_save()
+
+
+def unindex_product(product_id):
+    if get_index().remove(product_id):
+        schedule_save()
+
+
+def index_category(category):
+    """Re-index the products of a category after it was renamed"""
+    index = get_index()
+    changed = False
+    for product in category.products.filter(available=True).select_related('category'):
+        changed = index.add(product.pk, product_terms(product)) or changed
+    if changed:
+        schedule_save()
+
+
+def search_products(query, limit=None):
+    """Return available products matching ``query``, best match first"""
+    limit = limit or getattr(settings, 'STORE_SEARCH_LIMIT', 48)
+    ranked = [doc_id for doc_id, score in get_index().search(query, limit)]
+    if not ranked:
+        return []
+    products = with_available(Product.objects.filter(id__in=ranked, available=True)).in_bulk()
+    return [products[pk] for pk in ranked if pk in products]
@@ -0,0 +1,93 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import search
+from .cart import invalidate_cart_summary, merge_guest_cart
+from .catalog_cache import bump_catalog_version, bump_stock_version
+from .jobs import enqueue
+from .models import Cart, CartItem, Category, Product
+from .renditions import image_updated
+
+
+def catalog_changed():
+    # Bump now so this process sees its own write, and again after commit
+    # so other workers don't cache a snapshot taken mid-transaction.
+    bump_catalog_version()
+    transaction.on_commit(bump_catalog_version)
+
+
+def stock_changed():
+    """Like ``catalog_changed`` for stock moves that leave cached catalog data valid"""
+    bump_stock_version()
+    transaction.on_commit(bump_stock_version)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    """Refresh derived catalog data after a product is saved"""
+    catalog_changed()
+    if kwargs.get('raw'):
+        # loaddata bypasses save(); fixtures are indexed by build_search_index
+        return
+    transaction.on_commit(lambda: search.index_product(instance))
+    if getattr(instance, 'image_replaced', False) and image_updated(instance):
+        # By name: store.tasks imports this module
+        enqueue('store.tasks.render_product_images', {'product_id': instance.pk})
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    catalog_changed()
+    product_id = instance.pk
+    transaction.on_commit(lambda: search.unindex_product(product_id))
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    catalog_changed()
+    if not created:
+        transaction.on_commit(lambda: search.index_category(instance))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    catalog_changed()
+
+
+def cart_changed(item):
+    """Drop the cached summaries of the cart ``item`` belongs to"""
+    if CartItem.cart.is_cached(item):
+        item.cart._summary = None
+        user_id = item.cart.user_id
+    else:
+        user_id = Cart.objects.filter(pk=item.cart_id).values_list('user_id', flat=True).first()
+    if user_id is None:
+        return
+    invalidate_cart_summary(user_id)
+    transaction.on_commit(lambda: invalidate_cart_summary(user_id))
+
+
+def cart_emptied(cart):
+    """Drop the cached summaries of ``cart`` after its lines were deleted in bulk"""
+    cart._summary = None
+    user_id = cart.user_id
+    invalidate_cart_summary(user_id)
+    transaction.on_commit(lambda: invalidate_cart_summary(user_id))
+
+
+@receiver(post_save, sender=CartItem)
+def cart_item_saved(sender, instance, **kwargs):
+    cart_changed(instance)
+
+
+@receiver(post_delete, sender=CartItem)
+def cart_item_deleted(sender, instance, **kwargs):
+    cart_changed(instance)
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    if request is not None:
+        merge_guest_cart(request, user)
@@ -0,0 +1,38 @@
+"""
+Background tasks run by ``run_worker`` (see ``store.jobs``).
+"""
+from django.conf import settings
+from django.core.mail import send_mail
+from django.template.loader import render_to_string
+
+from . import search
+from .jobs import task
+from .models import Order
+from .renditions import render_product
+from .signals import catalog_changed
+
+
+@task
+def send_order_confirmation(order_id):
+    """Email the shopper a summary of their order"""
+    order = Order.objects.prefetch_related('items__product').get(pk=order_id)
+    send_mail(
+        f'Your ShopSphere order #{order.id}',
+        render_to_string('store/email/order_confirmation.txt', {'order': order}),
+        getattr(settings, 'DEFAULT_FROM_EMAIL', None),
+        [order.email],
+    )
+
+
+@task
+def render_product_images(product_id):
+    """Render the image renditions of a product whose image changed"""
+    if render_product(product_id):
+        # update() sends no signals; cached products carry the renditions
+        catalog_changed()
+
+
+@task
+def save_search_index():
+    """Rebuild the search index from the database and write it to disk"""
+    search.rebuild_index()
@@ -0,0 +1,36 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from ..renditions import CONTENT_TYPES, srcset
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_image(product, name, **attrs):
+    """``<picture>`` for one rendition of ``product``'s image, with ``srcset`` per format
+
+    Falls back to the original image until its renditions are rendered.
+    Extra keyword arguments become attributes of the ``<img>``.
+    """
+    attrs.setdefault('alt', product.name)
+    renditions = (product.renditions or {}).get(name)
+    if not renditions:
+        attributes = format_html_join(' ', '{}="{}"', attrs.items())
+        return format_html('<img src="{}" {}>', product.image.url, attributes)
+
+    attrs.setdefault('loading', 'lazy')
+    attributes = format_html_join(' ', '{}="{}"', attrs.items())
+    # Browsers take the first <source> they support; the <img> is JPEG
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}">',
+        ((CONTENT_TYPES[fmt], srcset(product, name, fmt)) for fmt in renditions if fmt != 'jpeg'),
+    )
+    fallback = renditions.get('jpeg') or next(iter(renditions.values()))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" {}></picture>',
+        sources,
+        product.image.storage.url(fallback[0][0]),
+        srcset(product, name, 'jpeg' if 'jpeg' in renditions else next(iter(renditions))),
+        attributes,
+    )
@@ -1,8 +1,68 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.http import Http404
+from django.db.models import QuerySet, Sum
+from django.db import OperationalError, connection, connections as db_connections
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from datetime import timedelta
 from decimal import Decimal
+from unittest import mock
+import base64
+import csv
+import io
+import gzip
+import hashlib
+import json
 from .models import Category, Product, Cart, CartItem, Order, OrderItem
+from .featured import get_featured_product_ids, get_featured_products
+from .pagination import KeysetPaginator
+from . import search
+from .cart import get_user_cart_summary
+from .catalog_cache import CatalogCache, LRUCache, get_catalog_version, get_categories, get_stock_version
+from .exports import run_export, split_ranges
+from .facets import get_facet_index
+from .inventory import available_to_sell, reserve_cart
+from . import jobs
+from .orders import EmptyCart, OutOfStock, place_order, refresh_order_totals
+from .models import IdempotencyKey, Job, ProductRecommendation, StockReservation, Watermark
+from .recommendations import build_recommendations, get_related_products
+from .templatetags.store_images import product_image
+from . import media, media_sync, thumbnails
+from .media_views import serve_media
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+_search_index_override = None
+
+
+def setUpModule():
+    # Signals and get_index() may write the search index; keep it away
+    # from the developer's real file
+    global _search_index_override
+    directory = tempfile.mkdtemp()
+    _search_index_override = override_settings(
+        STORE_SEARCH_INDEX_PATH=os.path.join(directory, 'search_index.json')
+    )
+    _search_index_override.enable()
+    search.reset_index()
+
+
+def tearDownModule():
+    shutil.rmtree(os.path.dirname(settings.STORE_SEARCH_INDEX_PATH), ignore_errors=True)
+    _search_index_override.disable()
+    search.reset_index()
 
 
 class ModelTestCase(TestCase):
@@ -97,12 +157,17 @@ class ViewTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Test Product')
 
-    def test_cart_view_requires_login(self):
+    def test_guest_cart_view(self):
         response = self.client.get(reverse('store:cart_detail'))
-        self.assertEqual(response.status_code, 302)  # Redirect to login
+        self.assertEqual(response.status_code, 200)
 
-    def test_add_to_cart_requires_login(self):
+    def test_add_to_cart_as_guest(self):
         response = self.client.post(reverse('store:add_to_cart', args=[self.product.id]))
+        self.assertEqual(response.status_code, 302)  # Redirect after adding
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_checkout_requires_login(self):
+        response = self.client.get(reverse('store:checkout'))
         self.assertEqual(response.status_code, 302)  # Redirect to login
 
     def test_authenticated_cart_view(self):
@@ -121,6 +186,1996 @@ class ViewTestCase(TestCase):
         self.assertEqual(cart.items.first().product, self.product)
 
 
+@override_settings(STORE_FEATURED_PRODUCTS=['coffee', 'bread'], STORE_FEATURED_LIMIT=3)
+class FeaturedProductsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Groceries', slug='groceries')
+        self.bread = Product.objects.create(
+            name='Bread', slug='bread', category=self.category,
+            description='Bread', price=Decimal('3.49'), stock=40
+        )
+        self.coffee = Product.objects.create(
+            name='Coffee', slug='coffee', category=self.category,
+            description='Coffee', price=Decimal('12.99'), stock=40
+        )
+        self.popular = Product.objects.create(
+            name='Popular', slug='popular', category=self.category,
+            description='Popular', price=Decimal('50.00'), stock=5
+        )
+
+    def test_configured_products_come_first_in_order(self):
+        self.assertEqual(
+            get_featured_product_ids(),
+            [self.coffee.id, self.bread.id, self.popular.id]
+        )
+
+    def test_featured_ids_are_cached(self):
+        get_featured_product_ids()
+        with self.assertNumQueries(0):
+            get_featured_product_ids()
+        with self.assertNumQueries(1):
+            products = get_featured_products()
+        self.assertEqual(products, [self.coffee, self.bread, self.popular])
+
+    def test_product_save_rebuilds_featured_set(self):
+        get_featured_product_ids()
+        self.coffee.available = False
+        self.coffee.save()
+        self.assertEqual(get_featured_product_ids(), [self.bread.id, self.popular.id])
+
+    def test_product_delete_rebuilds_featured_set(self):
+        get_featured_product_ids()
+        self.popular.delete()
+        self.assertEqual(get_featured_product_ids(), [self.coffee.id, self.bread.id])
+
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.products = [
+            Product.objects.create(
+                name=f'Book {i}', slug=f'book-{i}', category=self.category,
+                description='A book', price=Decimal('10.00'), stock=5
+            )
+            for i in range(5)
+        ]
+        # Force a tie on created_at so the id tiebreaker is exercised
+        Product.objects.filter(pk__in=[p.pk for p in self.products[1:3]]).update(
+            created_at=self.products[1].created_at
+        )
+        self.expected = list(Product.objects.order_by('-created_at', 'id'))
+
+    def test_walk_forward_and_back(self):
+        paginator = KeysetPaginator(Product.objects.all(), page_size=2)
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(pages[-1].next_cursor))
+        self.assertEqual([p for page in pages for p in page], self.expected)
+        self.assertFalse(pages[0].has_previous)
+
+        previous = paginator.page(pages[-1].previous_cursor)
+        self.assertEqual(previous.object_list, pages[-2].object_list)
+        first = paginator.page(pages[1].previous_cursor)
+        self.assertEqual(first.object_list, pages[0].object_list)
+        self.assertFalse(first.has_previous)
+
+    def test_product_list_pages_without_count(self):
+        url = reverse('store:product_list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'per_page': 2})
+        self.assertFalse(any('COUNT(' in q['sql'] for q in queries.captured_queries))
+        self.assertEqual(list(response.context['products']), self.expected[:2])
+
+        cursor = response.context['page'].next_cursor
+        response = self.client.get(url, {'per_page': 2, 'cursor': cursor})
+        self.assertEqual(list(response.context['products']), self.expected[2:4])
+
+    def test_category_page_uses_paginator(self):
+        url = reverse('store:product_list_by_category', args=[self.category.slug])
+        response = self.client.get(url, {'per_page': 3})
+        self.assertEqual(list(response.context['products']), self.expected[:3])
+        self.assertTrue(response.context['page'].has_next)
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(reverse('store:product_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_naive_cursor_returns_404(self):
+        payload = json.dumps({'c': '2024-01-01T00:00:00', 'i': 1, 'd': 'next'}).encode()
+        cursor = base64.urlsafe_b64encode(payload).decode().rstrip('=')
+        response = self.client.get(reverse('store:product_list'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 404)
+
+
+class CatalogCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Books', slug='books')
+
+    def test_lru_evicts_least_recently_used(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 2)
+
+    def test_tiers_and_counters(self):
+        worker_a = CatalogCache(version_ttl=0)
+        worker_b = CatalogCache(version_ttl=0)
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return 'value'
+
+        self.assertEqual(worker_a.get_or_set('key', loader), 'value')
+        self.assertEqual(worker_a.get_or_set('key', loader), 'value')
+        self.assertEqual(worker_b.get_or_set('key', loader), 'value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(worker_a.stats()['local_hits'], 1)
+        self.assertEqual(worker_a.stats()['misses'], 1)
+        self.assertEqual(worker_b.stats()['shared_hits'], 1)
+        self.assertEqual(worker_a.stats()['hit_rate'], 0.5)
+
+    def test_version_bump_invalidates_every_worker(self):
+        worker_a = CatalogCache(version_ttl=0)
+        worker_b = CatalogCache(version_ttl=0)
+        worker_a.get_or_set('key', lambda: 'old')
+        worker_b.get_or_set('key', lambda: 'old')
+        worker_a.bump()
+        self.assertEqual(worker_b.get_or_set('key', lambda: 'new'), 'new')
+
+    def test_category_changes_refresh_cached_categories(self):
+        self.assertEqual(get_categories(), [self.category])
+        with self.assertNumQueries(0):
+            get_categories()
+        toys = Category.objects.create(name='Toys', slug='toys')
+        self.assertEqual(get_categories(), [self.category, toys])
+        toys.delete()
+        self.assertEqual(get_categories(), [self.category])
+
+
+class FacetTestCase(TestCase):
+    def setUp(self):
+        self.books = Category.objects.create(name='Books', slug='books')
+        self.toys = Category.objects.create(name='Toys', slug='toys')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.books,
+            description='A novel', price=Decimal('14.99'), stock=3
+        )
+        self.handbook = Product.objects.create(
+            name='Handbook', slug='handbook', category=self.books,
+            description='A handbook', price=Decimal('44.99'), stock=0
+        )
+        self.blocks = Product.objects.create(
+            name='Blocks', slug='blocks', category=self.toys,
+            description='Building blocks', price=Decimal('34.99'), stock=8
+        )
+
+    def test_counts_are_disjunctive_per_facet(self):
+        facets = get_facet_index()
+        selected = {'category': {'books'}, 'price': {'25-50'}}
+        counts = facets.counts(selected)
+        # Category counts ignore the category filter but honour the price filter
+        self.assertEqual(counts['category'], {'books': 1, 'toys': 1})
+        self.assertEqual(counts['price']['0-25'], 1)
+        self.assertEqual(counts['price']['25-50'], 1)
+        self.assertEqual(counts['stock']['in'], 0)
+
+    def test_match_combines_filters(self):
+        facets = get_facet_index()
+        page = facets.page({'price': {'25-50'}, 'stock': {'in'}})
+        self.assertEqual(page.object_list, [self.blocks])
+
+    def test_index_follows_product_changes(self):
+        self.assertEqual(get_facet_index().counts({})['stock']['in'], 2)
+        self.handbook.stock = 5
+        self.handbook.save()
+        self.assertEqual(get_facet_index().counts({})['stock']['in'], 3)
+
+    def test_product_list_filters_with_one_product_query(self):
+        get_facet_index()
+        url = reverse('store:product_list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'price': '25-50', 'in_stock': '1'})
+        product_queries = [q for q in queries.captured_queries if 'store_product' in q['sql']]
+        self.assertEqual(len(product_queries), 1)
+        self.assertEqual(list(response.context['products']), [self.blocks])
+        self.assertEqual(response.context['in_stock_count'], 1)
+
+    def test_category_page_counts(self):
+        url = reverse('store:product_list_by_category', args=['books'])
+        response = self.client.get(url)
+        self.assertEqual(set(response.context['products']), {self.novel, self.handbook})
+        counts = dict((cat.slug, count) for cat, count in response.context['category_facets'])
+        self.assertEqual(counts, {'books': 2, 'toys': 1})
+
+
+class RecommendationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        self.groceries = Category.objects.create(name='Groceries', slug='groceries')
+        self.kitchen = Category.objects.create(name='Kitchen', slug='kitchen')
+        self.coffee = self.make_product('Coffee', self.groceries)
+        self.bread = self.make_product('Bread', self.groceries)
+        self.milk = self.make_product('Milk', self.groceries)
+        self.grinder = self.make_product('Grinder', self.kitchen)
+        self.mug = self.make_product('Mug', self.kitchen)
+
+    def make_product(self, name, category):
+        return Product.objects.create(
+            name=name, slug=name.lower(), category=category,
+            description=name, price=Decimal('5.00'), stock=10
+        )
+
+    def place_order(self, *products):
+        order = Order.objects.create(
+            user=self.user, first_name='A', last_name='B', email='a@example.com',
+            address='1 Street', postal_code='12345', city='Town'
+        )
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, price=product.price)
+        return order
+
+    def test_top_neighbours_ranked_by_co_occurrence(self):
+        self.place_order(self.coffee, self.grinder, self.mug)
+        self.place_order(self.coffee, self.grinder)
+        build_recommendations()
+        self.assertEqual(
+            ProductRecommendation.objects.get(product=self.coffee).related_ids,
+            [self.grinder.id, self.mug.id]
+        )
+
+    def test_incremental_refresh_only_reads_new_orders(self):
+        self.place_order(self.coffee, self.mug)
+        last_order_id, refreshed = build_recommendations()
+        self.assertEqual(refreshed, 2)
+
+        self.place_order(self.coffee, self.grinder)
+        self.place_order(self.coffee, self.grinder)
+        build_recommendations()
+        self.assertEqual(
+            ProductRecommendation.objects.get(product=self.coffee).related_ids,
+            [self.grinder.id, self.mug.id]
+        )
+        self.assertEqual(build_recommendations()[1], 0)
+
+    def test_related_products_fall_back_to_category(self):
+        self.place_order(self.coffee, self.grinder)
+        build_recommendations()
+        product = Product.objects.select_related('recommendation').get(pk=self.coffee.pk)
+        related = get_related_products(product)
+        self.assertEqual(related[0], self.grinder)
+        self.assertEqual(set(related[1:]), {self.bread, self.milk})
+        self.assertNotIn(self.coffee, related)
+
+    def test_product_detail_reads_recommendations_with_one_query(self):
+        self.place_order(self.coffee, self.grinder, self.mug, self.bread, self.milk)
+        build_recommendations()
+        url = reverse('store:product_detail', args=[self.coffee.slug])
+        # Product, related products and the live stock figure
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['related_products']), 4)
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.product = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=3
+        )
+        self.urls = [
+            reverse('store:home'),
+            reverse('store:product_list'),
+            reverse('store:product_list_by_category', args=['books']),
+            reverse('store:product_detail', args=['novel']),
+        ]
+
+    def test_matching_etag_returns_304(self):
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('ETag'))
+            self.assertFalse(response.has_header('Last-Modified'))
+            response = self.client.get(url, headers={'If-None-Match': response['ETag']})
+            self.assertEqual(response.status_code, 304, url)
+
+    def test_if_modified_since_alone_never_returns_304(self):
+        # A date cannot tell that stock or the cart moved since
+        since = http_date(time.time() + 3600)
+        for url in self.urls:
+            response = self.client.get(url, headers={'If-Modified-Since': since})
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_anonymous_304_costs_no_queries(self):
+        url = reverse('store:product_detail', args=['novel'])
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_signed_in_304_uses_cached_cart_summary(self):
+        self.client.login(username='shopper', password='testpass123')
+        url = reverse('store:product_list')
+        etag = self.client.get(url)['ETag']
+        # Session and user lookups only; the cart summary is cached
+        with self.assertNumQueries(2):
+            response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_product_change_invalidates_etag(self):
+        url = reverse('store:product_list')
+        etag = self.client.get(url)['ETag']
+        self.product.price = Decimal('9.99')
+        self.product.save()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_varies_with_query_string(self):
+        url = reverse('store:product_list')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, {'in_stock': '1'}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_varies_with_cart(self):
+        self.client.login(username='shopper', password='testpass123')
+        url = reverse('store:home')
+        etag = self.client.get(url)['ETag']
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class CartSummaryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=5
+        )
+        self.atlas = Product.objects.create(
+            name='Atlas', slug='atlas', category=self.category,
+            description='An atlas', price=Decimal('30.10'), stock=5
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.novel, quantity=3)
+        CartItem.objects.create(cart=self.cart, product=self.atlas, quantity=1)
+
+    def test_totals_use_one_query(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.get_total_price(), Decimal('75.07'))
+            self.assertEqual(cart.get_total_items(), 4)
+
+    def test_item_change_clears_memoized_totals(self):
+        self.assertEqual(self.cart.get_total_items(), 4)
+        CartItem.objects.create(cart=self.cart, product=Product.objects.create(
+            name='Map', slug='map', category=self.category,
+            description='A map', price=Decimal('5.00'), stock=5
+        ))
+        self.assertEqual(self.cart.get_total_items(), 5)
+
+    def test_summary_cached_until_cart_changes(self):
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 4)
+        CartItem.objects.filter(product=self.atlas).delete()
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 3)
+
+    def test_price_change_refreshes_summary(self):
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_price'], Decimal('75.07'))
+        self.novel.price = Decimal('10.00')
+        self.novel.save()
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_price'], Decimal('60.10'))
+
+    def test_navbar_badge(self):
+        self.client.login(username='shopper', password='testpass123')
+        response = self.client.post(reverse('store:add_to_cart', args=[self.novel.id]))
+        response = self.client.get(reverse('store:cart_detail'))
+        self.assertContains(response, '<span class="cart-badge">5</span>', html=True)
+
+
+class GuestCartTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=5
+        )
+        self.atlas = Product.objects.create(
+            name='Atlas', slug='atlas', category=self.category,
+            description='An atlas', price=Decimal('30.10'), stock=5
+        )
+
+    def add(self, product, times=1):
+        for _ in range(times):
+            self.client.post(reverse('store:add_to_cart', args=[product.id]))
+
+    def log_in(self):
+        return self.client.post(reverse('store:login'), {
+            'username': 'shopper', 'password': 'testpass123',
+        })
+
+    def test_guest_cart_lives_in_session(self):
+        self.add(self.novel, 2)
+        self.add(self.atlas)
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual(self.client.session['cart'], {str(self.novel.id): 2, str(self.atlas.id): 1})
+
+        response = self.client.get(reverse('store:cart_detail'))
+        self.assertContains(response, '<span class="cart-badge">3</span>', html=True)
+        self.assertEqual(response.context['cart'].get_total_price(), Decimal('60.08'))
+
+    def test_update_and_remove_guest_items(self):
+        self.add(self.novel)
+        self.add(self.atlas)
+        self.client.post(reverse('store:update_cart', args=[self.novel.id]), {'quantity': 4})
+        self.client.post(reverse('store:remove_from_cart', args=[self.atlas.id]))
+        self.assertEqual(self.client.session['cart'], {str(self.novel.id): 4})
+
+    def test_login_merges_guest_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.novel, quantity=1)
+        self.add(self.novel, 2)
+        self.add(self.atlas)
+
+        self.log_in()
+        quantities = dict(cart.items.values_list('product__slug', 'quantity'))
+        self.assertEqual(quantities, {'novel': 3, 'atlas': 1})
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 4)
+
+    def test_merge_skips_deleted_products(self):
+        self.add(self.novel)
+        self.add(self.atlas)
+        self.atlas.delete()
+        self.log_in()
+        self.assertEqual(list(CartItem.objects.values_list('product', flat=True)), [self.novel.id])
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_signed_cookie_sessions(self):
+        self.add(self.novel, 2)
+        response = self.client.get(reverse('store:cart_detail'))
+        self.assertContains(response, '<span class="cart-badge">2</span>', html=True)
+
+        self.log_in()
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 2)
+
+
+class CartMutationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=5
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_add_is_one_upsert(self):
+        url = reverse('store:add_to_cart', args=[self.novel.id])
+        self.client.post(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url)
+        cart_writes = [q['sql'] for q in queries if 'store_cartitem' in q['sql']]
+        self.assertEqual(len(cart_writes), 1)
+        self.assertIn('ON CONFLICT', cart_writes[0])
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 2)
+
+    def test_add_creates_missing_cart(self):
+        self.cart.delete()
+        self.client.post(reverse('store:add_to_cart', args=[self.novel.id]))
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 1)
+
+    def test_update_and_remove(self):
+        url = reverse('store:update_cart', args=[self.novel.id])
+        self.client.post(url, {'quantity': 3})
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 3)
+        self.client.post(url, {'quantity': 1})
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 1)
+        self.client.post(url, {'quantity': 0})
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_badge_follows_mutations(self):
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 0)
+        self.client.post(reverse('store:add_to_cart', args=[self.novel.id]))
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 1)
+        self.client.post(reverse('store:update_cart', args=[self.novel.id]), {'quantity': 4})
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 4)
+
+
+class BatchCartUpdateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.products = [
+            Product.objects.create(
+                name=f'Book {i}', slug=f'book-{i}', category=self.category,
+                description='A book', price=Decimal('10.00') + i, stock=20
+            )
+            for i in range(6)
+        ]
+        self.cart = Cart.objects.create(user=self.user)
+        for product in self.products[:3]:
+            CartItem.objects.create(cart=self.cart, product=product, quantity=1)
+        self.url = reverse('store:update_cart_batch')
+
+    def post_json(self, items):
+        return self.client.post(self.url, json.dumps({'items': items}), content_type='application/json')
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_json_batch(self):
+        self.client.force_login(self.user)
+        p = self.products
+        response = self.post_json({p[0].id: 4, p[1].id: 0, p[3].id: 2, 999999: 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {p[0].id: 4, p[2].id: 1, p[3].id: 2})
+
+        data = response.json()
+        self.assertEqual(data['cart_total'], 7)
+        self.assertEqual(data['total_price'], '78.00')
+        self.assertEqual(data['items'][str(p[0].id)], {'quantity': 4, 'total_price': '40.00'})
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 7)
+
+    def test_queries_do_not_grow_with_batch_size(self):
+        self.client.force_login(self.user)
+        p = self.products
+        with CaptureQueriesContext(connection) as small:
+            self.post_json({p[0].id: 2, p[3].id: 1})
+        with CaptureQueriesContext(connection) as large:
+            self.post_json({p[0].id: 3, p[1].id: 5, p[2].id: 2, p[4].id: 1, p[5].id: 1})
+        self.assertEqual(len(small), len(large))
+
+    def test_form_batch_redirects(self):
+        self.client.force_login(self.user)
+        p = self.products
+        response = self.client.post(self.url, {f'quantity-{p[0].id}': '3', f'quantity-{p[2].id}': '0'})
+        self.assertRedirects(response, reverse('store:cart_detail'))
+        self.assertEqual(self.quantities(), {p[0].id: 3, p[1].id: 1})
+
+    def test_guest_batch(self):
+        p = self.products
+        self.client.post(reverse('store:add_to_cart', args=[p[0].id]))
+        data = self.post_json({p[0].id: 0, p[4].id: 2}).json()
+        self.assertEqual(self.client.session['cart'], {str(p[4].id): 2})
+        self.assertEqual(data['total_price'], '28.00')
+
+    def test_invalid_payload(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.post_json({self.products[0].id: -1}).status_code, 400)
+        self.assertEqual(self.post_json({self.products[0].id: 'many'}).status_code, 400)
+        response = self.client.post(self.url, 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncApiTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=5
+        )
+
+    async def test_product_detail(self):
+        response = await self.async_client.get(reverse('store:api_product_detail', args=['novel']))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['price'], '14.99')
+        self.assertEqual(data['category'], 'books')
+        response = await self.async_client.get(reverse('store:api_product_detail', args=['missing']))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_add_for_signed_in_user(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse('store:api_cart_add', args=[self.novel.id])
+        await self.async_client.post(url)
+        response = await self.async_client.post(url)
+        self.assertEqual(response.json()['cart_total'], 2)
+        self.assertEqual(response.json()['total_price'], '29.98')
+        item = await CartItem.objects.aget(cart__user=self.user)
+        self.assertEqual(item.quantity, 2)
+
+        response = await self.async_client.get(reverse('store:api_cart'))
+        self.assertEqual(response.json(), {'lines': 1, 'total_items': 2, 'total_price': '29.98'})
+
+    def test_add_for_guest_and_unknown_product(self):
+        response = self.client.post(reverse('store:api_cart_add', args=[self.novel.id]))
+        self.assertEqual(response.json()['cart_total'], 1)
+        self.assertEqual(self.client.session['cart'], {str(self.novel.id): 1})
+        response = self.client.post(reverse('store:api_cart_add', args=[999999]))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse('store:api_cart_add', args=[self.novel.id])).status_code, 405)
+
+
+class CheckoutTestCase(TestCase):
+    shipping = {
+        'first_name': 'Ada', 'last_name': 'Lovelace', 'email': 'ada@example.com',
+        'address': '1 Street', 'postal_code': '12345', 'city': 'London',
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, lines, quantity=2, stock=10):
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Book {i}', slug=f'book-{lines}-{i}', category=self.category,
+                description='A book', price=Decimal('5.00'), stock=stock
+            )
+            for i in range(lines)
+        ])
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.cart, product=product, quantity=quantity) for product in products
+        ])
+        return products
+
+    def new_order(self):
+        return Order(**self.shipping)
+
+    def test_places_order(self):
+        products = self.fill_cart(3)
+        order = place_order(self.user, self.new_order())
+        self.assertEqual(order.items.count(), 3)
+        self.assertEqual(order.get_total_cost(), Decimal('30.00'))
+        self.assertEqual(order.item_count, 6)
+        self.assertEqual(
+            set(Product.objects.filter(id__in=[p.id for p in products]).values_list('stock', flat=True)), {8}
+        )
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(get_user_cart_summary(self.user.pk)['total_items'], 0)
+
+    def test_query_count_is_constant(self):
+        self.fill_cart(5)
+        with CaptureQueriesContext(connection) as small:
+            place_order(self.user, self.new_order())
+        self.fill_cart(50)
+        with CaptureQueriesContext(connection) as large:
+            place_order(self.user, self.new_order())
+        self.assertEqual(len(small), len(large))
+        # Includes queueing the confirmation email job
+        self.assertLessEqual(len(large), 11)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_cache_table',
+    }})
+    def test_query_count_is_constant_on_the_database_cache(self):
+        call_command('createcachetable', verbosity=0)
+        self.fill_cart(5)
+        with CaptureQueriesContext(connection) as small, self.captureOnCommitCallbacks(execute=True):
+            place_order(self.user, self.new_order())
+        self.fill_cart(50)
+        with CaptureQueriesContext(connection) as large, self.captureOnCommitCallbacks(execute=True):
+            place_order(self.user, self.new_order())
+        self.assertEqual(len(small), len(large))
+
+    def test_short_line_rolls_back_order(self):
+        products = self.fill_cart(3)
+        Product.objects.filter(id=products[1].id).update(stock=1)
+        with self.assertRaises(OutOfStock) as raised:
+            place_order(self.user, self.new_order())
+        self.assertEqual([p.id for p in raised.exception.products], [products[1].id])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 3)
+        self.assertEqual(Product.objects.get(id=products[0].id).stock, 10)
+
+    def test_empty_cart(self):
+        with self.assertRaises(EmptyCart):
+            place_order(self.user, self.new_order())
+
+    def test_ordinary_sale_keeps_catalog_caches(self):
+        product, = self.fill_cart(1, quantity=2, stock=50)
+        url = reverse('store:product_detail', args=[product.slug])
+        response = self.client.get(url)
+        self.assertContains(response, '50 in stock')
+        version, etag = get_catalog_version(), response['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            place_order(self.user, self.new_order())
+        self.assertEqual(get_catalog_version(), version)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '48 in stock')
+
+    def test_selling_out_or_running_low_bumps_catalog_version(self):
+        for lines, stock, quantity in ((1, 2, 2), (2, 21, 1)):
+            self.fill_cart(lines, quantity=quantity, stock=stock)
+            version = get_catalog_version()
+            place_order(self.user, self.new_order())
+            self.assertNotEqual(get_catalog_version(), version, (stock, quantity))
+
+    def test_checkout_view(self):
+        self.fill_cart(2, stock=1)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('store:checkout'), self.shipping)
+        self.assertRedirects(response, reverse('store:cart_detail'))
+        self.assertFalse(Order.objects.exists())
+
+        CartItem.objects.update(quantity=1)
+        response = self.client.post(reverse('store:checkout'), self.shipping)
+        order = Order.objects.get()
+        self.assertRedirects(response, reverse('store:order_detail', args=[order.id]))
+        self.assertEqual(order.user, self.user)
+
+
+class OrderHistoryTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass123')
+        category = Category.objects.create(name='Books', slug='books')
+        self.products = [
+            Product.objects.create(
+                name=f'Book {i}', slug=f'book-{i}', category=category,
+                description='A book', price=Decimal('4.50'), stock=100
+            )
+            for i in range(3)
+        ]
+        self.client.force_login(self.user)
+
+    def make_orders(self, count):
+        orders = Order.objects.bulk_create([
+            Order(
+                user=self.user, first_name='A', last_name='B', email='a@example.com',
+                address='1 Street', postal_code='12345', city='Town'
+            )
+            for _ in range(count)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=2)
+            for order in orders for product in self.products
+        ])
+        return orders
+
+    def test_history_query_count_is_constant(self):
+        url = reverse('store:order_history')
+        self.make_orders(5)
+        refresh_order_totals()
+        # Warm the per-user cart summary cache shared by both requests
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url, {'per_page': 100})
+        self.make_orders(195)
+        refresh_order_totals()
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(url, {'per_page': 100})
+        self.assertEqual(len(small), len(large))
+        self.assertFalse(any('COUNT(' in q['sql'] for q in large.captured_queries))
+        self.assertContains(response, '$27.00', count=100)
+
+    def test_json_pages_follow_next_links(self):
+        self.make_orders(25)
+        expected = list(Order.objects.order_by('-created_at', 'id').values_list('id', flat=True))
+        url = reverse('store:order_history') + '?format=json&per_page=10'
+        seen = []
+        while url:
+            data = self.client.get(url).json()
+            seen.extend(order['id'] for order in data['orders'])
+            url = data['next']
+        self.assertEqual(seen, expected)
+
+    def test_filters(self):
+        old, shipped, recent = self.make_orders(3)
+        Order.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=40))
+        Order.objects.filter(pk=shipped.pk).update(status='shipped')
+        url = reverse('store:order_history')
+
+        def ids(**params):
+            data = self.client.get(url, {'format': 'json', **params}).json()
+            return {order['id'] for order in data['orders']}
+
+        self.assertEqual(ids(status='shipped'), {shipped.id})
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.assertEqual(ids(date_from=since), {shipped.id, recent.id})
+        self.assertEqual(ids(date_to=since), {old.id})
+        response = self.client.get(url, {'status': 'shipped'})
+        self.assertEqual(list(response.context['orders']), [shipped])
+
+    def test_invalid_filters_and_cursor(self):
+        url = reverse('store:order_history')
+        self.assertEqual(self.client.get(url, {'format': 'json', 'date_from': 'soon'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'format': 'json', 'cursor': 'bogus'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': 'bogus'}).status_code, 404)
+        response = self.client.get(url, {'status': 'lost'})
+        self.assertContains(response, 'No matching orders')
+
+    def test_detail_query_count_is_constant(self):
+        order = self.make_orders(1)[0]
+        self.client.get(reverse('store:order_detail', args=[order.id]))
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(reverse('store:order_detail', args=[order.id]))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price) for product in self.products * 5
+        ])
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(reverse('store:order_detail', args=[order.id]))
+        self.assertEqual(len(small), len(large))
+
+    def test_backfill_command(self):
+        orders = self.make_orders(3)
+        updated_at = Order.objects.get(pk=orders[0].pk).updated_at
+        out = io.StringIO()
+        call_command('backfill_order_totals', '--batch-size', '2', stdout=out)
+        self.assertIn('Updated totals for 3 orders', out.getvalue())
+        self.assertEqual(
+            set(Order.objects.values_list('total_cost', 'item_count')), {(Decimal('27.00'), 6)}
+        )
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).updated_at, updated_at)
+
+        # Only orders still missing totals are picked up unless --all is given
+        OrderItem.objects.filter(order=orders[0]).update(quantity=1)
+        call_command('backfill_order_totals', stdout=out)
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).item_count, 6)
+        call_command('backfill_order_totals', '--all', stdout=out)
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).total_cost, Decimal('13.50'))
+
+
+class ReservationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel', price=Decimal('14.99'), stock=5
+        )
+
+    def cart_with(self, name, quantity):
+        user = User.objects.create_user(username=name, password='testpass123')
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=self.novel, quantity=quantity)
+        return cart
+
+    def order(self, cart):
+        return place_order(cart.user, Order(
+            first_name='A', last_name='B', email='a@example.com',
+            address='1 Street', postal_code='12345', city='Town'
+        ))
+
+    def test_holds_reduce_available_to_sell(self):
+        first = self.cart_with('first', 3)
+        reserve_cart(first)
+        self.assertEqual(available_to_sell([self.novel.id]), {self.novel.id: 2})
+        # A cart's own hold still counts as available to it
+        self.assertEqual(available_to_sell([self.novel.id], cart_id=first.pk), {self.novel.id: 5})
+
+        second = self.cart_with('second', 3)
+        with self.assertRaises(OutOfStock):
+            reserve_cart(second)
+        self.assertFalse(second.reservations.exists())
+
+    def test_checkout_respects_other_holds(self):
+        reserve_cart(self.cart_with('first', 3))
+        with self.assertRaises(OutOfStock):
+            self.order(self.cart_with('second', 3))
+        self.order(self.cart_with('third', 2))
+        self.novel.refresh_from_db()
+        self.assertEqual(self.novel.stock, 3)
+
+    def test_checkout_consumes_own_hold(self):
+        cart = self.cart_with('first', 5)
+        reserve_cart(cart)
+        self.order(cart)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(Product.objects.get(id=self.novel.id).stock, 0)
+
+    def test_expired_holds_are_ignored_and_reaped(self):
+        with override_settings(STORE_RESERVATION_TTL=-1):
+            reserve_cart(self.cart_with('first', 5))
+        self.assertEqual(available_to_sell([self.novel.id]), {self.novel.id: 5})
+        reserve_cart(self.cart_with('second', 5))
+
+        out = io.StringIO()
+        call_command('reap_reservations', '--batch-size', '1', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        self.assertEqual(StockReservation.objects.count(), 1)
+
+    def test_proceeding_to_checkout_reserves_cart(self):
+        cart = self.cart_with('first', 2)
+        self.client.force_login(cart.user)
+        self.assertNotContains(self.client.get(reverse('store:checkout')), 'reserved until')
+        self.assertFalse(cart.reservations.exists())
+        response = self.client.post(reverse('store:proceed_to_checkout'))
+        self.assertRedirects(response, reverse('store:checkout'))
+        self.assertContains(self.client.get(reverse('store:checkout')), 'reserved until')
+        self.assertEqual(cart.reservations.get().quantity, 2)
+
+        greedy = self.cart_with('greedy', 4)
+        self.client.force_login(greedy.user)
+        response = self.client.post(reverse('store:proceed_to_checkout'))
+        self.assertRedirects(response, reverse('store:cart_detail'), fetch_redirect_response=False)
+        self.assertFalse(greedy.reservations.exists())
+
+    def test_reserving_again_keeps_the_hold_without_extending_it(self):
+        cart = self.cart_with('first', 2)
+        expires_at = reserve_cart(cart)
+        version = get_stock_version()
+        with self.assertNumQueries(2):
+            self.assertEqual(reserve_cart(cart), expires_at)
+        self.assertEqual(get_stock_version(), version)
+
+        # A changed line is held until the same time, and other carts see it
+        cart.items.update(quantity=3)
+        self.assertEqual(reserve_cart(cart), expires_at)
+        self.assertEqual(cart.reservations.get().expires_at, expires_at)
+        self.assertNotEqual(get_stock_version(), version)
+
+    def test_pages_show_stock_not_held_by_other_carts(self):
+        detail = reverse('store:product_detail', args=[self.novel.slug])
+        etag = self.client.get(detail)['ETag']
+        reserve_cart(self.cart_with('first', 3))
+        response = self.client.get(detail, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '2 in stock')
+        self.assertContains(self.client.get(reverse('store:product_list')), '2 in stock')
+
+        reserve_cart(self.cart_with('second', 2))
+        response = self.client.get(detail)
+        self.assertContains(response, 'Out of Stock')
+        self.assertNotContains(response, reverse('store:add_to_cart', args=[self.novel.id]))
+
+    def test_add_to_cart_refuses_held_stock(self):
+        reserve_cart(self.cart_with('first', 5))
+        url = reverse('store:add_to_cart', args=[self.novel.id])
+        response = self.client.post(url)
+        self.assertRedirects(response, reverse('store:product_detail', args=[self.novel.slug]))
+        response = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(reverse('store:api_cart_add', args=[self.novel.id]))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 'Novel is out of stock.')
+        self.assertEqual(self.client.session.get('cart', {}), {})
+
+
+class IdempotencyTestCase(TestCase):
+    shipping = CheckoutTestCase.shipping
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='shopper', password='testpass123')
+        category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=category,
+            description='A novel', price=Decimal('12.00'), stock=5
+        )
+        self.client.force_login(self.user)
+
+    def test_checkout_replays_first_response(self):
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.novel, quantity=2)
+        data = {**self.shipping, 'idempotency_key': 'checkout-1'}
+        first = self.client.post(reverse('store:checkout'), data)
+        second = self.client.post(reverse('store:checkout'), data)
+        order = Order.objects.get()
+        self.assertRedirects(first, reverse('store:order_detail', args=[order.id]))
+        self.assertEqual(second.status_code, 302)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Product.objects.get(pk=self.novel.pk).stock, 3)
+
+    def test_checkout_replays_after_a_crash_past_the_lock_timeout(self):
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.novel, quantity=2)
+        data = {**self.shipping, 'idempotency_key': 'checkout-1'}
+        # The worker dies after the order commits, before the view returns
+        with mock.patch('store.idempotency.complete'):
+            first = self.client.post(reverse('store:checkout'), data)
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        CartItem.objects.create(cart=Cart.objects.get(user=self.user), product=self.novel, quantity=2)
+        second = self.client.post(reverse('store:checkout'), data)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second['Location'], first['Location'])
+
+    def test_cart_post_runs_once_per_key(self):
+        url = reverse('store:add_to_cart', args=[self.novel.id])
+        for key in ('a', 'a', 'b'):
+            response = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IDEMPOTENCY_KEY=key)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cart_total'], 2)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_async_cart_api(self):
+        url = reverse('store:api_cart_add', args=[self.novel.id])
+        first = self.client.post(url, HTTP_IDEMPOTENCY_KEY='api-1')
+        second = self.client.post(url, HTTP_IDEMPOTENCY_KEY='api-1')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_guest_keys_are_scoped_to_session(self):
+        self.client.logout()
+        url = reverse('store:add_to_cart', args=[self.novel.id])
+        self.client.post(url)
+        self.client.post(url, HTTP_IDEMPOTENCY_KEY='guest-1')
+        self.client.post(url, HTTP_IDEMPOTENCY_KEY='guest-1')
+        self.assertEqual(self.client.session['cart'], {str(self.novel.id): 2})
+        self.assertTrue(IdempotencyKey.objects.get().owner.startswith('session:'))
+
+    def test_key_reused_for_other_request(self):
+        self.client.post(reverse('store:add_to_cart', args=[self.novel.id]), HTTP_IDEMPOTENCY_KEY='k')
+        response = self.client.post(
+            reverse('store:remove_from_cart', args=[self.novel.id]), HTTP_IDEMPOTENCY_KEY='k'
+        )
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_in_flight_and_abandoned_keys(self):
+        url = reverse('store:add_to_cart', args=[self.novel.id])
+        self.client.post(url, HTTP_IDEMPOTENCY_KEY='k')
+        record = IdempotencyKey.objects.get()
+        IdempotencyKey.objects.filter(pk=record.pk).update(status_code=None)
+        response = self.client.post(url, HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+
+        # A claim older than the lock timeout is taken over
+        IdempotencyKey.objects.filter(pk=record.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        response = self.client.post(url, HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_reap_command(self):
+        self.client.post(reverse('store:add_to_cart', args=[self.novel.id]), HTTP_IDEMPOTENCY_KEY='old')
+        self.client.post(reverse('store:add_to_cart', args=[self.novel.id]), HTTP_IDEMPOTENCY_KEY='new')
+        IdempotencyKey.objects.filter(key='old').update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = io.StringIO()
+        call_command('reap_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1 expired idempotency keys', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+
+
+ran_jobs = []
+
+
+@jobs.task(name='tests.record')
+def record_job(value):
+    ran_jobs.append(value)
+
+
+@jobs.task(name='tests.fail')
+def failing_job():
+    raise ValueError('boom')
+
+
+def run_burst(**options):
+    metrics = jobs.Metrics()
+    jobs.work(threading.Event(), metrics.add, burst=True, **options)
+    return metrics
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        ran_jobs.clear()
+
+    def test_runs_due_jobs_in_order(self):
+        for value in range(5):
+            jobs.enqueue(record_job, {'value': value})
+        jobs.enqueue('tests.record', {'value': 'later'}, delay=60)
+        metrics = run_burst(batch_size=2)
+        self.assertEqual(ran_jobs, [0, 1, 2, 3, 4])
+        self.assertEqual(metrics.counts, {'done': 5, 'retry': 0, 'failed': 0})
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 5)
+        self.assertEqual(Job.objects.get(status=Job.QUEUED).payload, {'value': 'later'})
+
+    @override_settings(STORE_JOB_BACKOFF=10)
+    def test_retries_with_backoff_then_fails(self):
+        job = jobs.enqueue(failing_job, max_attempts=2)
+        self.assertEqual(run_burst().counts['retry'], 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('ValueError: boom', job.last_error)
+        delay = (job.run_at - timezone.now()).total_seconds()
+        self.assertTrue(4 < delay <= 10)
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(run_burst().counts['failed'], 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_unknown_tasks(self):
+        with self.assertRaises(jobs.UnknownTask):
+            jobs.enqueue('tests.missing')
+        Job.objects.create(task='tests.missing', run_at=timezone.now())
+        self.assertEqual(run_burst().counts['failed'], 1)
+
+    def test_claimed_jobs_are_skipped_until_lock_expires(self):
+        jobs.enqueue(record_job, {'value': 1})
+        self.assertEqual(len(jobs.claim('first')), 1)
+        self.assertEqual(jobs.claim('second'), [])
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        [job] = jobs.claim('second')
+        self.assertEqual((job.locked_by, job.attempts), ('second', 2))
+
+    def test_outcome_is_recorded_despite_a_busy_database(self):
+        jobs.enqueue(record_job, {'value': 1})
+        [job] = jobs.claim('worker')
+        update = QuerySet.update
+        busy = []
+
+        def flaky_update(queryset, **kwargs):
+            if not busy:
+                busy.append(True)
+                raise OperationalError('database is locked')
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', flaky_update):
+            self.assertEqual(jobs.run_job(job), 'done')
+        self.assertEqual(ran_jobs, [1])
+        self.assertEqual(Job.objects.get().status, Job.DONE)
+
+    def test_reaps_finished_jobs_after_retention(self):
+        for value in range(3):
+            jobs.enqueue(record_job, {'value': value})
+        jobs.enqueue(failing_job, max_attempts=1)
+        run_burst()
+        jobs.enqueue('tests.record', {'value': 'queued'})
+        Job.objects.filter(payload={'value': 0}).update(finished_at=timezone.now())
+        Job.objects.exclude(payload={'value': 0}).update(finished_at=timezone.now() - timedelta(days=8))
+        out = io.StringIO()
+        call_command('reap_jobs', '--batch-size', '1', stdout=out)
+        self.assertIn('Deleted 3 finished jobs', out.getvalue())
+        self.assertEqual(
+            sorted(Job.objects.values_list('status', flat=True)), [Job.DONE, Job.QUEUED]
+        )
+
+    def test_checkout_queues_confirmation_email(self):
+        user = User.objects.create_user(username='shopper', password='testpass123')
+        category = Category.objects.create(name='Books', slug='books')
+        novel = Product.objects.create(
+            name='Novel', slug='novel', category=category, description='A novel', price=Decimal('12.00'), stock=5
+        )
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=novel, quantity=2)
+        order = place_order(user, Order(**CheckoutTestCase.shipping))
+        self.assertEqual(Job.objects.get().payload, {'order_id': order.id})
+        self.assertEqual(mail.outbox, [])
+
+        run_burst()
+        [message] = mail.outbox
+        self.assertEqual(message.to, ['ada@example.com'])
+        self.assertIn('2 x Novel', message.body)
+        self.assertIn('Total: $24.00', message.body)
+
+
+class RunWorkerTestCase(TransactionTestCase):
+    def test_burst_with_threads(self):
+        ran_jobs.clear()
+        for value in range(20):
+            jobs.enqueue(record_job, {'value': value})
+        out = io.StringIO()
+        call_command('run_worker', '--burst', '--concurrency', '3', '--batch-size', '2', stdout=out)
+        self.assertEqual(sorted(ran_jobs), list(range(20)))
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 20)
+        self.assertIn('20 done, 0 retried, 0 failed', out.getvalue())
+
+
+def make_image(size=(1000, 500), color=(200, 30, 30, 128), name='photo.png'):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGBA', size, color).save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(STORE_IMAGE_RENDITIONS={'thumb': 60, 'card': 400})
+class RenditionTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.category = Category.objects.create(name='Books', slug='books')
+
+    def make_product(self, image):
+        return Product.objects.create(
+            name='Poster', slug='poster', category=self.category,
+            description='A poster', price=Decimal('9.00'), stock=3, image=image
+        )
+
+    def test_upload_queues_renditions_and_keeps_original(self):
+        product = self.make_product(make_image())
+        job = Job.objects.get()
+        self.assertEqual(job.payload, {'product_id': product.id})
+        self.assertEqual(len(product.image_hash), 64)
+        with product.image.open('rb'):
+            from PIL import Image
+            self.assertEqual(Image.open(product.image).size, (1000, 500))
+
+        run_burst()
+        product.refresh_from_db()
+        card = product.renditions['card']
+        self.assertEqual([entry[1:] for entry in card['webp']], [[400, 1], [800, 2]])
+        self.assertEqual([entry[1:] for entry in card['jpeg']], [[400, 1], [800, 2]])
+        for path, pixels, density in card['webp'] + product.renditions['thumb']['jpeg']:
+            self.assertTrue(product.image.storage.exists(path))
+
+        html = product_image(product, 'card', **{'class': 'card-img-top'})
+        self.assertIn('<source type="image/webp" srcset="/media/renditions/', html)
+        self.assertIn('/800.webp 2x"', html)
+        self.assertIn('class="card-img-top" alt="Poster" loading="lazy"', html)
+
+    def test_unchanged_image_does_no_work(self):
+        product = self.make_product(make_image())
+        run_burst()
+        product = Product.objects.get(pk=product.pk)
+        with mock.patch('store.renditions.hash_image') as hash_image:
+            product.stock = 1
+            product.save()
+            Product.objects.get(pk=product.pk).save(update_fields=['price'])
+        hash_image.assert_not_called()
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 0)
+
+        # The same picture uploaded again keeps its renditions
+        renditions = Product.objects.get(pk=product.pk).renditions
+        product.image = make_image(name='again.png')
+        product.save()
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 0)
+        self.assertEqual(Product.objects.get(pk=product.pk).renditions, renditions)
+
+        product.image = make_image(color=(0, 0, 255, 255))
+        product.save()
+        self.assertEqual(Product.objects.get(pk=product.pk).renditions, {})
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_small_images_are_not_upscaled(self):
+        product = self.make_product(make_image(size=(100, 100)))
+        run_burst()
+        product.refresh_from_db()
+        self.assertEqual([entry[1:] for entry in product.renditions['thumb']['jpeg']], [[60, 1], [100, 2]])
+        self.assertEqual([entry[1:] for entry in product.renditions['card']['jpeg']], [[100, 1]])
+
+    def test_falls_back_to_original_until_rendered(self):
+        product = self.make_product(make_image())
+        html = product_image(product, 'card')
+        self.assertEqual(html, f'<img src="{product.image.url}" alt="Poster">')
+
+    def test_build_renditions_command(self):
+        product = self.make_product(make_image())
+        Job.objects.all().delete()
+        Product.objects.filter(pk=product.pk).update(image_hash='')
+        out = io.StringIO()
+        call_command('build_renditions', '--workers', '1', stdout=out)
+        self.assertIn('Rendered 1 products', out.getvalue())
+        product.refresh_from_db()
+        self.assertEqual(len(product.image_hash), 64)
+        self.assertEqual(set(product.renditions), {'thumb', 'card'})
+
+    def test_loaddata_installs_products_without_rendering(self):
+        out = io.StringIO()
+        call_command('loaddata', os.path.join(settings.BASE_DIR, 'initial_data.json'), stdout=out)
+        self.assertIn('Installed 21 object(s)', out.getvalue())
+        self.assertEqual(Product.objects.count(), 15)
+        self.assertFalse(Job.objects.exists())
+
+
+def retry_locked(func, *args):
+    """Call ``func``, retrying while SQLite's shared test database is locked"""
+    while True:
+        try:
+            return func(*args)
+        except OperationalError as e:
+            # The transaction was rolled back, so retrying is safe
+            if 'locked' not in str(e):
+                raise
+
+
+@override_settings(STORE_THUMBNAIL_SIZES=['60x60', '200x200'])
+class ThumbnailTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, STORE_THUMBNAIL_CACHE_DIR=cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def save_image(self, name, size=(1000, 500), mode='RGB', fmt='JPEG'):
+        from PIL import Image
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new(mode, size, 'red').save(path, format=fmt)
+        return path
+
+    def get(self, size, name):
+        return self.client.get(f'/media/thumb/{size}/{name}')
+
+    def test_scales_image_to_fit_and_caches_it(self):
+        from PIL import Image
+        self.save_image('products/photo.jpg')
+        with mock.patch('store.thumbnails.render_thumbnail', wraps=thumbnails.render_thumbnail) as render:
+            response = self.get('200x200', 'products/photo.jpg')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertIn('max-age', response['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(response.getvalue())).size, (200, 100))
+
+            response = self.get('200x200', 'products/photo.jpg')
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertEqual(render.call_count, 1)
+
+    def test_spellings_of_one_path_share_a_thumbnail(self):
+        self.save_image('products/photo.jpg')
+        names = ['products/photo.jpg', 'products/./photo.jpg', 'products//photo.jpg', 'products/../products/photo.jpg']
+        with mock.patch('store.thumbnails.render_thumbnail', wraps=thumbnails.render_thumbnail) as render:
+            paths = {thumbnails.get_thumbnail(name, '60x60')[0] for name in names}
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(render.call_count, 1)
+
+    def test_never_upscales_and_keeps_transparency(self):
+        from PIL import Image
+        self.save_image('icon.png', size=(40, 20), mode='RGBA', fmt='PNG')
+        response = self.get('200x200', 'icon.png')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        image = Image.open(io.BytesIO(response.getvalue()))
+        self.assertEqual((image.size, image.mode), ((40, 20), 'RGBA'))
+
+    def test_replaced_image_gets_a_new_thumbnail(self):
+        path = self.save_image('photo.jpg')
+        first, _ = thumbnails.get_thumbnail('photo.jpg', '60x60')
+        self.save_image('photo.jpg', size=(300, 600))
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        second, _ = thumbnails.get_thumbnail('photo.jpg', '60x60')
+        self.assertNotEqual(first, second)
+
+    def test_rejects_unlisted_sizes_and_bad_paths(self):
+        self.save_image('photo.jpg')
+        with open(os.path.join(self.media_root, 'notes.txt'), 'w') as fh:
+            fh.write('not an image')
+        self.assertEqual(self.get('201x200', 'photo.jpg').status_code, 404)
+        self.assertEqual(self.get('200x200', 'missing.jpg').status_code, 404)
+        self.assertEqual(self.get('200x200', 'notes.txt').status_code, 404)
+        for name in ('../photo.jpg', '/etc/passwd', 'products/../../photo.jpg'):
+            with self.assertRaises(thumbnails.InvalidThumbnail):
+                thumbnails.get_thumbnail(name, '200x200')
+
+    def test_evicts_least_recently_used_over_limit(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        disk_cache = thumbnails.DiskLRUCache(directory, max_bytes=250)
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            path = disk_cache.put(key, b'x' * 100)
+            os.utime(path, (i, i))
+        self.assertIsNone(disk_cache.get('aa1'))
+        # A hit makes bb2 the most recently used
+        self.assertIsNotNone(disk_cache.get('bb2'))
+        disk_cache.put('dd4', b'x' * 100)
+        self.assertIsNone(disk_cache.get('cc3'))
+        self.assertIsNotNone(disk_cache.get('bb2'))
+        self.assertIsNotNone(disk_cache.get('dd4'))
+
+    def test_concurrent_misses_render_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        disk_cache = thumbnails.DiskLRUCache(directory, max_bytes=10 ** 6)
+        renders = []
+        barrier = threading.Barrier(4, timeout=10)
+
+        def render():
+            renders.append(1)
+            time.sleep(0.05)
+            return b'thumbnail'
+
+        def request():
+            barrier.wait()
+            paths.append(disk_cache.get_or_create('abc', render))
+
+        paths = []
+        workers = [threading.Thread(target=request) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(len(paths), 4)
+
+
+class MediaServingTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.factory = RequestFactory()
+        media.get_memory_cache().clear()
+
+    def write(self, name, content):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def get(self, name, **headers):
+        return serve_media(self.factory.get(f'/media/{name}', headers=headers), name)
+
+    def test_sends_validators_and_answers_revalidation_with_304(self):
+        self.write('products/photo.jpg', b'jpeg bytes')
+        response = self.get('products/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.getvalue(), b'jpeg bytes')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.get('products/photo.jpg', if_none_match=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('ETag', response)
+        response = self.get('products/photo.jpg', if_modified_since=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.get('products/photo.jpg', if_none_match='"other"').status_code, 200)
+
+    def test_hashed_names_are_immutable(self):
+        name = 'renditions/ab/' + 'ab' * 32 + '/400.webp'
+        self.write(name, b'webp')
+        response = self.get(name)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+
+    def test_hashed_looking_uploads_are_not_immutable(self):
+        # A UUID upload name can be rewritten in place by a media sync
+        name = 'products/3f2b8c1e-9d4a-4e6b-a7c2-5f1e8d9b0a6c.jpg'
+        self.write(name, b'jpeg')
+        self.assertEqual(self.get(name)['Cache-Control'], 'public, max-age=3600')
+        self.write('products/' + 'ab' * 32 + '.jpg', b'jpeg')
+        self.assertEqual(self.get('products/' + 'ab' * 32 + '.jpg')['Cache-Control'], 'public, max-age=3600')
+        with override_settings(STORE_MEDIA_IMMUTABLE_PREFIXES=('renditions/', 'products/')):
+            self.assertEqual(self.get(name)['Cache-Control'], 'public, max-age=31536000, immutable')
+
+    def test_byte_ranges(self):
+        self.write('video.mp4', bytes(range(100)))
+        response = self.get('video.mp4', range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(response.getvalue(), bytes(range(10, 20)))
+        self.assertEqual(self.get('video.mp4', range='bytes=-5').getvalue(), bytes(range(95, 100)))
+        self.assertEqual(self.get('video.mp4', range='bytes=98-500').getvalue(), bytes([98, 99]))
+
+        response = self.get('video.mp4', range='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+        # Several ranges, or a stale If-Range, get the whole file
+        self.assertEqual(self.get('video.mp4', range='bytes=0-1,5-6').status_code, 200)
+        self.assertEqual(self.get('video.mp4', range='bytes=0-1', if_range='"stale"').status_code, 200)
+        etag = self.get('video.mp4')['ETag']
+        self.assertEqual(self.get('video.mp4', range='bytes=0-1', if_range=etag).status_code, 206)
+
+    @override_settings(STORE_MEDIA_MEMORY_FILE_MAX_BYTES=10)
+    def test_large_files_stream_from_disk(self):
+        self.write('big.bin', bytes(range(100)))
+        response = self.get('big.bin')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(response.getvalue(), bytes(range(100)))
+        response = self.get('big.bin', range='bytes=50-59')
+        self.assertEqual((response.status_code, response['Content-Length']), (206, '10'))
+        self.assertEqual(response.getvalue(), bytes(range(50, 60)))
+
+    def test_small_files_are_served_from_memory_until_changed(self):
+        path = self.write('logo.png', b'first')
+        self.assertEqual(self.get('logo.png').content, b'first')
+        with mock.patch('builtins.open', side_effect=AssertionError('read from disk')):
+            self.assertEqual(self.get('logo.png').content, b'first')
+        self.write('logo.png', b'second!')
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.get('logo.png').content, b'second!')
+
+    def test_hands_off_to_front_end_server(self):
+        path = self.write('products/my photo.jpg', b'jpeg bytes')
+        with override_settings(STORE_MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.get('products/my photo.jpg')
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/products/my%20photo.jpg')
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+            self.assertEqual(self.get('products/my photo.jpg', if_none_match=response['ETag']).status_code, 304)
+        with override_settings(STORE_MEDIA_SENDFILE='x-sendfile'):
+            self.assertEqual(self.get('products/my photo.jpg')['X-Sendfile'], path)
+
+    def test_missing_and_outside_files_are_404(self):
+        os.makedirs(os.path.join(self.media_root, 'products'))
+        for name in ('missing.jpg', 'products', '../secret.txt', '/etc/passwd'):
+            with self.assertRaises(Http404):
+                self.get(name)
+
+
+class MediaSyncTestCase(TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        self.destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.destination)
+
+    def write(self, root, name, content):
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.destination, name), 'rb') as fh:
+            return fh.read()
+
+    def test_copies_only_new_and_changed_files(self):
+        self.write(self.source, 'a.jpg', b'first')
+        self.write(self.source, 'sub/b.jpg', b'second')
+        result = media_sync.sync_tree(self.source, self.destination)
+        self.assertEqual(sorted(result.copied), ['a.jpg', 'sub/b.jpg'])
+        self.assertEqual(self.read('sub/b.jpg'), b'second')
+        manifest = media_sync.load_manifest(os.path.join(self.destination, media_sync.MANIFEST_NAME))
+        self.assertEqual(manifest['a.jpg']['sha256'], hashlib.sha256(b'first').hexdigest())
+
+        # Nothing changed: no file is read
+        with mock.patch('store.media_sync.sha256_file') as sha256_file, \
+                mock.patch('store.media_sync._copy') as copy:
+            result = media_sync.sync_tree(self.source, self.destination)
+        self.assertEqual((result.copied, result.unchanged), ([], 2))
+        sha256_file.assert_not_called()
+        copy.assert_not_called()
+
+        path = self.write(self.source, 'a.jpg', b'changed')
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.write(self.source, 'c.jpg', b'third')
+        result = media_sync.sync_tree(self.source, self.destination)
+        self.assertEqual(sorted(result.copied), ['a.jpg', 'c.jpg'])
+        self.assertEqual(result.unchanged, 1)
+        self.assertEqual(self.read('a.jpg'), b'changed')
+
+    def test_touched_but_identical_files_are_not_copied(self):
+        path = self.write(self.source, 'a.jpg', b'same')
+        media_sync.sync_tree(self.source, self.destination)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        with mock.patch('store.media_sync._copy') as copy:
+            result = media_sync.sync_tree(self.source, self.destination)
+        copy.assert_not_called()
+        self.assertEqual(result.unchanged, 1)
+        self.assertEqual(os.stat(os.path.join(self.destination, 'a.jpg')).st_mtime_ns, os.stat(path).st_mtime_ns)
+
+    def test_deletes_only_synced_orphans_when_asked(self):
+        path = self.write(self.source, 'a.jpg', b'gone soon')
+        self.write(self.destination, 'upload.jpg', b'not ours')
+        media_sync.sync_tree(self.source, self.destination)
+        os.unlink(path)
+
+        result = media_sync.sync_tree(self.source, self.destination)
+        self.assertEqual(result.deleted, [])
+        self.assertTrue(os.path.exists(os.path.join(self.destination, 'a.jpg')))
+
+        result = media_sync.sync_tree(self.source, self.destination, delete=True)
+        self.assertEqual(result.deleted, ['a.jpg'])
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'a.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.destination, 'upload.jpg')))
+        manifest = media_sync.load_manifest(os.path.join(self.destination, media_sync.MANIFEST_NAME))
+        self.assertEqual(manifest, {})
+
+    def test_sync_media_command_prints_a_summary(self):
+        for i in range(3):
+            self.write(self.source, f'{i}.jpg', b'x' * i)
+        out = io.StringIO()
+        with override_settings(MEDIA_ROOT=self.destination):
+            call_command('sync_media', source=self.source, stdout=out)
+            call_command('sync_media', source=self.source, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn('3 copied', lines[1])
+        self.assertIn('0 copied', lines[3])
+        self.assertIn('3 unchanged', lines[3])
+        self.assertEqual(self.read('products/2.jpg'), b'xx')
+
+
+class MediaAuditTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.category = Category.objects.create(name='Books', slug='books')
+
+        self.save_image('products/good.jpg', (40, 30))
+        self.save_image('products/wide.jpg', (120, 10))
+        self.write('products/broken.jpg', b'\xff\xd8 not really a jpeg')
+        self.write('products/orphan.jpg', b'unused')
+        self.write('renditions/ab/abcdef/400.webp', b'generated')
+        self.write('products/.gitkeep', b'')
+        self.products = {}
+        for name in ('good', 'wide', 'broken', 'missing', 'good-again'):
+            image = 'products/good.jpg' if name == 'good-again' else f'products/{name}.jpg'
+            product = Product.objects.create(
+                name=name, slug=name, category=self.category, description=name, price=Decimal('1.00'), stock=1
+            )
+            # update() skips the save signals, which would read the file
+            Product.objects.filter(pk=product.pk).update(image=image)
+            self.products[name] = product.pk
+        Product.objects.create(
+            name='No image', slug='no-image', category=self.category, description='', price=Decimal('1.00'), stock=1
+        )
+
+    def write(self, name, content):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+
+    def save_image(self, name, size):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'blue').save(buffer, format='JPEG')
+        self.write(name, buffer.getvalue())
+
+    def run_audit(self, *args):
+        out = io.StringIO()
+        call_command('check_media', '--max-side', '100', *args, stdout=out)
+        return out.getvalue()
+
+    def test_json_report(self):
+        report = json.loads(self.run_audit('--json', '--workers', '2', '--chunk-size', '2'))
+        self.assertEqual(report['summary']['products'], 5)
+        self.assertEqual(report['summary']['files'], 4)
+        self.assertEqual(report['missing'], [{'product_id': self.products['missing'], 'image': 'products/missing.jpg'}])
+        self.assertEqual(report['orphans'], [{'path': 'products/orphan.jpg', 'size': 6}])
+        self.assertEqual([(row['path'], row['width'], row['product_ids']) for row in report['oversize']], [
+            ('products/wide.jpg', 120, [self.products['wide']]),
+        ])
+        self.assertEqual([row['path'] for row in report['undecodable']], ['products/broken.jpg'])
+        self.assertEqual(report['undecodable'][0]['product_ids'], [self.products['broken']])
+
+    def test_table_report(self):
+        output = self.run_audit('--audit', '--workers', '1')
+        self.assertIn('5 product images, 4 files', output)
+        self.assertIn('Missing files: 1', output)
+        self.assertIn(f"{self.products['missing']:<7}  products/missing.jpg", output)
+        self.assertIn('Oversize originals: 1', output)
+        self.assertIn('products/wide.jpg', output)
+        self.assertIn('Undecodable files: 1', output)
+        self.assertNotIn('No problems found', output)
+
+    def test_clean_tree_and_oversize_by_bytes(self):
+        Product.objects.exclude(pk__in=[self.products['good'], self.products['good-again']]).delete()
+        for name in ('wide', 'broken', 'orphan'):
+            os.unlink(os.path.join(self.media_root, 'products', f'{name}.jpg'))
+        self.assertIn('No problems found', self.run_audit('--audit'))
+        report = json.loads(self.run_audit('--json', '--max-bytes', '10'))
+        self.assertEqual(report['oversize'][0]['product_ids'], [self.products['good'], self.products['good-again']])
+
+
+class ConcurrentReservationTestCase(TransactionTestCase):
+    shoppers = 12
+    stock = 5
+
+    def run_threads(self, target, carts):
+        start = threading.Barrier(len(carts), timeout=10)
+        results = []
+
+        def run(cart):
+            start.wait()
+            try:
+                retry_locked(target, cart)
+                results.append('ok')
+            except OutOfStock:
+                results.append('short')
+            except Exception as e:
+                results.append(e)
+            finally:
+                db_connections.close_all()
+
+        workers = [threading.Thread(target=run, args=[cart]) for cart in carts]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+        return results
+
+    def test_concurrent_reservations_and_checkouts_never_oversell(self):
+        category = Category.objects.create(name='Books', slug='books')
+        product = Product.objects.create(
+            name='Novel', slug='novel', category=category,
+            description='A novel', price=Decimal('14.99'), stock=self.stock
+        )
+        carts = []
+        for i in range(self.shoppers):
+            cart = Cart.objects.create(user=User.objects.create_user(username=f'shopper{i}'))
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+            carts.append(cart)
+
+        results = self.run_threads(reserve_cart, carts)
+        self.assertEqual(sorted(map(str, results)), ['ok'] * self.stock + ['short'] * (self.shoppers - self.stock))
+        self.assertEqual(StockReservation.objects.aggregate(Sum('quantity'))['quantity__sum'], self.stock)
+        holders = set(StockReservation.objects.values_list('cart__user', flat=True))
+
+        def checkout(cart):
+            place_order(cart.user, Order(
+                first_name='A', last_name='B', email='a@example.com',
+                address='1 Street', postal_code='12345', city='Town'
+            ))
+
+        results = self.run_threads(checkout, carts)
+        self.assertEqual(results.count('ok'), self.stock)
+        self.assertEqual(Order.objects.count(), self.stock)
+        # Only the carts holding stock got it
+        self.assertEqual(set(Order.objects.values_list('user', flat=True)), holders)
+        self.assertEqual(Product.objects.get(id=product.id).stock, 0)
+
+
+class ConcurrentCartTestCase(TransactionTestCase):
+    threads = 8
+    adds_per_thread = 10
+
+    def test_concurrent_adds_lose_no_increments(self):
+        user = User.objects.create_user(username='shopper', password='testpass123')
+        category = Category.objects.create(name='Books', slug='books')
+        product = Product.objects.create(
+            name='Novel', slug='novel', category=category,
+            description='A novel', price=Decimal('14.99'), stock=500
+        )
+        Cart.objects.create(user=user)
+        url = reverse('store:add_to_cart', args=[product.id])
+        start = threading.Barrier(self.threads, timeout=10)
+        errors = []
+        # Log in up front: a session write failing on the shared test
+        # database would keep a thread from ever reaching the barrier
+        clients = []
+        for _ in range(self.threads):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+
+        def hammer(client):
+            try:
+                start.wait()
+                for _ in range(self.adds_per_thread):
+                    while True:
+                        try:
+                            response = client.post(url)
+                            break
+                        except OperationalError as e:
+                            # SQLite's shared in-memory test database reports
+                            # a write lock at once instead of waiting on the
+                            # busy timeout; the failed upsert wrote nothing.
+                            if 'locked' not in str(e):
+                                raise
+                    if response.status_code != 302:
+                        errors.append(response.status_code)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db_connections.close_all()
+
+        workers = [threading.Thread(target=hammer, args=(client,)) for client in clients]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            CartItem.objects.get(cart__user=user, product=product).quantity,
+            self.threads * self.adds_per_thread,
+        )
+
+
+class ProductFeedTestCase(TestCase):
+    def setUp(self):
+        self.books = Category.objects.create(name='Books', slug='books')
+        self.toys = Category.objects.create(name='Toys', slug='toys')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.books,
+            description='A novel', price=Decimal('14.99'), stock=3
+        )
+        self.blocks = Product.objects.create(
+            name='Blocks', slug='blocks', category=self.toys,
+            description='Blocks', price=Decimal('34.99'), stock=8
+        )
+        self.hidden = Product.objects.create(
+            name='Hidden', slug='hidden', category=self.toys,
+            description='Hidden', price=Decimal('1.00'), available=False
+        )
+        self.url = reverse('store:api_products')
+
+    def read(self, response):
+        return response.getvalue().decode()
+
+    def test_json_array(self):
+        response = self.client.get(self.url, {'fields': 'id,price,category'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(self.read(response)), [
+            {'id': self.novel.id, 'price': '14.99', 'category': 'books'},
+            {'id': self.blocks.id, 'price': '34.99', 'category': 'toys'},
+        ])
+
+    def test_ndjson_with_filters(self):
+        response = self.client.get(self.url, {'format': 'ndjson', 'category': 'toys', 'fields': 'slug'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.read(response), '{"slug":"blocks"}\n')
+
+        response = self.client.get(
+            self.url, {'fields': 'slug', 'include_unavailable': '1'},
+            headers={'Accept': 'application/x-ndjson'}
+        )
+        lines = [json.loads(line) for line in self.read(response).splitlines()]
+        self.assertEqual([line['slug'] for line in lines], ['novel', 'blocks', 'hidden'])
+
+    def test_updated_since(self):
+        Product.objects.filter(pk=self.novel.pk).update(updated_at=self.novel.updated_at.replace(year=2020))
+        since = self.blocks.updated_at.replace(year=2021).isoformat()
+        response = self.client.get(self.url, {'fields': 'slug', 'updated_since': since})
+        self.assertEqual(json.loads(self.read(response)), [{'slug': 'blocks'}])
+
+    def test_empty_result_is_valid_json(self):
+        response = self.client.get(self.url, {'category': 'missing'})
+        self.assertEqual(json.loads(self.read(response)), [])
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get(self.url, {'fields': 'id,secret'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'updated_since': 'yesterday'}).status_code, 400)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.novel = Product.objects.create(
+            name='Novel', slug='novel', category=self.category,
+            description='A novel, with commas', price=Decimal('14.99'), stock=3
+        )
+
+    def test_split_ranges(self):
+        self.assertEqual(split_ranges(1, 10, 3), [(1, 5), (5, 9), (9, 11)])
+        self.assertEqual(split_ranges(4, 5, 8), [(4, 5), (5, 6)])
+        self.assertEqual(split_ranges(None, None, 4), [])
+
+    def test_csv_export(self):
+        rows, files, until = run_export('products', self.tmpdir)
+        self.assertEqual(rows, 1)
+        with open(files[0], newline='') as fh:
+            records = list(csv.DictReader(fh))
+        self.assertEqual(records[0]['description'], 'A novel, with commas')
+        self.assertEqual(records[0]['price'], '14.99')
+
+    def test_gzip_ndjson_incremental_export(self):
+        rows, files, until = run_export('products', self.tmpdir, fmt='ndjson', compress=True, incremental=True)
+        self.assertEqual(rows, 1)
+        with gzip.open(files[0], 'rt') as fh:
+            self.assertEqual(json.loads(fh.readline())['slug'], 'novel')
+
+        rows, files, until = run_export('products', self.tmpdir, incremental=True)
+        self.assertEqual(rows, 0)
+
+        self.novel.stock = 2
+        self.novel.save()
+        rows, files, until = run_export('products', self.tmpdir, incremental=True)
+        self.assertEqual(rows, 1)
+
+    def test_edited_order_items_are_exported_again(self):
+        user = User.objects.create_user(username='buyer', password='testpass123')
+        order = Order.objects.create(
+            user=user, first_name='A', last_name='B', email='a@example.com',
+            address='1 Street', postal_code='12345', city='Town'
+        )
+        item = OrderItem.objects.create(order=order, product=self.novel, price=Decimal('14.99'))
+        # A watermark stored when order items were exported by id
+        Watermark.objects.create(name='export:order_items', value='7')
+        self.assertEqual(run_export('order_items', self.tmpdir, incremental=True)[0], 1)
+        self.assertEqual(run_export('order_items', self.tmpdir, incremental=True)[0], 0)
+        item.quantity = 2
+        item.save()
+        rows, files, until = run_export('order_items', self.tmpdir, fmt='ndjson', incremental=True)
+        with open(files[0]) as fh:
+            self.assertEqual(json.loads(fh.readline())['quantity'], 2)
+
+    def test_since_is_checked_before_exporting(self):
+        output_dir = os.path.join(self.tmpdir, 'orders')
+        with self.assertRaisesMessage(CommandError, 'is not an ISO datetime'):
+            call_command('export_orders', '--since', '5', '--output-dir', output_dir, stdout=io.StringIO())
+        self.assertFalse(os.path.exists(output_dir))
+        out = io.StringIO()
+        call_command('export_orders', '--since', '2024-01-01T00:00:00', '--output-dir', output_dir, stdout=out)
+        self.assertIn('Exported 0 orders rows', out.getvalue())
+        self.assertIn('Exported 0 order_items rows', out.getvalue())
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmpdir, 'search_index.json')
+        settings_override = override_settings(STORE_SEARCH_INDEX_PATH=self.index_path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(search.reset_index)
+        search.reset_index()
+
+        self.category = Category.objects.create(name='Electronics', slug='electronics')
+        self.headphones = Product.objects.create(
+            name='Wireless Headphones', slug='wireless-headphones', category=self.category,
+            description='Premium headphones with noise cancellation.', price=Decimal('199.99')
+        )
+        self.speaker = Product.objects.create(
+            name='Bluetooth Speaker', slug='bluetooth-speaker', category=self.category,
+            description='Portable speaker that pairs with wireless headphones.', price=Decimal('59.99')
+        )
+
+    def test_stemming(self):
+        self.assertEqual(search.tokenize('Running Shoes'), ['run', 'shoe'])
+        self.assertEqual(search.tokenize('Batteries'), ['battery'])
+
+    def test_bm25_ranks_name_matches_first(self):
+        results = search.search_products('wireless headphone')
+        self.assertEqual(results, [self.headphones, self.speaker])
+
+    def test_category_name_is_indexed(self):
+        self.assertEqual(set(search.search_products('electronics')), {self.headphones, self.speaker})
+
+    def test_incremental_updates_from_signals(self):
+        search.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            lamp = Product.objects.create(
+                name='Desk Lamp', slug='desk-lamp', category=self.category,
+                description='LED lamp', price=Decimal('34.99')
+            )
+        self.assertEqual(search.search_products('lamp'), [lamp])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            lamp.available = False
+            lamp.save()
+        self.assertEqual(search.search_products('lamp'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.speaker.delete()
+        self.assertEqual(search.search_products('speaker'), [])
+
+    def test_signals_queue_one_debounced_save(self):
+        search.rebuild_index()
+        mtime = os.stat(self.index_path).st_mtime_ns
+        with self.captureOnCommitCallbacks(execute=True):
+            self.speaker.name = 'Bluetooth Boombox'
+            self.speaker.save()
+            self.headphones.delete()
+        self.assertEqual(os.stat(self.index_path).st_mtime_ns, mtime)
+        job = Job.objects.get(task=search.SAVE_TASK)
+        self.assertGreater(job.run_at, timezone.now())
+
+        Job.objects.update(run_at=timezone.now())
+        run_burst()
+        search.reset_index()
+        self.assertEqual(search.search_products('boombox'), [self.speaker])
+        self.assertEqual(search.search_products('noise cancellation'), [])
+
+    def test_index_is_persisted_and_loaded_from_disk(self):
+        search.rebuild_index()
+        self.assertTrue(os.path.exists(self.index_path))
+        search.reset_index()
+        with self.assertNumQueries(0):
+            index = search.get_index()
+        self.assertEqual(len(index), 2)
+
+    def test_search_view(self):
+        response = self.client.get(reverse('store:search'), {'q': 'speaker'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['products'], [self.speaker])
+        self.assertContains(response, 'Bluetooth Speaker')
+
+
 class AuthenticationTestCase(TestCase):
     def setUp(self):
         self.client = Client()
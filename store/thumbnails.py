@@ -0,0 +1,230 @@
+"""
+On-demand thumbnails of media images.
+
+``/media/thumb/<w>x<h>/<path>`` serves the media image at ``path`` scaled
+to fit inside ``w`` x ``h``. Only sizes listed in ``STORE_THUMBNAIL_SIZES``
+are served, so clients cannot fill the cache with arbitrary sizes.
+
+A thumbnail is generated on its first request and kept in a disk cache
+under ``STORE_THUMBNAIL_CACHE_DIR``. The cache is keyed by the source's
+normalized path under MEDIA_ROOT, its modification time and the size, so
+replacing an image is picked up at once and spellings of the same path
+(``a//b.jpg``, ``a/./b.jpg``) share one thumbnail. It is bounded by ``STORE_THUMBNAIL_CACHE_MAX_BYTES``: each hit
+touches the file's mtime, and once the cache outgrows the limit the least
+recently used files are deleted until it is back under 90% of it.
+
+JPEG sources are decoded at a reduced scale with ``Image.draft()`` and
+shrunk further with ``reduce()`` before the final resampling, so a large
+photo is never decoded at full size. Files are written to a temporary
+name and renamed into place, so readers never see a partial file.
+Concurrent requests in one process for the same missing thumbnail wait
+for a single render; across processes the atomic rename makes a rare
+duplicate render harmless.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from .media import resolve
+
+DEFAULT_SIZES = ('60x60', '180x180', '200x200', '300x300', '400x400', '800x800')
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+JPEG_QUALITY = 85
+
+# Fraction of the limit the cache is trimmed down to
+LOW_WATER = 0.9
+
+
+class InvalidThumbnail(Exception):
+    pass
+
+
+def get_allowed_sizes():
+    return set(getattr(settings, 'STORE_THUMBNAIL_SIZES', DEFAULT_SIZES))
+
+
+def get_cache_dir():
+    default = os.path.join(settings.BASE_DIR, 'cache', 'thumbnails')
+    return str(getattr(settings, 'STORE_THUMBNAIL_CACHE_DIR', default))
+
+
+def get_max_bytes():
+    return getattr(settings, 'STORE_THUMBNAIL_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+
+
+def source_path(file_path):
+    """Absolute path of the media file ``file_path``, refusing paths outside MEDIA_ROOT"""
+    full_path = resolve(file_path)
+    if full_path is None or not os.path.isfile(full_path):
+        raise InvalidThumbnail(file_path)
+    return full_path
+
+
+class DiskLRUCache:
+    """Files in one directory, trimmed least recently used first when over ``max_bytes``"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Bytes written since the last scan; the directory itself is the
+        # source of truth, shared with other processes
+        self._size = None
+        self._key_locks = {}
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Path of the cached file for ``key``, marking it recently used, or None"""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Store ``data`` under ``key`` atomically; returns its path"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.trim()
+        return path
+
+    def get_or_create(self, key, render):
+        """Cached path for ``key``, calling ``render()`` for the bytes at most once at a time"""
+        path = self.get(key)
+        if path is not None:
+            return path
+        with self._lock:
+            key_lock, waiters = self._key_locks.get(key, (threading.Lock(), 0))
+            self._key_locks[key] = (key_lock, waiters + 1)
+        try:
+            with key_lock:
+                # Whoever held the lock before us has rendered it
+                path = self.get(key)
+                if path is None:
+                    path = self.put(key, render())
+                return path
+        finally:
+            with self._lock:
+                key_lock, waiters = self._key_locks[key]
+                if waiters == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (key_lock, waiters - 1)
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def trim(self):
+        """Delete least recently used files until under the low-water mark"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * LOW_WATER
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._size = total
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    """The process-wide cache for the configured directory and limit"""
+    key = (get_cache_dir(), get_max_bytes())
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DiskLRUCache(*key)
+        return _caches[key]
+
+
+def render_thumbnail(path, width, height):
+    """``(bytes, content type)`` of the image at ``path`` fitted inside ``width`` x ``height``"""
+    with Image.open(path) as image:
+        # For JPEG, decode at 1/2, 1/4 or 1/8 scale straight away
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, height), Image.LANCZOS, reducing_gap=2.0)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        output = tempfile.SpooledTemporaryFile()
+        if has_alpha:
+            image.save(output, format='PNG', optimize=True)
+            content_type = 'image/png'
+        else:
+            image.convert('RGB').save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+            content_type = 'image/jpeg'
+    output.seek(0)
+    return output.read(), content_type
+
+
+def get_thumbnail(file_path, size):
+    """Path and content type of the cached ``size`` (``'WxH'``) thumbnail of a media file
+
+    Raises ``InvalidThumbnail`` for sizes not on the whitelist, paths
+    outside MEDIA_ROOT and files that are not images.
+    """
+    if size not in get_allowed_sizes():
+        raise InvalidThumbnail(size)
+    width, height = (int(part) for part in size.split('x'))
+    full_path = source_path(file_path)
+    stat = os.stat(full_path)
+    name = os.path.relpath(full_path, os.path.normpath(str(settings.MEDIA_ROOT))).replace(os.sep, '/')
+    key = hashlib.sha256(f'{name}:{stat.st_mtime_ns}:{stat.st_size}:{size}'.encode()).hexdigest()
+    content_types = {}
+
+    def render():
+        try:
+            data, content_types['type'] = render_thumbnail(full_path, width, height)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise InvalidThumbnail(file_path) from e
+        return data
+
+    path = get_cache().get_or_create(key, render)
+    if 'type' not in content_types:
+        # Served from the cache: PNG files start with their signature
+        with open(path, 'rb') as fh:
+            content_types['type'] = 'image/png' if fh.read(8) == b'\x89PNG\r\n\x1a\n' else 'image/jpeg'
+    return path, content_types['type']
@@ -1,6 +1,6 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from . import views
+from . import views, api_views
 
 app_name = 'store'
 
@@ -13,6 +13,7 @@ urlpatterns = [
     path('products/', views.product_list, name='product_list'),
     path('category/<slug:category_slug>/', views.product_list, name='product_list_by_category'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
+    path('search/', views.search, name='search'),
     
     # Authentication
     path('register/', views.register, name='register'),
@@ -25,9 +26,17 @@ urlpatterns = [
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:product_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('cart/update/<int:product_id>/', views.update_cart, name='update_cart'),
+    path('cart/update/', views.update_cart_batch, name='update_cart_batch'),
+
+    # Catalog API
+    path('api/products/', api_views.product_feed, name='api_products'),
+    path('api/products/<slug:slug>/', api_views.product_detail, name='api_product_detail'),
+    path('api/cart/', api_views.cart_summary, name='api_cart'),
+    path('api/cart/add/<int:product_id>/', api_views.cart_add, name='api_cart_add'),
 
     # Order functionality
     path('checkout/', views.checkout, name='checkout'),
+    path('checkout/start/', views.proceed_to_checkout, name='proceed_to_checkout'),
     path('order/<int:order_id>/', views.order_detail, name='order_detail'),
     path('orders/', views.order_history, name='order_history'),
 ]
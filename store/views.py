@@ -3,13 +3,31 @@ from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.db import transaction
+from django.http import JsonResponse, HttpResponse, Http404
+from django.urls import reverse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from .models import Category, Product, Cart, CartItem, Order, OrderItem
-from .forms import CustomUserCreationForm, OrderForm
+from .forms import CustomUserCreationForm, OrderForm, OrderHistoryFilterForm
+from .featured import get_featured_products
+from .cart import (
+    add_item, get_cart, get_cart_items, get_cart_summary, remove_item, set_item_quantity,
+    set_quantities,
+)
+from .catalog_cache import catalog_cache, get_categories, get_category, get_product
+from .conditional import catalog_condition, home_scope, product_list_scope, product_detail_scope
+from .facets import get_facet_index, parse_selection
+from .idempotency import idempotent, remember
+from .inventory import available_to_sell, get_hold_expiry, reserve_cart, with_available
+from .orders import EmptyCart, OutOfStock, place_order
+from .pagination import InvalidCursor, KeysetPaginator, get_page_size
+from .recommendations import get_cached_related_products
+from .search import search_products
 from django.conf import settings
+import copy
 import os
+import uuid
 
 def debug_info(request):
     """Debug view to check database and media state"""
@@ -51,57 +69,19 @@ def debug_info(request):
         'MEDIA_URL': settings.MEDIA_URL,
         'STATIC_URL': settings.STATIC_URL,
         'BASE_DIR': str(settings.BASE_DIR),
+        'Catalog Cache': catalog_cache.stats(),
     }
     
     return JsonResponse(debug_info, json_dumps_params={'indent': 2})
 import json
 
 
+@catalog_condition(home_scope)
 def home(request):
     """Home page with featured products"""
-    # Get most efficient/popular products that users are likely to buy
-    # Prioritize: daily essentials, high-demand items (low stock = high sales)
-    efficient_product_names = [
-        'Premium Coffee Beans',      # Daily essential, consumable
-        'Greek Yogurt',             # Healthy daily essential
-        'Wireless Headphones',       # Popular tech, good value
-        'Organic Apples',           # Fresh, healthy, affordable
-        'Fitness Tracker',          # Popular wellness item
-        'Whole Grain Bread',        # Daily staple
-        'Smartphone Pro',           # High-demand tech
-        'Bluetooth Speaker',        # Popular entertainment item
-    ]
-
-    # Get products by name priority
-    featured_products = []
-    for name in efficient_product_names:
-        try:
-            product = Product.objects.get(name=name, available=True)
-            featured_products.append(product)
-        except Product.DoesNotExist:
-            continue
-
-    # If we don't have enough featured products, add high-demand items (low stock indicates popularity)
-    if len(featured_products) < 8:
-        additional_products = Product.objects.filter(
-            available=True,
-            stock__lte=20  # Low stock indicates high demand/popularity
-        ).exclude(
-            id__in=[p.id for p in featured_products]
-        ).order_by('stock', 'price')[:8-len(featured_products)]
-        featured_products.extend(additional_products)
-
-    # Final fallback: affordable items
-    if len(featured_products) < 8:
-        fallback_products = Product.objects.filter(
-            available=True,
-            price__lte=30.00
-        ).exclude(
-            id__in=[p.id for p in featured_products]
-        ).order_by('price')[:8-len(featured_products)]
-        featured_products.extend(fallback_products)
+    featured_products = get_featured_products()
 
-    categories = Category.objects.all()
+    categories = get_categories()
     context = {
         'featured_products': featured_products,
         'categories': categories,
@@ -109,37 +89,69 @@ def home(request):
     return render(request, 'store/home.html', context)
 
 
+@catalog_condition(product_list_scope)
 def product_list(request, category_slug=None):
-    """Display all products or products by category"""
+    """Display all products or products by category, with facet filters"""
     category = None
-    categories = Category.objects.all()
-    products = Product.objects.filter(available=True)
-    
-    # Add debugging information to the response
-    print(f"Total products: {products.count()}")
-    print(f"Available categories: {[c.name for c in categories]}")
+    categories = get_categories()
 
     if category_slug:
-        category = get_object_or_404(Category, slug=category_slug)
-        products = products.filter(category=category)
+        category = get_category(category_slug)
+        if category is None:
+            raise Http404('No category matches the given query.')
+
+    facets = get_facet_index()
+    selected = facets.clean(parse_selection(request.GET, category_slug))
+    try:
+        page = facets.page(selected, request.GET.get('cursor'), get_page_size(request))
+    except InvalidCursor:
+        raise Http404('Invalid page cursor')
+    counts = facets.counts(selected)
 
     context = {
         'category': category,
         'categories': categories,
-        'products': products,
+        'products': page.object_list,
+        'page': page,
+        'category_facets': [(cat, counts['category'].get(cat.slug, 0)) for cat in categories],
+        'price_facets': [
+            (key, label, counts['price'][key], key in selected.get('price', ()))
+            for key, label in facets.labels['price'].items()
+        ],
+        'in_stock_count': counts['stock']['in'],
+        'in_stock': 'stock' in selected,
     }
     return render(request, 'store/product_list.html', context)
 
 
+@catalog_condition(product_detail_scope)
 def product_detail(request, slug):
     """Display product details"""
-    product = get_object_or_404(Product, slug=slug, available=True)
+    product = get_product(slug)
+    if product is None:
+        raise Http404('No product matches the given query.')
+    # The cached copy's stock goes stale with sales and holds; show what is
+    # live and not held by other carts on a private copy
+    product = copy.copy(product)
+    product.sellable = available_to_sell([product.pk]).get(product.pk, 0)
     context = {
         'product': product,
+        'related_products': get_cached_related_products(product),
     }
     return render(request, 'store/product_detail.html', context)
 
 
+def search(request):
+    """Full-text product search"""
+    query = request.GET.get('q', '').strip()
+    products = search_products(query) if query else []
+    context = {
+        'query': query,
+        'products': products,
+    }
+    return render(request, 'store/search.html', context)
+
+
 def register(request):
     """User registration"""
     if request.method == 'POST':
@@ -156,123 +168,172 @@ def register(request):
     return render(request, 'registration/register.html', {'form': form})
 
 
-@login_required
 def cart_detail(request):
     """Display cart contents"""
-    cart, created = Cart.objects.get_or_create(user=request.user)
+    cart = get_cart(request)
     context = {
         'cart': cart,
+        'cart_items': get_cart_items(cart),
     }
     return render(request, 'store/cart_detail.html', context)
 
 
-@login_required
 @require_POST
+@idempotent
 def add_to_cart(request, product_id):
     """Add product to cart"""
-    product = get_object_or_404(Product, id=product_id)
-    cart, created = Cart.objects.get_or_create(user=request.user)
+    product = get_object_or_404(with_available(Product.objects.all()), id=product_id)
+    if product.sellable < 1:
+        message = f'{product.name} is out of stock.'
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'error': message}, status=409)
+        messages.error(request, message)
+        return redirect('store:product_detail', slug=product.slug)
 
-    cart_item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': 1}
-    )
-
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
+    add_item(request, product)
 
     messages.success(request, f'{product.name} added to cart!')
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return JsonResponse({
             'success': True,
-            'cart_total': cart.get_total_items(),
+            'cart_total': get_cart_summary(request)['total_items'],
             'message': f'{product.name} added to cart!'
         })
 
     return redirect('store:product_detail', slug=product.slug)
 
 
-@login_required
 @require_POST
+@idempotent
 def remove_from_cart(request, product_id):
     """Remove product from cart"""
     product = get_object_or_404(Product, id=product_id)
-    cart = get_object_or_404(Cart, user=request.user)
 
-    try:
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        cart_item.delete()
+    if remove_item(request, product):
         messages.success(request, f'{product.name} removed from cart!')
-    except CartItem.DoesNotExist:
+    else:
         messages.error(request, 'Item not found in cart!')
 
     return redirect('store:cart_detail')
 
 
-@login_required
 @require_POST
+@idempotent
 def update_cart(request, product_id):
     """Update cart item quantity"""
     product = get_object_or_404(Product, id=product_id)
-    cart = get_object_or_404(Cart, user=request.user)
     quantity = int(request.POST.get('quantity', 1))
+    set_item_quantity(request, product, quantity)
+    return redirect('store:cart_detail')
+
 
-    if quantity > 0:
-        cart_item, created = CartItem.objects.get_or_create(
-            cart=cart,
-            product=product,
-            defaults={'quantity': quantity}
-        )
-        if not created:
-            cart_item.quantity = quantity
-            cart_item.save()
+def _parse_quantities(request):
+    """Read ``{product id: quantity}`` from a JSON body or ``quantity-<id>`` fields"""
+    if request.content_type == 'application/json':
+        data = json.loads(request.body)
+        if isinstance(data, dict) and 'items' in data:
+            data = data['items']
+        if not isinstance(data, dict):
+            raise ValueError('Expected an object of product id to quantity')
     else:
-        try:
-            cart_item = CartItem.objects.get(cart=cart, product=product)
-            cart_item.delete()
-        except CartItem.DoesNotExist:
-            pass
+        data = {
+            key[len('quantity-'):]: value
+            for key, value in request.POST.items()
+            if key.startswith('quantity-')
+        }
+    quantities = {int(product_id): int(quantity) for product_id, quantity in data.items()}
+    if any(quantity < 0 for quantity in quantities.values()):
+        raise ValueError('Quantities cannot be negative')
+    return quantities
+
+
+@require_POST
+@idempotent
+def update_cart_batch(request):
+    """Update several cart quantities at once
+
+    Accepts a JSON object ``{"items": {"<product id>": quantity}}`` or
+    form fields named ``quantity-<product id>``; a quantity of 0 removes
+    the line. JSON and AJAX requests get the new cart summary back.
+    """
+    try:
+        quantities = _parse_quantities(request)
+    except (TypeError, ValueError) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
 
+    items = set_quantities(request, quantities)
+
+    if request.content_type == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return JsonResponse({
+            'success': True,
+            'cart_total': sum(item.quantity for item in items),
+            'total_price': str(sum(item.get_total_price() for item in items)),
+            'items': {
+                item.product_id: {
+                    'quantity': item.quantity,
+                    'total_price': str(item.get_total_price()),
+                }
+                for item in items
+            },
+        })
+
+    messages.success(request, 'Cart updated!')
     return redirect('store:cart_detail')
 
 
 @login_required
+@require_POST
+@idempotent
+def proceed_to_checkout(request):
+    """Hold the cart's stock, then show the checkout form"""
+    cart = get_object_or_404(Cart, user=request.user)
+    if not cart.items.exists():
+        messages.error(request, 'Your cart is empty!')
+        return redirect('store:cart_detail')
+    try:
+        reserve_cart(cart)
+    except OutOfStock as e:
+        messages.error(request, f'Not enough stock for: {e}. Please update your cart.')
+        return redirect('store:cart_detail')
+    return redirect('store:checkout')
+
+
+@login_required
+@idempotent
 def checkout(request):
     """Checkout process"""
     cart = get_object_or_404(Cart, user=request.user)
+    cart_items = get_cart_items(cart)
 
-    if not cart.items.exists():
+    if not cart_items:
         messages.error(request, 'Your cart is empty!')
         return redirect('store:cart_detail')
 
+    reserved_until = None
     if request.method == 'POST':
         form = OrderForm(request.POST)
         if form.is_valid():
-            order = form.save(commit=False)
-            order.user = request.user
-            order.save()
-
-            # Create order items
-            for cart_item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    price=cart_item.product.price,
-                    quantity=cart_item.quantity
-                )
-                # Update product stock
-                cart_item.product.stock -= cart_item.quantity
-                cart_item.product.save()
-
-            # Clear the cart
-            cart.items.all().delete()
+            try:
+                with transaction.atomic():
+                    order = place_order(request.user, form.save(commit=False))
+                    response = redirect('store:order_detail', order_id=order.id)
+                    # Committed with the order, so a retry after a crash
+                    # replays this instead of placing a second order
+                    remember(request, response)
+            except EmptyCart:
+                messages.error(request, 'Your cart is empty!')
+                return redirect('store:cart_detail')
+            except OutOfStock as e:
+                messages.error(request, f'Not enough stock for: {e}. Please update your cart.')
+                return redirect('store:cart_detail')
 
             messages.success(request, f'Order #{order.id} has been placed successfully!')
-            return redirect('store:order_detail', order_id=order.id)
+            return response
     else:
+        # Holds are placed by proceed_to_checkout; showing the form never writes
+        reserved_until = get_hold_expiry(cart)
+
         # Pre-fill form with user data
         initial_data = {
             'first_name': request.user.first_name,
@@ -283,7 +344,11 @@ def checkout(request):
 
     context = {
         'cart': cart,
+        'cart_items': cart_items,
         'form': form,
+        'reserved_until': reserved_until,
+        # A fresh key per rendered form: resubmitting this form replays its result
+        'idempotency_key': uuid.uuid4().hex,
     }
     return render(request, 'store/checkout.html', context)
 
@@ -291,18 +356,73 @@ def checkout(request):
 @login_required
 def order_detail(request, order_id):
     """Display order details"""
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    order = get_object_or_404(
+        Order.objects.prefetch_related('items__product__category'), id=order_id, user=request.user
+    )
     context = {
         'order': order,
     }
     return render(request, 'store/order_detail.html', context)
 
 
+def _order_json(order):
+    return {
+        'id': order.id,
+        'created_at': order.created_at.isoformat(),
+        'status': order.status,
+        'status_display': order.get_status_display(),
+        'item_count': order.item_count,
+        'total_cost': str(order.total_cost),
+        'url': reverse('store:order_detail', args=[order.id]),
+    }
+
+
 @login_required
 def order_history(request):
-    """Display user's order history"""
-    orders = Order.objects.filter(user=request.user)
+    """Display user's order history, newest first, a keyset page at a time
+
+    Filters: ``status``, ``date_from`` and ``date_to`` (inclusive ISO
+    dates). With ``?format=json`` or ``Accept: application/json`` the page
+    is returned as JSON with a ``next`` URL for infinite scroll.
+    """
+    as_json = (
+        request.GET.get('format') == 'json'
+        or 'application/json' in request.headers.get('Accept', '')
+    )
+    filter_form = OrderHistoryFilterForm(request.GET)
+    if not filter_form.is_valid():
+        if as_json:
+            return JsonResponse({'error': 'Invalid filters', 'fields': filter_form.errors}, status=400)
+        orders = Order.objects.none()
+    else:
+        orders = filter_form.filter(Order.objects.filter(user=request.user))
+    if not as_json:
+        orders = orders.prefetch_related('items__product')
+
+    paginator = KeysetPaginator(orders, get_page_size(request))
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        if as_json:
+            return JsonResponse({'error': 'Invalid page cursor'}, status=400)
+        raise Http404('Invalid page cursor')
+
+    if as_json:
+        next_url = None
+        if page.has_next:
+            query = request.GET.copy()
+            query['cursor'] = page.next_cursor
+            next_url = f'{request.path}?{query.urlencode()}'
+        return JsonResponse({
+            'orders': [_order_json(order) for order in page],
+            'next_cursor': page.next_cursor,
+            'next': next_url,
+        })
+
     context = {
-        'orders': orders,
+        'orders': page.object_list,
+        'page': page,
+        'filter_form': filter_form,
+        'filtered': any(request.GET.get(name) for name in filter_form.fields),
     }
     return render(request, 'store/order_history.html', context)